@@ -1,42 +1,160 @@
-from auth0.v3.authentication import GetToken
+import functools
+import logging
+import os
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
 from auth0.v3.management import Auth0
 from auth0.v3.exceptions import Auth0Error
-from api.python_common.repeat_timer import RepeatTimer
+from auth0.v3.rest import RestClient
 from django.conf import settings
 
-API_KEY_UPDATE_TIME = 79200 #22 hours
+logger = logging.getLogger(__name__)
+
+API_TOKEN_REFRESH_MARGIN = 300 #refresh the management token 5 minutes before it expires
+API_TOKEN_REQUEST_TIMEOUT = 5
+API_POOL_MAXSIZE = 10
+DATABASE_CONNECTION = 'Username-Password-Authentication' #connection the accounts of invited users are created in
+
+#counts calls currently being made to the management api
+def _tracked(func):
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        self._check_process()
+        self._count('in_flight', 1)
+        self._count('calls', 1)
+        try:
+            return func(self, *args, **kwargs)
+        finally:
+            self._count('in_flight', -1)
+    return wrapper
+
+class PooledRestClient(RestClient):
+    '''
+    auth0 RestClient that sends its requests over a shared keep-alive session, the sdks client opens a new
+    connection (and TLS handshake) for every call. Rate limited (429) reads are retried with the sdks backoff.
+    '''
+
+    def __init__(self, session, jwt, options=None):
+        super().__init__(jwt, options=options)
+        self.session = session
+
+    def get(self, url, params=None, headers=None):
+        request_headers = dict(self.base_headers, **(headers or {}))
+        self._metrics = {'retries': 0, 'backoff': []}
+        attempt = 0
+        while True:
+            attempt += 1
+            response = self.session.request('get', url, params=params, headers=request_headers, timeout=self.options.timeout)
+            if response.status_code != 429 or attempt > self._retries:
+                return self._process_response(response)
+            time.sleep(self._calculate_wait(attempt) / 1000)
+
+    def post(self, url, data=None, headers=None):
+        return self._send('post', url, dict(self.base_headers, **(headers or {})), json=data)
+
+    def file_post(self, url, data=None, files=None):
+        headers = {key: value for key, value in self.base_headers.items() if key != 'Content-Type'}
+        return self._send('post', url, headers, data=data, files=files)
+
+    def patch(self, url, data=None):
+        return self._send('patch', url, self.base_headers, json=data)
+
+    def put(self, url, data=None):
+        return self._send('put', url, self.base_headers, json=data)
+
+    def delete(self, url, params=None, data=None):
+        return self._send('delete', url, self.base_headers, params=params or {}, json=data)
+
+    def _send(self, method, url, headers, **kwargs):
+        response = self.session.request(method, url, headers=headers, timeout=self.options.timeout, **kwargs)
+        return self._process_response(response)
+
 
 class Auth0ManagmentAPI:
+    '''
+    Thread safe Auth0 management API client.
+
+    The management token is fetched lazily on first use and refreshed when it is within
+    API_TOKEN_REFRESH_MARGIN seconds of its `expires_in`, token requests and management api calls reuse a pooled keep-alive session.
+    Use get_management_client() to get the process wide instance rather than constructing one per call.
+    '''
 
     def __init__(self, non_interactive_client_id, non_interactive_client_secret, domain):
         self.client_id = non_interactive_client_id
         self.client_secret = non_interactive_client_secret
         self.domain = domain
-        self.run()
+        self._reset()
+
+    #(re)creates all per process state, called on init and in a child process after a fork
+    def _reset(self):
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        #a lock held by another thread of the parent at fork time would never be released in the child
+        self._metrics_lock = threading.Lock()
+        self.metrics = {'token_refreshes': 0, 'token_refresh_failures': 0, 'in_flight': 0, 'calls': 0}
+        self._auth0 = None
+        self._expires_at = 0
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=API_POOL_MAXSIZE))
 
-    def run(self):
-        self._update_Auth0_conection()
-        self.update_timer = RepeatTimer(API_KEY_UPDATE_TIME, self._update_Auth0_conection)
-        self.update_timer.start()
+    #sockets and locks inherited from a pre-fork parent process cant be shared so start fresh
+    def _check_process(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    @property
+    def auth0(self):
+        self._check_process()
+        if self._auth0 is None or time.monotonic() >= self._expires_at:
+            with self._lock:
+                #another thread may have refreshed the token while we waited on the lock
+                if self._auth0 is None or time.monotonic() >= self._expires_at:
+                    self._update_Auth0_conection()
+        return self._auth0
 
     def stop(self):
-        self.update_timer.cancel()
+        self.session.close()
+
+    def get_metrics(self):
+        with self._metrics_lock:
+            return dict(self.metrics)
 
-    # TODO make this function threadsafe                                                                                                        
     def _update_Auth0_conection(self):
-        token = self._get_new_Auth0_token()
-        self.auth0 = Auth0(self.domain, token)
+        token, expires_in = self._get_new_Auth0_token()
+        auth0 = Auth0(self.domain, token)
+        #every endpoint of the sdk has its own client, they all send their requests over the pooled session
+        for endpoint in vars(auth0).values():
+            if isinstance(getattr(endpoint, 'client', None), RestClient):
+                endpoint.client = PooledRestClient(self.session, token, options=endpoint.client.options)
+        self._auth0 = auth0
+        self._expires_at = time.monotonic() + max(expires_in - API_TOKEN_REFRESH_MARGIN, 0)
 
     def _get_new_Auth0_token(self):
-        get_token = GetToken(self.domain)
-        try: 
-            token = get_token.client_credentials(self.client_id, self.client_secret, 'https://{}/api/v2/'.format(self.domain))
-            mgmt_api_token = token['access_token']
-            return mgmt_api_token
+        body = {
+            'grant_type': 'client_credentials',
+            'client_id': self.client_id,
+            'client_secret': self.client_secret,
+            'audience': 'https://{}/api/v2/'.format(self.domain),
+        }
+        try:
+            resp = self.session.post('https://{}/oauth/token'.format(self.domain), json=body, timeout=API_TOKEN_REQUEST_TIMEOUT)
+            resp.raise_for_status()
+            token = resp.json()
         except Exception as e:
-            print(e) # TODO: Maker this a logger statment
+            self._count('token_refresh_failures', 1)
+            logger.error('Unable to get Auth0 management API token: %s', e)
+            raise
 
+        self._count('token_refreshes', 1)
+        return token['access_token'], token.get('expires_in', 86400)
 
+    def _count(self, name, amount):
+        with self._metrics_lock:
+            self.metrics[name] += amount
+
+    @_tracked
     def list_users(self):
         """
         Gets list of users 
@@ -53,6 +171,7 @@ class Auth0ManagmentAPI:
 
         return data
 
+    @_tracked
     def get_user(self, user_id=None, email=None):
         """
         Get user - gets a single user 
@@ -81,7 +200,8 @@ class Auth0ManagmentAPI:
         return fetched_user
 
         
-    def create_user(self, email, name, password, validate_email=False):
+    @_tracked
+    def create_user(self, email, name, password, validate_email=False, app_metadata=None):
         """
         Create user 
 
@@ -91,6 +211,8 @@ class Auth0ManagmentAPI:
             the detials of the new user 
         validate_email : bool
             send the validation email on user creation 
+        app_metadata : dict
+            stored with the account, e.g to tag it with the local user it was created for
         Returns
         -------
         on success - the user id of the newly created user 
@@ -100,17 +222,33 @@ class Auth0ManagmentAPI:
             "email": email,
             "name": name,
             "email_verified": validate_email,
-            "connection" : "Username-Password-Authentication",
+            "connection" : DATABASE_CONNECTION,
             "password": password,
         }
+        if app_metadata:
+            user_body["app_metadata"] = app_metadata
         resp = self.auth0.users.create(user_body)
         return resp.get("user_id")
 
 
+    #returns the auth0 user id of the database connection account with the email (and the given app_metadata values), None if there isnt one.
+    # accounts of other connections (e.g a social login with the same email) are never returned
+    @_tracked
+    def get_user_id_by_email(self, email, app_metadata=None):
+        users = self.auth0.users_by_email.search_users_by_email(email, fields=['user_id', 'identities', 'app_metadata'])
+        for user in users:
+            connections = {identity.get('connection') for identity in user.get('identities') or []}
+            metadata = user.get('app_metadata') or {}
+            if DATABASE_CONNECTION in connections and all(metadata.get(key) == value for key, value in (app_metadata or {}).items()):
+                return user['user_id']
+        return None
+
+    @_tracked
     def delete_user(self, user_id):  
         self.auth0.users.delete(user_id)
         return True
 
+    @_tracked
     def get_passsword_reset_url_by_id(self, user_id, invite_url=False):
         request_body = {
             'user_id' : user_id,
@@ -123,6 +261,7 @@ class Auth0ManagmentAPI:
             url += 'invite'
         return url
 
+    @_tracked
     def get_email_template(self, template_name):
         """Retrieves an email template by its name.
 
@@ -137,6 +276,23 @@ class Auth0ManagmentAPI:
         return template.get('body') 
 
     #returns all clients/applications
+    @_tracked
     def get_client_application(self, client_id):
         client = self.auth0.clients.get(client_id)
         return client
+
+
+_management_client = None
+_management_client_lock = threading.Lock()
+
+#returns the process wide management api client created from the AUTH0_* environment variables on first use
+def get_management_client():
+    global _management_client
+    if _management_client is None:
+        with _management_client_lock:
+            if _management_client is None:
+                _management_client = Auth0ManagmentAPI(
+                    os.environ.get('AUTH0_CLIENT_ID'),
+                    os.environ.get('AUTH0_CLIENT_SECRET'),
+                    os.environ.get('AUTH0_DOMAIN'))
+    return _management_client
@@ -1,33 +1,206 @@
+import copy
 import requests
+import hashlib
+import threading
 import os
+import time
 from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from jose import jwt
 from rest_framework import exceptions
 from rest_framework.authentication import (BaseAuthentication,
                                            get_authorization_header)
 
-from api.utilities.auth0 import Auth0ManagmentAPI
-from api.models import User
+from api.utilities.auth0 import get_management_client
+from api.utilities.jwks import get_jwks_store
+from api.utilities.outbox import PENDING_AUTH0_ID_PREFIX
+from api.utilities.ttl_cache import MISSING, TTLCache
+from api.models import User, users_bulk_updated
 
 User = get_user_model()
 
+AUTH0_TOKEN_CACHE_SIZE = 10000
+AUTH0_TOKEN_CACHE_LEEWAY = 30 #seconds before a tokens exp that its cache entry is dropped
+AUTH0_TOKEN_CACHE_MAX_TTL = 300 #caps how long a user change made in another process can go unseen
+AUTH0_USERINFO_CACHE_SIZE = 10000
+AUTH0_USERINFO_CACHE_TTL = 3600
+AUTH0_USERINFO_TIMEOUT = 5
+#how users of authorization code tokens are resolved
+#.. 'claims' - match the verified `sub` claim to User.auth0_id, if no user matches call /userinfo and link the
+#..   local user with the same verified email (e.g created before their auth0 account) to the sub
+#.. 'userinfo' - always match the email and sub returned by /userinfo (cached per subject)
+AUTH0_IDENTITY_RESOLUTION = 'claims'
+AUTH0_CLIENT_CACHE_SIZE = 10000
+AUTH0_CLIENT_CACHE_TTL = 3600
+AUTH0_CLIENT_CACHE_NEGATIVE_TTL = 60 #seconds clients without a matching user are remembered
+
+
+class VerifiedTokenCache:
+    '''
+    Bounded LRU cache of bearer tokens that have already been verified, keyed by a sha256 hash of the token.
+
+    Holds the decoded payload and the resolved user until the tokens `exp` (minus `leeway` seconds)
+    so repeat requests with the same token skip the RS256 verification and the user lookup. Every
+    request gets its own copy of the cached user so concurrent requests never share an instance.
+    Entries for a user are dropped when the user is saved or deleted in this process (through a
+    user id -> token keys index so only that users entries are touched), other processes pick the
+    change up after at most `max_ttl` seconds. A user loaded before an invalidation (read `generation`
+    before loading it) is never cached and inactive users arent cached.
+    '''
+
+    def __init__(self, maxsize=AUTH0_TOKEN_CACHE_SIZE, leeway=AUTH0_TOKEN_CACHE_LEEWAY, max_ttl=AUTH0_TOKEN_CACHE_MAX_TTL):
+        self.leeway = leeway
+        self.max_ttl = max_ttl
+        self._user_keys = {}
+        self._index_lock = threading.Lock()
+        #changes with every invalidation so a user loaded before one can be told apart
+        self.generation = 0
+        self.cache = TTLCache(maxsize=maxsize, on_remove=self._unindex)
+
+    @staticmethod
+    def key(token):
+        if isinstance(token, str):
+            token = token.encode()
+        return hashlib.sha256(token).hexdigest()
+
+    #returns (payload, user) for a verified token or None if it isnt cached
+    def get(self, token):
+        entry = self.cache.get(self.key(token))
+        if entry is MISSING:
+            return None
+        payload, user = entry
+        return payload, copy.copy(user)
+
+    #caches a user loaded from the database when the cache was at `generation`
+    def set(self, token, payload, user, generation):
+        exp = payload.get('exp')
+        if not exp or not user.is_active:
+            return
+
+        ttl = min(exp - time.time() - self.leeway, self.max_ttl)
+        if ttl <= 0:
+            return
+        key = self.key(token)
+        #the cached instance is never handed out, requests get copies of it
+        self.cache.set(key, (payload, copy.copy(user)), ttl=ttl)
+        #the entry is indexed under the same lock invalidations take, an invalidation since the user was loaded (which
+        # couldnt find this entry in the index yet) means the cached user may be stale so it is dropped again
+        with self._index_lock:
+            stale = generation != self.generation
+            if not stale:
+                self._user_keys.setdefault(str(user.pk), set()).add(key)
+        if stale:
+            self.cache.delete(key)
+
+    def invalidate_user(self, user_id):
+        with self._index_lock:
+            self.generation += 1
+            keys = self._user_keys.pop(str(user_id), ())
+        for key in keys:
+            self.cache.delete(key)
+        return len(keys)
+
+    def invalidate_users(self, user_ids):
+        return sum(self.invalidate_user(user_id) for user_id in user_ids)
+
+    def clear(self):
+        with self._index_lock:
+            self.generation += 1
+            self._user_keys.clear()
+        self.cache.clear()
+
+    #keeps the user index in step with entries leaving the cache (eviction, expiry, invalidation)
+    def _unindex(self, key, entry):
+        user_id = str(entry[1].pk)
+        with self._index_lock:
+            keys = self._user_keys.get(user_id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._user_keys[user_id]
+
+
+class ClientIdentityCache:
+    '''
+    Cache of client application id -> (email, auth0 id, user pk) of the user a client credentials client acts as,
+    None for clients without a matching user (cached for a shorter ttl).
+
+    Entries are indexed by user pk (as a string, like VerifiedTokenCache) so saving or deleting a user only drops the entries of
+    the clients acting as that user instead of scanning the whole cache.
+    '''
+
+    def __init__(self, maxsize=AUTH0_CLIENT_CACHE_SIZE, ttl=AUTH0_CLIENT_CACHE_TTL):
+        self._user_clients = {}
+        self._index_lock = threading.Lock()
+        self.cache = TTLCache(maxsize=maxsize, ttl=ttl, on_remove=self._unindex)
+
+    #returns the cached identity (None for clients without a user) or MISSING
+    def get(self, client_id):
+        return self.cache.get(client_id)
+
+    def set(self, client_id, identity, ttl=None):
+        self.cache.set(client_id, identity, ttl=ttl)
+        if identity is not None:
+            with self._index_lock:
+                self._user_clients.setdefault(str(identity[2]), set()).add(client_id)
+
+    def delete(self, client_id):
+        self.cache.delete(client_id)
+
+    def invalidate_user(self, user_id):
+        with self._index_lock:
+            client_ids = self._user_clients.pop(str(user_id), ())
+        for client_id in client_ids:
+            self.cache.delete(client_id)
+        return len(client_ids)
+
+    def invalidate_users(self, user_ids):
+        return sum(self.invalidate_user(user_id) for user_id in user_ids)
+
+    def clear(self):
+        with self._index_lock:
+            self._user_clients.clear()
+        self.cache.clear()
+
+    #keeps the user index in step with entries leaving the cache (eviction, expiry, invalidation)
+    def _unindex(self, client_id, identity):
+        if identity is None:
+            return
+        with self._index_lock:
+            client_ids = self._user_clients.get(str(identity[2]))
+            if client_ids is not None:
+                client_ids.discard(client_id)
+                if not client_ids:
+                    del self._user_clients[str(identity[2])]
+
+
+verified_token_cache = VerifiedTokenCache(
+    maxsize=getattr(settings, 'AUTH0_TOKEN_CACHE_SIZE', AUTH0_TOKEN_CACHE_SIZE),
+    leeway=getattr(settings, 'AUTH0_TOKEN_CACHE_LEEWAY', AUTH0_TOKEN_CACHE_LEEWAY),
+    max_ttl=getattr(settings, 'AUTH0_TOKEN_CACHE_MAX_TTL', AUTH0_TOKEN_CACHE_MAX_TTL))
+
+client_identity_cache = ClientIdentityCache(
+    maxsize=getattr(settings, 'AUTH0_CLIENT_CACHE_SIZE', AUTH0_CLIENT_CACHE_SIZE),
+    ttl=getattr(settings, 'AUTH0_CLIENT_CACHE_TTL', AUTH0_CLIENT_CACHE_TTL))
+
+#drop cached users whenever they change (e.g is deactivated) or are deleted so the stale user isnt authenticated
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_verified_tokens(sender, instance, **kwargs):
+    verified_token_cache.invalidate_user(instance.pk)
+    client_identity_cache.invalidate_user(instance.pk)
+
+@receiver(users_bulk_updated)
+def invalidate_bulk_updated_tokens(sender, user_ids, **kwargs):
+    verified_token_cache.invalidate_users(user_ids)
+    client_identity_cache.invalidate_users(user_ids)
+
 def is_valid_auth0token(token):
-    # TODO: remove request and make the `json` file as part of the project to save the request time
-    resp = requests.get('https://'+settings.AUTH0_DOMAIN +
-                        '/.well-known/jwks.json')
-    jwks = resp.json()
+    #signing keys come from the process wide jwks store so no request is made to Auth0 unless the keys have rotated
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
+    rsa_key = get_jwks_store().get_key(unverified_header.get('kid'))
     if rsa_key:
         try:
             payload = jwt.decode(
@@ -55,14 +228,93 @@ def is_valid_auth0token(token):
 def get_auth0_user_data(token):
     url = 'https://' + settings.AUTH0_DOMAIN + '/userinfo'
     params = {'access_token': token}
-    resp = requests.get(url, params)
+    resp = requests.get(url, params, timeout=AUTH0_USERINFO_TIMEOUT)
     data = resp.json()
     return data
 
+userinfo_cache = TTLCache(
+    maxsize=getattr(settings, 'AUTH0_USERINFO_CACHE_SIZE', AUTH0_USERINFO_CACHE_SIZE),
+    ttl=getattr(settings, 'AUTH0_USERINFO_CACHE_TTL', AUTH0_USERINFO_CACHE_TTL))
+
+#returns the /userinfo data for the tokens subject, only calling Auth0 once per subject while it is cached
+def get_cached_auth0_user_data(token, subject):
+    user_data = userinfo_cache.get(subject)
+    if user_data is MISSING:
+        user_data = get_auth0_user_data(token)
+        #only cache responses for the same subject as the verified token, error responses have no sub
+        if subject and user_data.get('sub') == subject:
+            userinfo_cache.set(subject, user_data)
+    return user_data
+
+#resolves the user for an authorization code token from its verified claims falling back to /userinfo
+def get_user_from_claims(token, payload):
+    subject = payload.get('sub')
+    mode = getattr(settings, 'AUTH0_IDENTITY_RESOLUTION', AUTH0_IDENTITY_RESOLUTION)
+    if mode == 'claims':
+        if not subject:
+            return None
+        user = User.objects.filter(auth0_id=subject).last()
+        if user:
+            return user
+        return link_user_by_email(token, subject)
+
+    user_data = get_cached_auth0_user_data(token, subject)
+    auth0_email = user_data.get('email')
+    auth0_user_id = user_data.get('sub')
+    return User.objects.filter(email=auth0_email, auth0_id=auth0_user_id).last()
+
+#links the local user with the subjects verified /userinfo email to the subject, None if there is no such user or it is linked to another identity
+def link_user_by_email(token, subject):
+    user_data = get_cached_auth0_user_data(token, subject)
+    auth0_email = user_data.get('email')
+    #an unverified email could belong to anyone so it is never used to link accounts
+    if user_data.get('sub') != subject or not auth0_email or not user_data.get('email_verified'):
+        return None
+
+    user = User.objects.filter(email=auth0_email).last()
+    if user is None:
+        return None
+    #only users without an auth0 account yet are linked, a user already linked to another identity (e.g a social
+    # connection with the same email) keeps it so a second identity cant take the account over
+    if user.auth0_id and not user.auth0_id.startswith(PENDING_AUTH0_ID_PREFIX):
+        return None
+    #later tokens for the subject then resolve from the sub claim without calling /userinfo
+    user.auth0_id = subject
+    user.save(update_fields=['auth0_id'])
+    return user
+
 def get_auth0_client_application_meta_data(client_id):
-    ath = Auth0ManagmentAPI(os.environ.get('AUTH0_CLIENT_ID'), os.environ.get('AUTH0_CLIENT_SECRET'), os.environ.get('AUTH0_DOMAIN'))
+    ath = get_management_client()
     client = ath.get_client_application(client_id)
-    return client['client_metadata']
+    #clients created without metadata have no client_metadata key
+    return client.get('client_metadata') or {}
+
+#returns (email, auth0 user id, user pk) of the user a m2m client application is assigned to or None if there is no matching user
+def get_client_application_identity(client_id):
+    identity = client_identity_cache.get(client_id)
+    if identity is not MISSING:
+        return identity
+
+    client_meta_data = get_auth0_client_application_meta_data(client_id)
+    auth0_email = client_meta_data.get('user_email')
+    auth0_user_id = client_meta_data.get('auth0_user_id')
+    user_pk = User.objects.filter(email=auth0_email, auth0_id=auth0_user_id).values_list('pk', flat=True).last()
+    if user_pk is None:
+        #negative cache clients that dont map to a user so they cant hammer the management api
+        negative_ttl = getattr(settings, 'AUTH0_CLIENT_CACHE_NEGATIVE_TTL', AUTH0_CLIENT_CACHE_NEGATIVE_TTL)
+        client_identity_cache.set(client_id, None, ttl=negative_ttl)
+        return None
+
+    identity = (auth0_email, auth0_user_id, user_pk)
+    client_identity_cache.set(client_id, identity)
+    return identity
+
+#must be called when a client applications metadata changes, drops every cached client if no client_id is given
+def invalidate_client_application_identity(client_id=None):
+    if client_id is None:
+        client_identity_cache.clear()
+    else:
+        client_identity_cache.delete(client_id)
 
 class Auth0TokenAuthentication(BaseAuthentication):
     '''
@@ -90,6 +342,13 @@ class Auth0TokenAuthentication(BaseAuthentication):
         return self.authenticate_credentials(token)
 
     def authenticate_credentials(self, token):
+        #tokens that have already been verified skip signature verification and the user lookup
+        cached = verified_token_cache.get(token)
+        if cached:
+            payload, user = cached
+            return user, token
+
+        generation = verified_token_cache.generation
         payload, is_valid = is_valid_auth0token(token)
         if not is_valid:
             raise exceptions.AuthenticationFailed(self.err_msg)
@@ -100,20 +359,17 @@ class Auth0TokenAuthentication(BaseAuthentication):
             client_id = payload['azp']
             auth0_email = payload.get('auth0_user_email')
             auth0_user_id = payload.get('auth0_user_id')
-            #if the user email and user id where not passed into the token by the auth0 m2m actions script call the management API to get the details from the client app metadata
+            #if the user email and user id where not passed into the token by the auth0 m2m actions script get the details from the client app metadata (cached per client)
             if not auth0_email or not auth0_user_id:
-                client_meta_data = get_auth0_client_application_meta_data(client_id)
-                auth0_email = client_meta_data['user_email']
-                auth0_user_id = client_meta_data['auth0_user_id']
-
-            user = User.objects.filter(email=auth0_email, auth0_id=auth0_user_id).last()
+                identity = get_client_application_identity(client_id)
+                user = User.objects.filter(pk=identity[2]).first() if identity else None
+            else:
+                user = User.objects.filter(email=auth0_email, auth0_id=auth0_user_id).last()
         else:
-            user_data = get_auth0_user_data(token)
-            auth0_email = user_data.get('email')
-            auth0_user_id = user_data.get('sub')
-            user = User.objects.filter(email=auth0_email, auth0_id=auth0_user_id).last()
+            user = get_user_from_claims(token, payload)
 
         if not user:
             raise exceptions.AuthenticationFailed('Matching user not found for Identity Server user')
 
+        verified_token_cache.set(token, payload, user, generation)
         return user, token
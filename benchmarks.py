@@ -0,0 +1,173 @@
+import json
+import random
+import time
+from unittest import skipIf
+from django.db import connection
+from django.db.models import Prefetch
+from rest_framework.renderers import JSONRenderer
+from django.test.utils import CaptureQueriesContext
+from api.models import OrganizationMembership, User
+from api.renderers import FastJSONRenderer, orjson
+from api.serializers import OrganizationMembershipSerializer, UserSerializer
+from api.tests import AllowedRolesTests, EndpointTestCase, SMTPSink, loop_allowed_roles
+from api.utilities.mailer import EmailDelivery, invite_email
+
+'''
+Benchmarks for the hot paths of the api.
+
+They arent collected with the tests (only test*.py modules are), run them with `python manage.py test api.benchmarks`.
+Timings are printed, the assertions only check that costs scale the way the optimizations intend so they hold on any machine.
+'''
+
+#best wall time of a number of runs in seconds
+def best_of(func, repeat=5):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+def report(name, **values):
+    print('\n{}: {}'.format(name, ', '.join('{}={}'.format(key, value) for key, value in values.items())))
+
+#adds `count` users with a user membership of the organization, numbered from `start`
+def seed_members(organization, count, start=0):
+    User.objects.bulk_create_users([{
+        'email': 'member{}@example.com'.format(i),
+        'auth0_id': 'auth0|member{}'.format(i),
+        'timezone': 'UTC',
+        'memberships': [{'organization_id': organization.pk, 'role': 'user'}],
+    } for i in range(start, start + count)])
+
+
+#--------------- Access policies -----------------------
+
+class AllowedRolesBenchmarks(AllowedRolesTests):
+    #the correctness test is run with the tests
+    test_matches_statement_loop = None
+
+    def test_faster_than_statement_loop(self):
+        rng = random.Random(7)
+        statements = self.random_statements(rng, 200)
+        policy = self.policy(statements)
+        roles = set(self.ROLES)
+        actions = self.ACTIONS * 200
+
+        looped = best_of(lambda: [loop_allowed_roles(statements, action, roles) for action in actions])
+        indexed = best_of(lambda: [policy.allowed_roles(action, roles) for action in actions])
+        report('allowed roles of 200 statements', calls=len(actions), loop=round(looped, 4), indexed=round(indexed, 4),
+               speedup=round(looped / indexed, 2))
+        self.assertLess(indexed, looped)
+
+
+#--------------- Pagination -----------------------
+
+class PaginationBenchmarks(EndpointTestCase):
+    def list_users(self):
+        self.authenticate()
+        return self.client.get('/users', {'limit': 25})
+
+    def test_page_cost_is_constant(self):
+        seeded = 0
+        pages = {}
+        for total in (1000, 10000):
+            seed_members(self.organization, total - seeded, seeded)
+            seeded = total
+            with CaptureQueriesContext(connection) as queries:
+                response = self.list_users()
+            self.assertEqual(len(response.data['data']), 25)
+            #captured queries are read from the connections log which the next request clears
+            pages[total] = (len(queries), best_of(self.list_users))
+            report('users list page', rows=total, queries=pages[total][0], seconds=round(pages[total][1], 4))
+
+        #the page is sliced in the database, 10x the rows doesnt mean more queries or 10x the time
+        self.assertEqual(pages[1000][0], pages[10000][0])
+        self.assertLess(pages[10000][1], pages[1000][1] * 5)
+
+
+#--------------- List serialization -----------------------
+
+class ValuesSerializationBenchmarks(EndpointTestCase):
+    def test_values_path_is_faster_than_serializer(self):
+        memberships = OrganizationMembership.objects.filter(organization=self.organization).order_by('pk')
+        sources = OrganizationMembershipSerializer.values_sources()
+        seeded = memberships.count()
+        for total in (1000, 10000, 100000):
+            OrganizationMembership.objects.bulk_create([
+                OrganizationMembership(user=self.member, organization=self.organization, role='user', is_external=False)
+                for _ in range(total - seeded)], batch_size=5000)
+            seeded = total
+
+            serialize = lambda: OrganizationMembershipSerializer(list(memberships.all()), many=True).data
+            from_values = lambda: OrganizationMembershipSerializer.from_values(memberships.values(*sources))
+            if total == 1000:
+                self.assertEqual(from_values(), serialize())
+
+            repeat = 1 if total == 100000 else 3
+            serialized, values = best_of(serialize, repeat), best_of(from_values, repeat)
+            report('memberships serialization', rows=total, serializer=round(serialized, 4), values=round(values, 4),
+                   speedup=round(serialized / values, 2))
+            self.assertLess(values, serialized)
+
+
+#--------------- Rendering -----------------------
+
+class RendererBenchmarks(EndpointTestCase):
+    @skipIf(orjson is None, 'orjson is not installed')
+    def test_fast_renderer_encodes_user_payloads_faster(self):
+        seed_members(self.organization, 5000)
+        users = User.objects.order_by('pk').prefetch_related(Prefetch('organizationmembership_set', to_attr='memberships'))
+        rendered = UserSerializer(users, many=True).data
+        data = {'total_results': len(rendered), 'next': None, 'previous': None, 'data': rendered}
+
+        fast, stdlib = FastJSONRenderer(), JSONRenderer()
+        self.assertEqual(json.loads(fast.render(data)), json.loads(stdlib.render(data)))
+
+        fast_seconds, stdlib_seconds = best_of(lambda: fast.render(data)), best_of(lambda: stdlib.render(data))
+        report('users payload rendering', users=len(data['data']), orjson=round(fast_seconds, 4), stdlib=round(stdlib_seconds, 4),
+               speedup=round(stdlib_seconds / fast_seconds, 2))
+        self.assertLess(fast_seconds, stdlib_seconds)
+
+
+#--------------- Email -----------------------
+
+class EmailDeliveryBenchmarks(EndpointTestCase):
+    def test_emails_per_second(self):
+        emails = [invite_email('new{}@example.com'.format(i), 'Admin', self.admin.email, 'https://example.com/reset') for i in range(500)]
+        delivery = EmailDelivery()
+        with SMTPSink() as sink:
+            start = time.perf_counter()
+            statuses = delivery.send(emails)
+            batched = time.perf_counter() - start
+            #a connection per email, as before batching
+            start = time.perf_counter()
+            for email in emails[:100]:
+                delivery.send([email])
+            single = time.perf_counter() - start
+
+        self.assertTrue(all(status['status'] == 'sent' for status in statuses))
+        report('email delivery to a local smtp sink', batched_per_second=round(len(emails) / batched), connection_per_email_per_second=round(100 / single))
+        self.assertEqual(sink.connections, 101)
+        self.assertGreater(len(emails) / batched, 100 / single)
+
+
+#--------------- Invites -----------------------
+
+class InviteBenchmarks(EndpointTestCase):
+    #invited users are created with create_user(auth0_managed=True), compared with the same call validating and hashing a local password
+    def test_auth0_managed_users_per_cpu_second(self):
+        def users_per_cpu_second(prefix, count, **kwargs):
+            start = time.process_time()
+            for i in range(count):
+                User.objects.create_user('{}{}@example.com'.format(prefix, i), auth0_id='auth0|{}{}'.format(prefix, i), timezone='UTC', **kwargs)
+            return count / (time.process_time() - start)
+
+        managed = users_per_cpu_second('managed', 20, auth0_managed=True)
+        hashed = users_per_cpu_second('hashed', 20, password='A-long-enough-password')
+        self.assertFalse(User.objects.get(email='managed0@example.com').has_usable_password())
+        self.assertTrue(User.objects.get(email='hashed0@example.com').has_usable_password())
+
+        report('create_user', auth0_managed_per_cpu_second=round(managed, 1), hashed_password_per_cpu_second=round(hashed, 1),
+               speedup=round(managed / hashed, 2))
+        self.assertGreater(managed, hashed)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand, CommandError
+from api.models import User
+
+'''
+Prints a users django rest api token (for TokenAuthentication), creating it if they dont have one yet.
+
+Users created with a local password get their token when they are created. Auth0 managed users (e.g invited users)
+authenticate with Auth0 access tokens and have no api token until one is issued with this command.
+'''
+
+class Command(BaseCommand):
+    help = 'Prints the api token of a user, creating it on first use'
+
+    def add_arguments(self, parser):
+        parser.add_argument('email', help='email of the user')
+
+    def handle(self, *args, **options):
+        user = User.objects.filter(email__iexact=options['email']).first()
+        if user is None:
+            raise CommandError('No user with the email {}'.format(options['email']))
+        self.stdout.write(user.get_api_token().key)
@@ -0,0 +1,156 @@
+import json
+import logging
+import threading
+import time
+import requests
+from django.conf import settings
+from api.python_common.repeat_timer import RepeatTimer
+
+logger = logging.getLogger(__name__)
+
+JWKS_REFRESH_INTERVAL = 3600 #1 hour
+JWKS_MIN_REFETCH_INTERVAL = 30 #minimum seconds between on demand fetches triggered by unknown key ids
+JWKS_REQUEST_TIMEOUT = 5
+#fields of a json web key needed to verify an RS256 signature
+RSA_KEY_FIELDS = ('kty', 'kid', 'use', 'n', 'e')
+
+
+class JWKSStore:
+    '''
+    Process wide cache of the Auth0 tenants JSON Web Key Set indexed by key id (kid).
+
+    Keys are loaded once, refreshed in the background every `refresh_interval` seconds and
+    re-fetched on demand when a token is signed with a kid we have not seen (Auth0 key rotation).
+    On demand fetches are rate limited to one per `min_refetch_interval` seconds and concurrent
+    requests for unknown kids are coalesced into a single fetch.
+
+    If `jwks_file` is given keys are read from the local file instead of Auth0 so it can be used offline (tests).
+    '''
+
+    def __init__(self, domain=None, jwks_file=None, refresh_interval=JWKS_REFRESH_INTERVAL,
+                 min_refetch_interval=JWKS_MIN_REFETCH_INTERVAL):
+        self.domain = domain
+        self.jwks_file = jwks_file
+        self.refresh_interval = refresh_interval
+        self.min_refetch_interval = min_refetch_interval
+        self.update_timer = None
+        self._keys = {}
+        self._generation = 0
+        self._last_attempt = None
+        self._fetch_lock = threading.Lock()
+        self._metrics_lock = threading.Lock()
+        self.metrics = {'hits': 0, 'misses': 0, 'refreshes': 0, 'refresh_failures': 0}
+
+    def get_key(self, kid):
+        """
+        Gets the RSA key for a key id
+
+        Parameters
+        ----------
+        kid : str
+            The key id from the tokens unverified header
+        Returns
+        -------
+        the rsa key dict on success, None if no key with the kid exists
+        """
+        key = self._keys.get(kid)
+        if key:
+            self._count('hits')
+            return key
+
+        self._count('misses')
+        return self._fetch_unknown_kid(kid)
+
+    def refresh(self):
+        """Fetches the key set and swaps it in, keeps the existing keys if the fetch fails."""
+        with self._fetch_lock:
+            self._refresh()
+
+    def start(self):
+        """Starts the background refresh timer if it isnt already running."""
+        if self.update_timer is None and self.refresh_interval:
+            self.update_timer = RepeatTimer(self.refresh_interval, self.refresh)
+            self.update_timer.daemon = True
+            self.update_timer.start()
+
+    def stop(self):
+        if self.update_timer is not None:
+            self.update_timer.cancel()
+            self.update_timer = None
+
+    def get_metrics(self):
+        with self._metrics_lock:
+            metrics = dict(self.metrics)
+        metrics['keys'] = len(self._keys)
+        return metrics
+
+    def _fetch_unknown_kid(self, kid):
+        generation = self._generation
+        with self._fetch_lock:
+            #another request refreshed the keys while we were waiting on the lock so use its result
+            if self._generation != generation:
+                return self._keys.get(kid)
+
+            #rate limit fetches so tokens with made up kids cant be used to hammer Auth0
+            last_attempt = self._last_attempt
+            if last_attempt is not None and time.monotonic() - last_attempt < self.min_refetch_interval:
+                return None
+
+            self._refresh()
+            self.start()
+            return self._keys.get(kid)
+
+    def _refresh(self):
+        self._last_attempt = time.monotonic()
+        try:
+            jwks = self._load()
+        except Exception as e:
+            self._count('refresh_failures')
+            logger.warning('Unable to refresh JWKS: %s', e)
+            return
+
+        #replace the whole index in one assignment so readers never see a partially built key set
+        self._keys = {
+            key['kid']: {field: key.get(field) for field in RSA_KEY_FIELDS}
+            for key in jwks.get('keys', []) if key.get('kid')
+        }
+        self._generation += 1
+        self._count('refreshes')
+
+    def _load(self):
+        if self.jwks_file:
+            with open(self.jwks_file) as f:
+                return json.load(f)
+
+        resp = requests.get('https://' + self.domain + '/.well-known/jwks.json', timeout=JWKS_REQUEST_TIMEOUT)
+        resp.raise_for_status()
+        return resp.json()
+
+    def _count(self, name):
+        with self._metrics_lock:
+            self.metrics[name] += 1
+
+
+_jwks_store = None
+_jwks_store_lock = threading.Lock()
+
+#returns the process wide jwks store, created from settings on first use
+def get_jwks_store():
+    global _jwks_store
+    if _jwks_store is None:
+        with _jwks_store_lock:
+            if _jwks_store is None:
+                _jwks_store = JWKSStore(
+                    domain=settings.AUTH0_DOMAIN,
+                    jwks_file=getattr(settings, 'AUTH0_JWKS_FILE', None),
+                    refresh_interval=getattr(settings, 'AUTH0_JWKS_REFRESH_INTERVAL', JWKS_REFRESH_INTERVAL),
+                    min_refetch_interval=getattr(settings, 'AUTH0_JWKS_MIN_REFETCH_INTERVAL', JWKS_MIN_REFETCH_INTERVAL))
+    return _jwks_store
+
+#replaces the process wide jwks store e.g with one reading a local jwks file in tests
+def set_jwks_store(store):
+    global _jwks_store
+    with _jwks_store_lock:
+        if _jwks_store is not None:
+            _jwks_store.stop()
+        _jwks_store = store
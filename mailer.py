@@ -0,0 +1,156 @@
+import logging
+import smtplib
+import threading
+import time
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+from django.template.loader import get_template
+
+logger = logging.getLogger(__name__)
+
+EMAIL_RATE_LIMIT = None #messages per second allowed by the email provider, None disables rate limiting
+EMAIL_RATE_BURST = 10 #messages that can be sent at once before the rate limit applies
+
+'''
+Batched email delivery.
+
+A batch of messages is sent over one authenticated SMTP connection instead of a connection per message,
+paced to the providers quota and with a delivery status reported for every message. Templates are compiled
+once per process.
+
+For local development/tests point EMAIL_BACKEND at django.core.mail.backends.locmem.EmailBackend or run a
+local SMTP sink (e.g `python -m aiosmtpd -n -l localhost:1025`) and set EMAIL_HOST/EMAIL_PORT to it.
+'''
+
+_templates = {}
+
+#returns the compiled template, templates are only loaded and parsed on first use
+def get_cached_template(name):
+    template = _templates.get(name)
+    if template is None:
+        template = _templates[name] = get_template(name)
+    return template
+
+
+#builds the organization invite email
+def invite_email(to_email, sender_name, sender_email, redirect_url):
+    message = get_cached_template('invite_email.html').render({
+        'sender_name': sender_name,
+        'sender_email': sender_email,
+        'domain': settings.DOMAIN,
+        'redirect_url': redirect_url
+    })
+    email = EmailMessage(subject='Method InSight Invite', body=message, to=[to_email], from_email='<no-reply@' + settings.DOMAIN)
+    email.content_subtype = "html"
+    return email
+
+
+class RateLimiter:
+    '''
+    Thread safe token bucket allowing `rate` acquisitions per second with bursts of up to `burst`.
+    Shared by every batch in the process so concurrent batches together stay within the quota.
+    '''
+
+    def __init__(self, rate, burst=EMAIL_RATE_BURST):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    #blocks until a message may be sent
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                wait = (1 - self._tokens) / self.rate
+            time.sleep(wait)
+
+
+class EmailDelivery:
+    '''
+    Sends batches of emails over a single connection of the configured EMAIL_BACKEND.
+
+    Messages are sent one at a time on the open connection so a rejected recipient only fails its own
+    message, the connection is reopened once if the server drops it part way through a batch.
+    '''
+
+    def __init__(self, rate_limiter=None):
+        self.rate_limiter = rate_limiter
+        self._metrics_lock = threading.Lock()
+        self.metrics = {'batches': 0, 'sent': 0, 'failed': 0}
+
+    def send(self, messages):
+        """
+        Sends a batch of emails
+
+        Parameters
+        ----------
+        messages : list
+            EmailMessage's to send
+        Returns
+        -------
+        a status for each message in the order given: {'to', 'status': 'sent' | 'failed', 'error'}
+        """
+        statuses = []
+        if not messages:
+            return statuses
+
+        connection = get_connection(fail_silently=False)
+        try:
+            connection.open()
+            for message in messages:
+                if self.rate_limiter is not None:
+                    self.rate_limiter.acquire()
+                try:
+                    self._send(connection, message)
+                    statuses.append({'to': message.to, 'status': 'sent', 'error': None})
+                except Exception as e:
+                    logger.warning('Unable to send email to %s: %s', message.to, e)
+                    statuses.append({'to': message.to, 'status': 'failed', 'error': str(e)})
+        except Exception as e:
+            #the connection couldnt be opened so nothing in the batch was sent
+            logger.warning('Unable to open email connection: %s', e)
+            statuses += [{'to': message.to, 'status': 'failed', 'error': str(e)} for message in messages[len(statuses):]]
+        finally:
+            connection.close()
+
+        sent = sum(1 for status in statuses if status['status'] == 'sent')
+        with self._metrics_lock:
+            self.metrics['batches'] += 1
+            self.metrics['sent'] += sent
+            self.metrics['failed'] += len(statuses) - sent
+        return statuses
+
+    def get_metrics(self):
+        with self._metrics_lock:
+            return dict(self.metrics)
+
+    @staticmethod
+    def _send(connection, message):
+        try:
+            connection.send_messages([message])
+        except smtplib.SMTPServerDisconnected:
+            connection.close()
+            connection.open()
+            connection.send_messages([message])
+
+
+_email_delivery = None
+_email_delivery_lock = threading.Lock()
+
+#returns the process wide email delivery created from settings on first use
+def get_email_delivery():
+    global _email_delivery
+    if _email_delivery is None:
+        with _email_delivery_lock:
+            if _email_delivery is None:
+                rate = getattr(settings, 'EMAIL_RATE_LIMIT', EMAIL_RATE_LIMIT)
+                rate_limiter = RateLimiter(rate, getattr(settings, 'EMAIL_RATE_BURST', EMAIL_RATE_BURST)) if rate else None
+                _email_delivery = EmailDelivery(rate_limiter)
+    return _email_delivery
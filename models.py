@@ -1,11 +1,16 @@
 from __future__ import unicode_literals
-from django.db import models
+from django.db import models, transaction
+from django.contrib.auth.hashers import make_password
+from django.utils import timezone
 from django.contrib.auth.models import PermissionsMixin
 from django.contrib.auth.base_user import AbstractBaseUser, BaseUserManager
 from django.core.exceptions import ValidationError
 from django.core.validators import validate_email
 from django.contrib.auth.password_validation import validate_password
-from django.contrib.auth.models import UserManager
+from django.contrib.auth.models import Group, UserManager
+from django.db.models.functions import Lower
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import Signal, receiver
 from rest_framework.authtoken.models import Token
 from api import services
 import datetime as dt
@@ -13,30 +18,249 @@ import uuid
 import os
 import uuid
 
+BULK_CREATE_BATCH_SIZE = 1000 #rows per INSERT and per IN (...) lookup in UserManager.bulk_create_users
+#User fields bulk_create_users never sets from a row, credentials and permissions are only set through create_user/create_superuser
+BULK_PROTECTED_FIELDS = ('id', 'password', 'last_login', 'is_staff', 'is_superuser', 'groups', 'user_permissions', 'version')
+
+#sent with the ids of users changed by UserManager.bulk_create_users which bypasses save signals (e.g to invalidate caches)
+users_bulk_updated = Signal()
+
+#splits values into lists of at most size items
+def _batches(values, size):
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+#returns a new random version stamp, stamps only need to change whenever the data changes
+def new_version():
+    return uuid.uuid4().hex
+
+class VersionedModel(models.Model):
+    '''
+    Gives a model a version stamp that changes on every save, used as the models ETag.
+    NOTE: queryset.update() does not change the stamp so it must be set explicitly (version=new_version())
+    '''
+    version = models.CharField(max_length=32, default=new_version, editable=False)
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        self.version = new_version()
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None:
+            kwargs['update_fields'] = set(update_fields) | {'version'}
+        super().save(*args, **kwargs)
+
 class UserManager(BaseUserManager):
     """Define a model manager for User model with no username field."""
 
     use_in_migrations = True
 
-    def _create_user(self, email, password, **extra_fields):
+    def _create_user(self, email, password, auth0_managed=False, **extra_fields):
         """Create and save a User with the given email and password."""
         if not email:
             raise ValueError('The given email must be set')
         email = self.normalize_email(email)
         user = self.model(email=email, **extra_fields)
-        validate_password(password)
-        user.set_password(password)
+        if auth0_managed:
+            #the users password is only held by auth0 so skip validating and hashing one locally (PBKDF2 is slow by design)
+            user.set_unusable_password()
+        else:
+            validate_password(password)
+            user.set_password(password)
         user.save(using=self._db)
-        #create django rest api token for user
-        Token.objects.create(user=user)
+        #create django rest api token for user, auth0 managed users authenticate with auth0 access tokens and only get one
+        # when it is issued with the create_api_token command (User.get_api_token)
+        if not auth0_managed:
+            Token.objects.create(user=user)
         return user
 
     def create_user(self, email, password=None, **extra_fields):
-        """Create and save a regular User with the given email and password."""
+        """
+        Create and save a regular User with the given email and password.
+
+        Pass auth0_managed=True for users that authenticate through Auth0, they get an unusable local password
+        and no password is needed.
+        """
         extra_fields.setdefault('is_staff', False)
         extra_fields.setdefault('is_superuser', False)
         return self._create_user(email, password, **extra_fields)
 
+    #users with any of the emails ignoring case, the rule existing users are matched by when creating users in bulk
+    def filter_emails(self, emails):
+        return self.annotate(email_lower=Lower('email')).filter(email_lower__in=[email.lower() for email in emails])
+
+    def bulk_create_users(self, rows, update_fields=(), create_tokens=False, batch_size=BULK_CREATE_BATCH_SIZE):
+        """
+        Creates many Auth0 managed users and their memberships in one transaction
+
+        Users, memberships, role permission group assignments and optionally api tokens are inserted with
+        batched bulk_create instead of a query per row. Rows that already exist are skipped rather than failing the
+        batch so reruns (e.g a nightly sync) are idempotent. Like create_user(auth0_managed=True) users get an
+        unusable local password. Save signals arent sent, versions are bumped here and users_bulk_updated is sent
+        with the ids of the existing users that were changed.
+
+        Parameters
+        ----------
+        rows : list
+            dicts with the users `email` and `auth0_id` (only needed for new users), any other User fields and
+            optionally `memberships`: a list of dicts with organization_id, role, is_external, is_key_contact and expires.
+            Rows with unknown fields or BULK_PROTECTED_FIELDS (e.g password) are conflicts
+        update_fields : list
+            User fields to update on users that already exist, existing users are left unchanged by default
+        create_tokens : bool
+            also create api tokens for users that dont have one (otherwise created on first use)
+        batch_size : int
+            rows per INSERT/lookup query
+        Returns
+        -------
+        a result for each row in the order given:
+        {'email', 'status': 'created' | 'existing' | 'conflict', 'user', 'memberships_created', 'errors'}
+        """
+        results = [{'email': None, 'status': 'created', 'user': None, 'memberships_created': 0, 'errors': []} for _ in rows]
+
+        def conflict(i, error):
+            results[i]['status'] = 'conflict'
+            results[i]['errors'].append(error)
+
+        row_fields = {field.name for field in self.model._meta.concrete_fields} - set(BULK_PROTECTED_FIELDS)
+        invalid = set(update_fields) - row_fields
+        if invalid:
+            raise ValueError('Fields cannot be updated: {}'.format(', '.join(sorted(invalid))))
+
+        #rows are matched to existing users by their email ignoring case, only the first row for an email/auth0 id is used
+        emails = {}
+        auth0_ids = {}
+        for i, row in enumerate(rows):
+            email = results[i]['email'] = self.normalize_email(row.get('email'))
+            invalid = set(row) - row_fields - {'memberships'}
+            if not email:
+                conflict(i, 'The given email must be set')
+            elif invalid:
+                conflict(i, 'Unknown or protected fields: {}'.format(', '.join(sorted(invalid))))
+            elif email.lower() in emails:
+                conflict(i, 'Duplicate email')
+            else:
+                emails[email.lower()] = i
+
+        with transaction.atomic(using=self._db):
+            existing = {}
+            for batch in _batches(list(emails), batch_size):
+                existing.update((user.email.lower(), user) for user in self.filter_emails(batch))
+
+            new_users = {}
+            updated = {}
+            for email, i in emails.items():
+                user = existing.get(email)
+                if user is not None:
+                    results[i]['status'] = 'existing'
+                    results[i]['user'] = user
+                    #only users whose values differ are written so an unchanged sync doesnt rewrite every row
+                    for field in update_fields:
+                        if field in rows[i] and getattr(user, field) != rows[i][field]:
+                            setattr(user, field, rows[i][field])
+                            updated[user.pk] = user
+                    continue
+
+                auth0_id = rows[i].get('auth0_id')
+                if not auth0_id:
+                    conflict(i, 'auth0_id must be set for new users')
+                elif auth0_id in auth0_ids:
+                    conflict(i, 'Duplicate auth0_id')
+                else:
+                    auth0_ids[auth0_id] = i
+                    fields = {key: value for key, value in rows[i].items() if key not in ('email', 'memberships')}
+                    new_users[i] = self.model(email=results[i]['email'], password=make_password(None), **fields)
+
+            #a new users auth0 account already belongs to a different user
+            for batch in _batches(list(auth0_ids), batch_size):
+                for auth0_id in self.filter(auth0_id__in=batch).values_list('auth0_id', flat=True):
+                    i = auth0_ids[auth0_id]
+                    del new_users[i]
+                    conflict(i, 'auth0_id belongs to another user')
+
+            self.bulk_create(new_users.values(), batch_size=batch_size)
+            for i, user in new_users.items():
+                results[i]['user'] = user
+
+            if updated:
+                self.bulk_update(updated.values(), list(update_fields), batch_size=batch_size)
+
+            organization_ids = self._bulk_create_memberships(rows, results, batch_size)
+
+            if create_tokens:
+                users = [result['user'] for result in results if result['user'] is not None]
+                #bulk_create skips Token.save() so the keys are generated here
+                Token.objects.bulk_create([Token(user=user, key=Token.generate_key()) for user in users],
+                    batch_size=batch_size, ignore_conflicts=True)
+
+            #bulk_create/bulk_update dont send save signals so update the versions used for etags and cached lists here
+            changed = set(updated) | {result['user'].pk for result in results if result['status'] == 'existing' and result['memberships_created']}
+            for batch in _batches(list(changed), batch_size):
+                self.filter(id__in=batch).update(version=new_version())
+            for batch in _batches(list(organization_ids), batch_size):
+                Organization.objects.filter(id__in=batch).update(members_version=new_version())
+            #like update_user_organization_versions an updated user changes the member lists of all of their organizations
+            for batch in _batches(list(updated), batch_size):
+                Organization.objects.filter(organizationmembership__user_id__in=batch).update(members_version=new_version())
+
+            if new_users or changed or organization_ids:
+                #imported here as api.pagination imports this module
+                from api.pagination import bump_count_version
+                transaction.on_commit(bump_count_version, using=self._db)
+            if changed:
+                transaction.on_commit(lambda: users_bulk_updated.send(sender=self.model, user_ids=changed), using=self._db)
+
+        return results
+
+    #inserts the memberships and role permission group assignments of bulk_create_users rows, returns the changed organization ids
+    def _bulk_create_memberships(self, rows, results, batch_size):
+        requested = {}
+        for i, row in enumerate(rows):
+            user = results[i]['user']
+            if user is None:
+                continue
+            for membership in row.get('memberships', ()):
+                role = membership.get('role')
+                if role not in dict(OrganizationMembership.role_choices):
+                    results[i]['errors'].append('Invalid role {}'.format(role))
+                    continue
+                requested.setdefault((user.pk, str(membership['organization_id']), role), (i, membership))
+
+        if not requested:
+            return set()
+
+        user_ids = {user_id for user_id, _, _ in requested}
+        organization_ids = {organization_id for _, organization_id, _ in requested}
+        found_organizations = set()
+        for batch in _batches(list(organization_ids), batch_size):
+            found_organizations.update(str(pk) for pk in Organization.objects.filter(id__in=batch).values_list('id', flat=True))
+        existing = set()
+        for batch in _batches(list(user_ids), batch_size):
+            existing.update((user_id, str(organization_id), role) for user_id, organization_id, role in
+                OrganizationMembership.objects.filter(user_id__in=batch, organization_id__in=organization_ids).values_list('user_id', 'organization_id', 'role'))
+
+        memberships = []
+        for key, (i, membership) in requested.items():
+            user_id, organization_id, role = key
+            if organization_id not in found_organizations:
+                results[i]['errors'].append('Organization {} does not exist'.format(organization_id))
+            elif key not in existing:
+                memberships.append(OrganizationMembership(
+                    user_id=user_id, organization_id=organization_id, role=role,
+                    is_external=membership.get('is_external', False), is_key_contact=membership.get('is_key_contact', False),
+                    expires=membership.get('expires')))
+                results[i]['memberships_created'] += 1
+        OrganizationMembership.objects.bulk_create(memberships, batch_size=batch_size)
+
+        #add users to the role permission groups, already assigned groups are ignored
+        groups = dict(Group.objects.filter(name__in={membership.role for membership in memberships}).values_list('name', 'id'))
+        UserGroups = self.model.groups.through
+        UserGroups.objects.bulk_create(
+            [UserGroups(user_id=membership.user_id, group_id=groups[membership.role]) for membership in memberships if membership.role in groups],
+            batch_size=batch_size, ignore_conflicts=True)
+        return {membership.organization_id for membership in memberships}
+
     def create_superuser(self, email, password, **extra_fields):
         """Create and save a SuperUser with the given email and password."""
         extra_fields.setdefault('is_active', True)
@@ -53,7 +277,7 @@ class UserManager(BaseUserManager):
 
         return self._create_user(email, password, **extra_fields)
 
-class User(AbstractBaseUser, PermissionsMixin):
+class User(VersionedModel, AbstractBaseUser, PermissionsMixin):
     id = models.CharField(default=uuid.uuid4, primary_key=True, unique=True, max_length=255)
     auth0_id = models.CharField(unique=True, max_length=255)
     email = models.EmailField(validators=[validate_email], unique=True)
@@ -72,12 +296,33 @@ class User(AbstractBaseUser, PermissionsMixin):
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
 
-class Organization(models.Model):
+    #returns the users django rest api token, creating it on first use
+    def get_api_token(self):
+        token, _ = Token.objects.get_or_create(user=self)
+        return token
+
+    class Meta:
+        indexes = [
+            #keyset pagination order (see api.pagination.KeysetPagination)
+            models.Index(fields=['date_joined', 'id']),
+            #existing users matched by email ignoring case (UserManager.filter_emails)
+            models.Index(Lower('email'), name='user_email_lower_idx'),
+        ]
+
+class Organization(VersionedModel):
     id = models.CharField(default=uuid.uuid4, primary_key=True, unique=True, max_length=255)
     name = models.CharField(max_length=50)
     date_created = models.DateField(default=dt.datetime.utcnow)
+    #aggregate version of the organizations members and memberships, changes when any of them change (used for list ETags)
+    members_version = models.CharField(max_length=32, default=new_version, editable=False)
 
-class OrganizationMembership(models.Model):
+    class Meta:
+        indexes = [
+            #keyset pagination order (see api.pagination.KeysetPagination)
+            models.Index(fields=['date_created', 'id']),
+        ]
+
+class OrganizationMembership(VersionedModel):
     role_choices = (
         ('system admin', 'system admin'),
         ('admin', 'admin'),
@@ -95,5 +340,57 @@ class OrganizationMembership(models.Model):
     #the date the membership expires
     expires = models.DateField(blank=True, null=True)
     date_created = models.DateField(default=dt.datetime.utcnow)
- 
 
+    class Meta:
+        indexes = [
+            #keyset pagination order (see api.pagination.KeysetPagination)
+            models.Index(fields=['date_created', 'id']),
+            #users memberships by user, (user, role) and (user, role, organization) e.g the access policy organization scope
+            models.Index(fields=['user', 'role', 'organization']),
+            #admins of an organization e.g sole admin checks
+            models.Index(fields=['organization', 'role']),
+            #users with a membership in a set of organizations (users access policy EXISTS subquery)
+            models.Index(fields=['user', 'organization']),
+        ]
+
+#a membership change changes its organizations member list and its users nested memberships
+@receiver(post_save, sender=OrganizationMembership)
+@receiver(post_delete, sender=OrganizationMembership)
+def update_membership_versions(sender, instance, **kwargs):
+    Organization.objects.filter(id=instance.organization_id).update(members_version=new_version())
+    User.objects.filter(id=instance.user_id).update(version=new_version())
+
+#a user change changes the member lists of all of the users organizations
+@receiver(post_save, sender=User)
+def update_user_organization_versions(sender, instance, **kwargs):
+    Organization.objects.filter(organizationmembership__user_id=instance.id).update(members_version=new_version())
+
+class OutboxMessage(models.Model):
+    '''
+    A side effect (Auth0 call, email) written in the same transaction as the change that caused it and
+    performed after commit by the outbox worker (see api.utilities.outbox)
+    '''
+    status_choices = (
+        ('pending', 'pending'),
+        ('done', 'done'),
+        ('failed', 'failed'),
+    )
+    id = models.CharField(default=uuid.uuid4, primary_key=True, unique=True, max_length=255)
+    #the handler that performs the side effect e.g auth0.delete_user
+    kind = models.CharField(max_length=64)
+    payload = models.JSONField(default=dict)
+    #enqueuing the same key twice only records the side effect once
+    idempotency_key = models.CharField(max_length=255, unique=True)
+    status = models.CharField(choices=status_choices, max_length=16, default='pending')
+    attempts = models.PositiveIntegerField(default=0)
+    #pending messages arent processed before this time (retry backoff)
+    available_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    date_created = models.DateTimeField(default=timezone.now)
+    date_processed = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        indexes = [
+            #the workers next batch of due messages
+            models.Index(fields=['status', 'available_at']),
+        ]
@@ -0,0 +1,315 @@
+import logging
+import random
+import string
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from itertools import groupby
+from django.conf import settings
+from django.db import DatabaseError, close_old_connections, transaction
+from django.utils import timezone
+from api.models import OutboxMessage, User
+from api.utilities.auth0 import get_management_client
+from api.utilities.mailer import get_email_delivery, invite_email
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_MODE = 'thread' #'thread' drains the outbox in this process, 'external' leaves it to the process_outbox command
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_POLL_INTERVAL = 5 #seconds between checks for due messages (retries) when nothing wakes the worker
+OUTBOX_MAX_ATTEMPTS = 8
+OUTBOX_BACKOFF_BASE = 2 #seconds, doubled after every failed attempt
+OUTBOX_BACKOFF_MAX = 3600
+OUTBOX_WORKERS = 4 #messages of the same kind handled concurrently within a batch
+OUTBOX_LEASE = 300 #seconds a claimed message is hidden from other workers while it is handled
+
+#auth0 id of a user whose auth0 account hasnt been created by the outbox worker yet
+PENDING_AUTH0_ID_PREFIX = 'pending|'
+
+'''
+Transactional outbox for side effects that call remote services (Auth0, SMTP).
+
+Instead of calling the remote service while a transaction holds row locks, services record the side effect with
+enqueue() in the same transaction as the change. The message is only visible once the transaction commits and is
+then performed by the OutboxWorker, so the request returns as soon as the commit completes and a rolled back
+change never leaves a side effect behind.
+
+Handlers are registered per message kind with @handler(kind) and must be safe to run more than once for the
+same message, delivery is at least once (a message is retried after a failure or a worker dying part way through).
+'''
+
+_handlers = {}
+
+#registers the handler for a kind of message, batch handlers get all due messages of the kind at once and return
+# {message id: exception} for the ones that failed, otherwise the handler is called once per message (concurrently)
+def handler(kind, batch=False):
+    def register(func):
+        _handlers[kind] = (func, batch)
+        return func
+    return register
+
+
+def enqueue(kind, payload, idempotency_key=None):
+    """
+    Records a side effect to be performed after the current transaction commits
+
+    Parameters
+    ----------
+    kind : str
+        The registered handler for the message
+    payload : dict
+        JSON serializable arguments for the handler
+    idempotency_key : str
+        Messages with a key that has already been enqueued are dropped, a random key is used if not given
+    Returns
+    -------
+    the OutboxMessage
+    """
+    if kind not in _handlers:
+        raise ValueError('No outbox handler registered for {}'.format(kind))
+
+    key = idempotency_key or '{}:{}'.format(kind, uuid.uuid4().hex)
+    message, _ = OutboxMessage.objects.get_or_create(idempotency_key=key, defaults={'kind': kind, 'payload': payload})
+    transaction.on_commit(get_outbox_worker().wake)
+    return message
+
+
+#records a message of the kind for each payload with a single insert, the batch version of enqueue()
+def enqueue_many(kind, payloads):
+    if kind not in _handlers:
+        raise ValueError('No outbox handler registered for {}'.format(kind))
+
+    messages = OutboxMessage.objects.bulk_create([
+        OutboxMessage(kind=kind, payload=payload, idempotency_key='{}:{}'.format(kind, uuid.uuid4().hex)) for payload in payloads])
+    transaction.on_commit(get_outbox_worker().wake)
+    return messages
+
+
+class OutboxWorker:
+    '''
+    Drains the outbox in batches of due messages.
+
+    Rows are leased with SELECT ... FOR UPDATE SKIP LOCKED so several workers (threads or processes) can run
+    at once without handling the same message. A failed message is retried with exponential backoff until
+    `max_attempts` is reached, after which it is marked failed and logged.
+
+    In thread mode start() runs the worker on a daemon thread that is woken whenever a transaction that
+    enqueued messages commits, run_forever() runs it in the foreground for a separate worker process.
+    '''
+
+    def __init__(self, batch_size=OUTBOX_BATCH_SIZE, poll_interval=OUTBOX_POLL_INTERVAL, max_attempts=OUTBOX_MAX_ATTEMPTS,
+                 backoff_base=OUTBOX_BACKOFF_BASE, backoff_max=OUTBOX_BACKOFF_MAX, max_workers=OUTBOX_WORKERS, lease=OUTBOX_LEASE, threaded=True):
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.lease = lease
+        self.threaded = threaded
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='outbox')
+        self.thread = None
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+
+    def wake(self):
+        """Signals the worker thread that new messages were committed, starting it on first use."""
+        if self.threaded:
+            self.start()
+            self._wake.set()
+
+    def start(self):
+        if self.thread is None:
+            with self._lock:
+                if self.thread is None:
+                    self._stop.clear()
+                    self.thread = threading.Thread(target=self.run_forever, name='outbox-worker', daemon=True)
+                    self.thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        self.thread = None
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            try:
+                self.drain()
+            except Exception:
+                logger.exception('Outbox worker failed to process a batch')
+            finally:
+                close_old_connections()
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+
+    #processes batches until there are no more due messages, returns the number of messages processed
+    def drain(self):
+        total = 0
+        while not self._stop.is_set():
+            processed = self.process_batch()
+            total += processed
+            if processed < self.batch_size:
+                break
+        return total
+
+    def process_batch(self):
+        """Claims and handles one batch of due messages, returns the number of messages processed."""
+        messages = self.claim()
+
+        errors = {}
+        for kind, group in groupby(messages, key=lambda m: m.kind):
+            errors.update(self._handle(kind, list(group)))
+
+        now = timezone.now()
+        for message in messages:
+            error = errors.get(message.id)
+            if error is None:
+                message.status = 'done'
+                message.date_processed = now
+                message.last_error = ''
+            elif message.attempts >= self.max_attempts:
+                message.status = 'failed'
+                message.last_error = str(error)
+                logger.error('Outbox message %s (%s) failed after %s attempts: %s', message.id, message.kind, message.attempts, error)
+            else:
+                message.available_at = now + self.backoff(message.attempts)
+                message.last_error = str(error)
+                logger.warning('Outbox message %s (%s) failed, retrying: %s', message.id, message.kind, error)
+
+        OutboxMessage.objects.bulk_update(messages, ['status', 'available_at', 'last_error', 'date_processed'])
+        return len(messages)
+
+    #leases the next batch of due messages to this worker, the transaction only lasts for the claim so no locks are held
+    # while handlers call remote services. Messages of a worker that dies are picked up again once their lease expires
+    def claim(self):
+        now = timezone.now()
+        with transaction.atomic():
+            messages = list(OutboxMessage.objects
+                .select_for_update(skip_locked=True)
+                .filter(status='pending', available_at__lte=now)
+                .order_by('kind', 'available_at')[:self.batch_size])
+            for message in messages:
+                message.attempts += 1
+                message.available_at = now + timedelta(seconds=self.lease)
+            OutboxMessage.objects.bulk_update(messages, ['attempts', 'available_at'])
+        return messages
+
+    #delay before the next attempt, jittered so messages that failed together dont all retry together
+    def backoff(self, attempts):
+        delay = min(self.backoff_base * 2 ** (attempts - 1), self.backoff_max)
+        return timedelta(seconds=delay * random.uniform(0.5, 1))
+
+    def _handle(self, kind, messages):
+        func, batch = _handlers.get(kind, (None, False))
+        if func is None:
+            return {message.id: ValueError('No outbox handler registered for {}'.format(kind)) for message in messages}
+
+        if batch:
+            try:
+                return func(messages)
+            except Exception as e:
+                return {message.id: e for message in messages}
+
+        futures = {message.id: self.executor.submit(self._run, func, message) for message in messages}
+        errors = {}
+        for message_id, future in futures.items():
+            try:
+                future.result()
+            except Exception as e:
+                errors[message_id] = e
+        return errors
+
+    @staticmethod
+    def _run(func, message):
+        try:
+            return func(message)
+        finally:
+            close_old_connections()
+
+
+_outbox_worker = None
+_outbox_worker_lock = threading.Lock()
+
+#returns the process wide outbox worker created from settings on first use
+def get_outbox_worker():
+    global _outbox_worker
+    if _outbox_worker is None:
+        with _outbox_worker_lock:
+            if _outbox_worker is None:
+                _outbox_worker = OutboxWorker(
+                    batch_size=getattr(settings, 'OUTBOX_BATCH_SIZE', OUTBOX_BATCH_SIZE),
+                    poll_interval=getattr(settings, 'OUTBOX_POLL_INTERVAL', OUTBOX_POLL_INTERVAL),
+                    max_attempts=getattr(settings, 'OUTBOX_MAX_ATTEMPTS', OUTBOX_MAX_ATTEMPTS),
+                    backoff_base=getattr(settings, 'OUTBOX_BACKOFF_BASE', OUTBOX_BACKOFF_BASE),
+                    backoff_max=getattr(settings, 'OUTBOX_BACKOFF_MAX', OUTBOX_BACKOFF_MAX),
+                    max_workers=getattr(settings, 'OUTBOX_WORKERS', OUTBOX_WORKERS),
+                    lease=getattr(settings, 'OUTBOX_LEASE', OUTBOX_LEASE),
+                    threaded=getattr(settings, 'OUTBOX_MODE', OUTBOX_MODE) == 'thread')
+    return _outbox_worker
+
+
+#---------- Handlers ------------------
+
+@handler('auth0.delete_user')
+def delete_auth0_user(message):
+    #auth0 responds with a 204 for users that no longer exist so retries are safe
+    get_management_client().delete_user(message.payload['auth0_id'])
+
+
+@handler('auth0.invite_user')
+def invite_auth0_user(message):
+    payload = message.payload
+    user = User.objects.filter(id=payload['user_id']).only('id', 'auth0_id').first()
+    #user was deleted before the invite was sent
+    if user is None:
+        return
+
+    ath = get_management_client()
+    if user.auth0_id.startswith(PENDING_AUTH0_ID_PREFIX):
+        #a previous attempt may have created the account before failing, accounts are tagged with the user they were
+        # created for so an account of someone else with the email (or of a deleted user) is never adopted
+        tag = {'user_id': str(user.id)}
+        auth0_id = ath.get_user_id_by_email(payload['email'], app_metadata=tag)
+        if auth0_id is None:
+            password = ''.join(random.choices(string.ascii_letters + string.digits + string.punctuation, k=9))
+            auth0_id = ath.create_user(payload['email'], payload['name'], password, app_metadata=tag)
+        user.auth0_id = auth0_id
+        try:
+            with transaction.atomic():
+                user.save(update_fields=['auth0_id'])
+        except DatabaseError:
+            if User.objects.filter(id=user.id).exists():
+                raise
+            #the user was deleted while their account was being created, a retry would find no user so remove the account now
+            with transaction.atomic():
+                enqueue('auth0.delete_user', {'auth0_id': auth0_id}, idempotency_key='auth0.delete_user:' + auth0_id)
+            return
+
+    redirect_url = ath.get_passsword_reset_url_by_id(user.auth0_id, invite_url=True)
+    with transaction.atomic():
+        enqueue('email.invite', {
+            'to_email': payload['email'],
+            'sender_name': payload['sender_name'],
+            'sender_email': payload['sender_email'],
+            'redirect_url': redirect_url,
+        }, idempotency_key='email.invite:{}'.format(message.idempotency_key))
+
+
+@handler('email.invite', batch=True)
+def send_invite_emails(messages):
+    errors = {}
+    emails = []
+    for message in messages:
+        payload = message.payload
+        try:
+            emails.append((message, invite_email(payload['to_email'], payload['sender_name'], payload['sender_email'], payload['redirect_url'])))
+        except Exception as e:
+            errors[message.id] = e
+
+    #the whole batch is sent over one smtp connection
+    statuses = get_email_delivery().send([email for _, email in emails])
+    for (message, _), status in zip(emails, statuses):
+        if status['status'] != 'sent':
+            errors[message.id] = Exception(status['error'])
+    return errors
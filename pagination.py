@@ -1,12 +1,258 @@
-from rest_framework.pagination import LimitOffsetPagination
+import base64
+import datetime as dt
+import hashlib
+import json
+import time
+from django.conf import settings
+from django.core.cache import DEFAULT_CACHE_ALIAS, cache, caches
+from django.core.cache.backends.dummy import DummyCache
+from django.core.cache.backends.locmem import LocMemCache
+from django.db import connections, transaction
+from django.db.models import Q
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import BasePagination, LimitOffsetPagination
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
+from api.models import Organization, OrganizationMembership, User
+
+COUNT_STRATEGY = 'exact'
+COUNT_CACHE_TIMEOUT = 60
+COUNT_ESTIMATE_THRESHOLD = 10000 #below this the planners estimate is replaced with an exact count
+COUNT_VERSION_KEY = 'pagination:count_version'
+
+#invalidates every cached count, called whenever memberships, users or organizations change
+def bump_count_version():
+    try:
+        cache.incr(COUNT_VERSION_KEY)
+    except ValueError:
+        #started from the time rather than 1 so a version that was evicted from the cache isnt handed out again
+        cache.set(COUNT_VERSION_KEY, time.time_ns(), None)
+
+#returns the current version of every organization, membership and user (changes with any of them)
+def get_count_version():
+    version = cache.get(COUNT_VERSION_KEY)
+    if version is None:
+        cache.add(COUNT_VERSION_KEY, time.time_ns(), None)
+        version = cache.get(COUNT_VERSION_KEY)
+    return version
+
+#whether every worker sees the same count version, a per process cache (locmem) only sees the bumps of its own process
+def count_version_is_shared():
+    return not isinstance(caches[DEFAULT_CACHE_ALIAS], (LocMemCache, DummyCache))
+
+@receiver(post_save, sender=OrganizationMembership)
+@receiver(post_delete, sender=OrganizationMembership)
+@receiver(post_save, sender=Organization)
+@receiver(post_delete, sender=Organization)
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_counts(sender, **kwargs):
+    #after the commit so a version is never paired with data from before the change (list etags of system admins)
+    transaction.on_commit(bump_count_version)
+
 
 class CustomLimitOffsetPagination(LimitOffsetPagination):
+    '''
+    Limit/offset pagination where the `total_results` count strategy can be chosen per viewset
+    with a `count_strategy` attribute (defaults to settings.PAGINATION_COUNT_STRATEGY):
+
+    - exact: COUNT(*) over the scoped queryset
+    - cached: exact count cached for a short time keyed by the querysets SQL, which includes the principals
+      organization scope and the filter params. Cached counts are dropped when memberships, users or organizations change
+    - estimate: the database query planners row estimate (PostgreSQL only), exact when the estimate is small
+
+    The strategy used is returned in the `total_results_type` response field.
+    '''
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count_strategy = getattr(view, 'count_strategy', None) or getattr(settings, 'PAGINATION_COUNT_STRATEGY', COUNT_STRATEGY)
+        #pages are sliced in the database (LIMIT/OFFSET) so give unordered querysets a stable order
+        if hasattr(queryset, 'ordered') and not queryset.ordered:
+            queryset = queryset.order_by('pk')
+
+        self.request = request
+        self.limit = self.get_limit(request)
+        if self.limit is None:
+            return None
+        self.offset = self.get_offset(request)
+        self.count = self.get_count(queryset)
+        if self.count > self.limit and self.template is not None:
+            self.display_page_controls = True
+        #a cached or estimated count can be off so it is only reported in total_results, the page and whether there
+        # is a next page come from the rows themselves (one extra row is fetched)
+        if self.count_type == 'exact' and self.offset >= self.count:
+            self.has_next = False
+            return []
+        rows = list(queryset[self.offset:self.offset + self.limit + 1])
+        self.has_next = len(rows) > self.limit
+        return rows[:self.limit]
+
+    def get_next_link(self):
+        if not self.has_next:
+            return None
+        url = self.request.build_absolute_uri()
+        url = replace_query_param(url, self.limit_query_param, self.limit)
+        return replace_query_param(url, self.offset_query_param, self.offset + self.limit)
+
+    def get_count(self, queryset):
+        if self.count_strategy == 'cached':
+            count = self.get_cached_count(queryset)
+            if count is not None:
+                self.count_type = 'cached'
+                return count
+
+        if self.count_strategy == 'estimate':
+            count = self.get_estimated_count(queryset)
+            threshold = getattr(settings, 'PAGINATION_COUNT_ESTIMATE_THRESHOLD', COUNT_ESTIMATE_THRESHOLD)
+            if count is not None and count >= threshold:
+                self.count_type = 'estimate'
+                return count
+
+        self.count_type = 'exact'
+        return super().get_count(queryset)
+
+    #returns the cached count for the queryset counting and caching it on a miss, None if the queryset cant be cached
+    def get_cached_count(self, queryset):
+        try:
+            sql, params = queryset.query.sql_with_params()
+        except Exception:
+            return None
+
+        fingerprint = hashlib.sha256(repr((queryset.db, sql, params)).encode()).hexdigest()
+        key = 'pagination:count:{}:{}'.format(get_count_version(), fingerprint)
+        count = cache.get(key)
+        if count is None:
+            count = super().get_count(queryset)
+            cache.set(key, count, getattr(settings, 'PAGINATION_COUNT_CACHE_TIMEOUT', COUNT_CACHE_TIMEOUT))
+        return count
+
+    #returns the query planners row estimate for the queryset, None if the database doesnt support it
+    def get_estimated_count(self, queryset):
+        connection = connections[queryset.db]
+        if connection.vendor != 'postgresql':
+            return None
+
+        try:
+            sql, params = queryset.query.sql_with_params()
+            with connection.cursor() as cursor:
+                cursor.execute('EXPLAIN (FORMAT JSON) ' + sql, params)
+                plan = cursor.fetchone()[0]
+        except Exception:
+            return None
+
+        if isinstance(plan, str):
+            plan = json.loads(plan)
+        return int(plan[0]['Plan']['Plan Rows'])
+
     def get_paginated_response(self, data):
         return Response({
             'next': self.get_next_link(),
             'previous': self.get_previous_link(),
             'total_results': self.count,
+            'total_results_type': self.count_type,
+            'returned_results': len(data),
+            'data': data
+        }, status=200, content_type='application/json')
+
+
+class KeysetPagination(BasePagination):
+    '''
+    Opt-in cursor pagination on a stable set of ordered keys, set `pagination_class = KeysetPagination` on a viewset to use it.
+
+    Each page is fetched with a `WHERE (keys) > (last row keys) ORDER BY keys LIMIT n` query so deep pages cost the same
+    as the first page and no COUNT(*) is run. The keys default to ('date_created', 'id') and can be changed with a
+    `keyset_ordering` attribute on the viewset, the last key must be unique and all keys are ascending.
+    Responses use the same envelope as CustomLimitOffsetPagination without `total_results`.
+    '''
+    page_size = api_settings.PAGE_SIZE
+    max_page_size = 1000
+    ordering = ('date_created', 'id')
+    cursor_query_param = 'cursor'
+    limit_query_param = 'limit'
+    invalid_cursor_message = 'Invalid cursor'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.keys = tuple(getattr(view, 'keyset_ordering', self.ordering))
+        self.limit = self.get_limit(request)
+        position, reverse = self.decode_cursor(request)
+
+        order = ['-' + key for key in self.keys] if reverse else list(self.keys)
+        queryset = queryset.order_by(*order)
+        if position is not None:
+            queryset = queryset.filter(self.keyset_filter(position, reverse))
+
+        #fetch one extra row to know if there is another page in this direction
+        rows = list(queryset[:self.limit + 1])
+        has_more = len(rows) > self.limit
+        rows = rows[:self.limit]
+        if reverse:
+            rows.reverse()
+
+        self.next_position = self.position(rows[-1]) if rows and (has_more if not reverse else True) else None
+        self.previous_position = self.position(rows[0]) if rows and (has_more if reverse else position is not None) else None
+        return rows
+
+    def get_paginated_response(self, data):
+        return Response({
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
             'returned_results': len(data),
             'data': data
         }, status=200, content_type='application/json')
+
+    def get_limit(self, request):
+        try:
+            limit = int(request.query_params[self.limit_query_param])
+        except (KeyError, ValueError):
+            return self.page_size
+        return min(max(limit, 1), self.max_page_size)
+
+    #builds (k1 > v1) OR (k1 = v1 AND k2 > v2) ... for the position (< when paging backwards)
+    def keyset_filter(self, position, reverse):
+        lookup = 'lt' if reverse else 'gt'
+        condition = Q()
+        for i, key in enumerate(self.keys):
+            equal = {k: v for k, v in zip(self.keys[:i], position[:i])}
+            condition |= Q(**equal, **{'{}__{}'.format(key, lookup): position[i]})
+        return condition
+
+    def position(self, row):
+        values = []
+        for key in self.keys:
+            #rows are model instances or dicts when the page was fetched with .values()
+            value = row[key] if isinstance(row, dict) else getattr(row, key)
+            values.append(value.isoformat() if isinstance(value, (dt.date, dt.datetime)) else value)
+        return values
+
+    def decode_cursor(self, request):
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None, False
+        try:
+            cursor = json.loads(base64.urlsafe_b64decode(encoded.encode()).decode())
+            position, reverse = cursor['p'], bool(cursor['r'])
+        except (TypeError, ValueError, KeyError):
+            raise NotFound(self.invalid_cursor_message)
+        if not isinstance(position, list) or len(position) != len(self.keys):
+            raise NotFound(self.invalid_cursor_message)
+        return position, reverse
+
+    def encode_cursor(self, position, reverse):
+        cursor = json.dumps({'p': position, 'r': int(reverse)}, separators=(',', ':'))
+        encoded = base64.urlsafe_b64encode(cursor.encode()).decode()
+        url = self.request.build_absolute_uri()
+        return replace_query_param(url, self.cursor_query_param, encoded)
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return self.encode_cursor(self.next_position, False)
+
+    def get_previous_link(self):
+        if self.previous_position is None:
+            return None
+        return self.encode_cursor(self.previous_position, True)
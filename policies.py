@@ -1,4 +1,5 @@
 from api.models import *
+from django.db.models import Exists, OuterRef, Prefetch
 from rest_access_policy import AccessPolicy
 from api.utilities import utilities
 
@@ -20,53 +21,170 @@ Available permissions groups:
 
 '''
 
+class PrincipalContext:
+    '''
+    Request scoped snapshot of the requesting users memberships, roles, groups and system admin flag.
+
+    Loaded once per request (memberships in a single query, groups on first use) and shared by every
+    access policy and service call made while handling the request. Use PrincipalContext.for_request().
+    '''
+
+    def __init__(self, user):
+        self.user = user
+        #(membership id, role, organization id) of each of the users memberships
+        self.memberships = list(OrganizationMembership.objects.filter(user_id=user.id).values_list('id', 'role', 'organization_id'))
+        self.roles = {role for _, role, _ in self.memberships}
+        self.is_system_admin = "Admin" in self.roles
+        self.organization_scopes = {}
+        self._groups = None
+
+    @property
+    def groups(self):
+        if self._groups is None:
+            self._groups = set(self.user.groups.values_list('name', flat=True))
+        return self._groups
+
+    #returns the context for the request creating it on first use
+    @classmethod
+    def for_request(cls, request):
+        #store on the underlying django request so every drf request wrapping it shares the same context
+        http_request = getattr(request, '_request', request)
+        context = getattr(http_request, '_principal_context', None)
+        if context is None or context.user.id != request.user.id:
+            context = cls.for_user(request.user)
+            http_request._principal_context = context
+        return context
+
+    #returns the context for the user creating it on first use, authentication gives every request its own user instance
+    # so drf-access-policy (which is only handed the user) shares the requests context
+    @classmethod
+    def for_user(cls, user):
+        context = getattr(user, '_principal_context', None)
+        if context is None:
+            context = user._principal_context = cls(user)
+        return context
+
+
 #NOTE: 'Admin' and 'user' groups must be created in Django.contrib.auth.Group model and assigned to users to allow this to work
 class BaseAccessPolicy:
+    #key in the statement index for actions that are only covered by '*' statements
+    ANY_ACTION = '*'
 
-    def get_permissioned_organizations(self, request, role_scoped, action=None, organization_id=None):
-        #if permissions are role scoped get users permissed organizations for the action, otherswise get permissed orgs for all actions
-        if role_scoped:
-            permissed_orgs = self.permissioned_organizations_by_role(request, action)
+    #compiles each access policies statements once when the policy class is defined
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        cls.compile_statements()
+
+    @classmethod
+    def compile_statements(cls):
+        """
+        Builds the statement index used to scope organizations by role
+
+        For every action named in the statements (plus ANY_ACTION for actions only matched by '*' and None for
+        all statements) stores whether an allow statement has a '*' principal, the principals of its allow
+        statements and which membership roles those principals allow. Roles are matched to principals the same
+        way as before: a role is allowed if it is a substring of any principal.
+        """
+        statements = getattr(cls, 'statements', None) or []
+        actions = {a for s in statements for a in s['action'] if a != '*'}
+        cls._statement_index = {}
+        cls._role_index = {}
+        for key in [None, cls.ANY_ACTION] + sorted(actions):
+            if key is None:
+                matched = statements
+            else:
+                matched = [s for s in statements if key in s['action'] or '*' in s['action']]
+            allowed = [s for s in matched if s['effect'] == 'allow']
+            any_principal = any('*' in s['principal'] for s in allowed)
+            principals = tuple(p for s in allowed for p in s['principal'])
+            cls._statement_index[key] = (any_principal, principals)
+            #pre-evaluate the known membership roles, any other role is evaluated on first use
+            cls._role_index[key] = {
+                role: cls._role_in_principals(role, any_principal, principals)
+                for role, _ in OrganizationMembership.role_choices
+            }
+
+    #group names matched against 'group:' principals, read from the principal context so they are only queried once per request
+    def get_user_group_values(self, user):
+        if user.is_anonymous:
+            return []
+        return list(PrincipalContext.for_user(user).groups)
+
+    @staticmethod
+    def _role_in_principals(role, any_principal, principals):
+        return any_principal or any(role in principal for principal in principals)
+
+    #returns the subset of roles that are allowed the action by the policies statements
+    @classmethod
+    def allowed_roles(cls, action, roles):
+        if not action:
+            key = None
         else:
-            permissed_orgs = OrganizationMembership.objects.filter(user__id=request.user.id).values_list('organization__id', flat=True)
+            key = action if action in cls._statement_index else cls.ANY_ACTION
+        role_index = cls._role_index[key]
+        allowed = set()
+        for role in roles:
+            role_allowed = role_index.get(role)
+            if role_allowed is None:
+                role_allowed = role_index[role] = cls._role_in_principals(role, *cls._statement_index[key])
+            if role_allowed:
+                allowed.add(role)
+        return allowed
+
+    #returns the ids of the organizations the user has permission for as a lazy subquery, None if the user is unrestricted (system admin)
+    def get_permissioned_organizations(self, request, role_scoped, action=None, organization_id=None):
+        return self.get_organization_scope(request, role_scoped, action, organization_id)
+
+    def get_organization_scope(self, request, role_scoped, action=None, organization_id=None):
+        """
+        Gets the organizations the user has permission for as a lazy subquery
+
+        Parameters
+        ----------
+        role_scoped : bool
+            only include organizations where the users role is allowed the action by the policy statements
+        action : str
+            the viewset action being scoped, all actions if not specified
+        organization_id : str
+            comma seperated organization ids to limit the scope to
+        Returns
+        -------
+        a values list queryset of organization ids to filter with `__in`, None if the user is unrestricted (system admin)
+        """
+        context = PrincipalContext.for_request(request)
+        #scope_queryset and permissed_orgs ask for the same scope within a request so reuse it
+        key = (type(self), role_scoped, action, organization_id)
+        if key not in context.organization_scopes:
+            context.organization_scopes[key] = self._get_organization_scope(context, role_scoped, action, organization_id)
+        return context.organization_scopes[key]
 
-        #if user is a system admin give them permission for all organization resources
-        if OrganizationMembership.objects.filter(user_id=request.user.id, role="Admin"):
-            permissed_orgs = Organization.objects.values_list('id', flat=True)
+    def _get_organization_scope(self, context, role_scoped, action=None, organization_id=None):
+        #incase it a comma seperated with more than one value
+        organization_ids = str(organization_id).split(',') if organization_id else None
+
+        #if user is a system admin give them permission for all organization resources without filtering
+        if context.is_system_admin:
+            if organization_ids is None:
+                return None
+            return Organization.objects.filter(id__in=organization_ids).values_list('id', flat=True)
+
+        memberships = OrganizationMembership.objects.filter(user_id=context.user.id)
+        #if permissions are role scoped only include organizations where the users role is allowed the action
+        if role_scoped:
+            memberships = memberships.filter(role__in=self.allowed_roles(action, context.roles))
 
         #if permissed queryset is only being sought for a set of organizations (list )
         #only return resources for that set of organizations from users permissed organizations
-        if organization_id:
-            #incase it a comma seperated with more than one value
-            organization_ids = str(organization_id).split(',')
-            permissed_orgs = [p for p in permissed_orgs if p in organization_ids]
-        
-        return list(permissed_orgs)
-    
-    def permissioned_organizations_by_role(self, request, action):
-        permissioned_orgs = []
-        #get permissed orgs for all actions if action is not specified otherwise filter only statements with the requested action
-        statements = self.statements if not action else [s for s in self.statements if action in s['action'] or '*' in s['action']]
-        #all of users org membership roles
-        memberships = OrganizationMembership.objects.filter(user__id=request.user.id).values('role', 'organization__id')
-        #iterate each of users role and check if the role is included in any of the policy statements
-        for membership in memberships:
-            role = membership['role']
-            org_id = membership['organization__id']
-            for statement in statements:
-                #check if the role is in any of the statement principals
-                role_in_policy = True if '*' in statement['principal'] else any(role in principal for principal in statement['principal'])
-                #check if the roles is in an allowed policy add the roles organization to permissable organizations for the action
-                if role_in_policy and statement['effect'] == "allow":
-                    permissioned_orgs.append(org_id)
-
-        return permissioned_orgs
+        if organization_ids is not None:
+            memberships = memberships.filter(organization_id__in=organization_ids)
+
+        return memberships.values_list('organization_id', flat=True)
 
 #--------------- Organizations --------------------
 
 
 #all role based policies for organizations
-class OrganizationsAccessPolicy(AccessPolicy, BaseAccessPolicy):
+class OrganizationsAccessPolicy(BaseAccessPolicy, AccessPolicy):
     statements = [
         {
             "action": ["*"],
@@ -77,14 +195,16 @@ class OrganizationsAccessPolicy(AccessPolicy, BaseAccessPolicy):
     #A scoped querset returns the resources (organizations in this case) that a user has access to 
     #based on the organizations they have access to the resources determined by their memberships and endpoints group permissionss 
     def scope_queryset(self, request, role_scoped, action=None, organization_id=None):
-        permissed_orgs = self.get_permissioned_organizations(request, role_scoped, action, organization_id)
-        organizations = Organization.objects.filter(id__in=permissed_orgs)
+        scope = self.get_organization_scope(request, role_scoped, action, organization_id)
+        organizations = Organization.objects.all()
+        if scope is not None:
+            organizations = organizations.filter(id__in=scope)
         return organizations
 
 # -------------- Users ---------------------
 
 #all role based policies for Users
-class UsersAccessPolicy(AccessPolicy, BaseAccessPolicy):
+class UsersAccessPolicy(BaseAccessPolicy, AccessPolicy):
     statements = [
         {
             "action": ["*"],
@@ -94,15 +214,25 @@ class UsersAccessPolicy(AccessPolicy, BaseAccessPolicy):
 
     ]
     def scope_queryset(self, request, role_scoped, action=None, organization_id=None):
-        permissed_orgs = self.get_permissioned_organizations(request, role_scoped, action, organization_id)
-        user_ids = set(OrganizationMembership.objects.filter(organization__id__in=permissed_orgs).values_list('user__id', flat=True))
-        users = User.objects.filter(id__in=user_ids)
+        scope = self.get_organization_scope(request, role_scoped, action, organization_id)
+        users = User.objects.all()
+        if scope is not None:
+            #users with a membership in any of the permissed organizations
+            users = users.filter(Exists(OrganizationMembership.objects.filter(user_id=OuterRef('pk'), organization_id__in=scope)))
         return users
+
+    #batch loads each users memberships (as user.memberships) limited to the requesters permissed organizations
+    def memberships_prefetch(self, request, action=None, organization_id=None):
+        scope = self.get_organization_scope(request, True, action, organization_id)
+        memberships = OrganizationMembership.objects.all()
+        if scope is not None:
+            memberships = memberships.filter(organization_id__in=scope)
+        return Prefetch('organizationmembership_set', queryset=memberships, to_attr='memberships')
  
 #--------------- Memberships -----------------------
 
 #all role based policies for Organization users
-class OrganizationMembershipsAccessPolicy(AccessPolicy, BaseAccessPolicy):
+class OrganizationMembershipsAccessPolicy(BaseAccessPolicy, AccessPolicy):
     statements = [
         {
             "action": ["*"],
@@ -117,12 +247,14 @@ class OrganizationMembershipsAccessPolicy(AccessPolicy, BaseAccessPolicy):
 
     ]
     def scope_queryset(self, request, role_scoped, action=None, organization_id=None):
-        permissed_orgs = self.get_permissioned_organizations(request, role_scoped, action, organization_id)    
-        organization_members = OrganizationMembership.filter(organization__id=permissed_orgs)
+        scope = self.get_organization_scope(request, role_scoped, action, organization_id)
+        organization_members = OrganizationMembership.objects.all()
+        if scope is not None:
+            organization_members = organization_members.filter(organization_id__in=scope)
         return organization_members
 
  #all authentication endpoint access 
-class AuthAccessPolicy(AccessPolicy, BaseAccessPolicy):
+class AuthAccessPolicy(BaseAccessPolicy, AccessPolicy):
     statements = [
         {
             "action": ["create"],
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+from api.utilities.outbox import get_outbox_worker
+
+'''
+Runs the outbox worker in the foreground, used when OUTBOX_MODE = 'external' so side effects are performed
+by dedicated worker processes instead of a thread in every web process.
+'''
+
+class Command(BaseCommand):
+    help = 'Performs the Auth0/email side effects recorded in the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help='process all due messages and exit')
+
+    def handle(self, *args, **options):
+        worker = get_outbox_worker()
+        if options['once']:
+            processed = worker.drain()
+            self.stdout.write('Processed {} outbox messages'.format(processed))
+            return
+
+        worker.run_forever()
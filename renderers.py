@@ -0,0 +1,59 @@
+from django.conf import settings
+from rest_framework.exceptions import ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.utils.encoders import JSONEncoder
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+'''
+JSON renderer and parser backed by orjson when it is installed.
+
+Both are drop in replacements for DRF's JSONRenderer/JSONParser and fall back to them (stdlib json)
+when orjson is missing or for options orjson cant reproduce (indented output, ascii only output, non utf-8 request bodies).
+'''
+
+#encodes the types orjson doesnt handle natively the same way DRF does (Decimal, lazy strings, querysets, timedelta...)
+_drf_encoder = JSONEncoder()
+
+def _default(obj):
+    return _drf_encoder.default(obj)
+
+
+class FastJSONRenderer(JSONRenderer):
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if orjson is None or not self.compact or self.ensure_ascii:
+            return super().render(data, accepted_media_type, renderer_context)
+
+        if data is None:
+            return b''
+
+        renderer_context = renderer_context or {}
+        if self.get_indent(accepted_media_type, renderer_context):
+            return super().render(data, accepted_media_type, renderer_context)
+
+        #datetimes are passed to DRF's encoder so they keep DRF's formatting (e.g the 'Z' suffix for UTC)
+        ret = orjson.dumps(data, default=_default, option=orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS)
+        #escape U+2028 and U+2029 like DRF so the output is a parseable subset of javascript
+        if b'\xe2\x80' in ret:
+            ret = ret.replace(b'\xe2\x80\xa8', b'\\u2028').replace(b'\xe2\x80\xa9', b'\\u2029')
+        return ret
+
+
+class FastJSONParser(JSONParser):
+    renderer_class = FastJSONRenderer
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        parser_context = parser_context or {}
+        encoding = parser_context.get('encoding', settings.DEFAULT_CHARSET)
+        if orjson is None or encoding.lower().replace('-', '') != 'utf8':
+            return super().parse(stream, media_type, parser_context)
+
+        try:
+            return orjson.loads(stream.read())
+        except ValueError as exc:
+            raise ParseError('JSON parse error - %s' % str(exc))
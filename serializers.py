@@ -1,8 +1,115 @@
 from itsdangerous import Serializer
 from rest_framework import serializers
 from api.models import *
+from django.core.exceptions import FieldDoesNotExist
+from rest_framework.exceptions import ValidationError
 from django.core.validators import validate_comma_separated_integer_list
 
+BULK_INVITE_MAX_INVITEES = 500
+
+#--------------- Sparse fieldsets ----------------------
+
+class SparseFieldsMixin:
+    '''
+    Lets clients request a subset of a serializers Meta.fields with a `?fields=id,email` query parameter.
+
+    Pass the requested fields to the serializer as `fields=` to drop every other field from its output.
+    '''
+    fields_query_param = 'fields'
+
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+
+    #returns the validated fields requested in the query params or None if all fields were requested
+    @classmethod
+    def requested_fields(cls, request):
+        value = request.query_params.get(cls.fields_query_param)
+        if not value:
+            return None
+
+        fields = list(dict.fromkeys(f.strip() for f in value.split(',') if f.strip()))
+        invalid = [f for f in fields if f not in cls.Meta.fields]
+        if invalid:
+            raise ValidationError({cls.fields_query_param: ['Invalid fields: {}'.format(', '.join(invalid))]})
+        if not fields:
+            raise ValidationError({cls.fields_query_param: ['At least one field must be requested']})
+        return fields
+
+    #returns the model columns backing the fields to load with .only(), the pk is always loaded
+    @classmethod
+    def only_fields(cls, fields):
+        return [column for name, _, column in cls._values_fields() if name in fields and column]
+
+
+#--------------- Fast list serialization ----------------------
+
+class ValuesSerializerMixin:
+    '''
+    Read-only fast path for list endpoints that renders rows fetched with `.values()` instead of model instances.
+
+    Each declared field's own to_representation is applied to the raw column value so the output is identical
+    to serializing model instances. It can only be used when every rendered field maps to a concrete column,
+    values_sources() returns None otherwise (e.g for nested serializers) so callers fall back.
+    '''
+
+    #returns the model columns to fetch with .values() or None if the fields need model instances
+    @classmethod
+    def values_sources(cls, fields=None):
+        sources = [column for name, _, column in cls._values_fields() if fields is None or name in fields]
+        return None if None in sources else sources
+
+    #returns the names of the fields that can be rendered from .values() rows
+    @classmethod
+    def column_fields(cls):
+        return [name for name, _, column in cls._values_fields() if column]
+
+    #renders rows fetched with .values(*values_sources()) the same way as serializing the model instances
+    @classmethod
+    def from_values(cls, rows, fields=None):
+        return list(cls.iter_values(rows, fields))
+
+    #lazily renders rows one at a time, used to stream large results
+    @classmethod
+    def iter_values(cls, rows, fields=None):
+        selected = [(name, field, column) for name, field, column in cls._values_fields() if fields is None or name in fields]
+        for row in rows:
+            item = {}
+            for name, field, column in selected:
+                value = row[column]
+                item[name] = None if value is None else field.to_representation(value)
+            yield item
+
+    #(name, field, column) for each readable field, column is None for fields that cant be read from a single column
+    @classmethod
+    def _values_fields(cls):
+        #built once per serializer class
+        if '_values_fields_cache' not in cls.__dict__:
+            cls._values_fields_cache = [(field.field_name, field, cls._column(field)) for field in cls()._readable_fields]
+        return cls._values_fields_cache
+
+    @classmethod
+    def _column(cls, field):
+        if isinstance(field, (serializers.BaseSerializer, serializers.ListField, serializers.SerializerMethodField,
+                              serializers.RelatedField, serializers.ManyRelatedField)):
+            return None
+        if len(field.source_attrs) != 1:
+            return None
+
+        source = field.source_attrs[0]
+        try:
+            model_field = cls.Meta.model._meta.get_field(source)
+        except FieldDoesNotExist:
+            return None
+        #relations can only be read as their id column (e.g organization_id)
+        if not model_field.concrete or model_field.many_to_many or (model_field.is_relation and source != model_field.attname):
+            return None
+        return source
+
+
 #--------------- AuthSerializer ----------------------
 
 class AuthSerializer(serializers.Serializer):
@@ -13,7 +120,7 @@ class AuthSerializer(serializers.Serializer):
 #---------- Organizations ------------------
 
 #serializer for returned data when retrieving or creating a single Organizations
-class OrganizationSerializer(serializers.ModelSerializer):
+class OrganizationSerializer(SparseFieldsMixin, ValuesSerializerMixin, serializers.ModelSerializer):
 
     class Meta:
         model = Organization
@@ -35,26 +142,10 @@ class OrganizationUpdateSerializer(serializers.Serializer):
         instance = service.update(organization_id, validated_data)
         return instance
 
-   
-#serializer for returned data when retrieving or creating a single user
-class UserSerializer(serializers.ModelSerializer):
-    memberships = serializers.ListField(child=OrganizationMembershipSerializer())
-
-    class Meta:
-        model = User
-        fields = ('id', 'first_name', 'last_name', 'timezone', 'email', 'is_active', 'date_joined')
-        read_only_fields = ('id', 'is_active', 'date_joined')
-    
-
-    def update(self, user_id, validated_data):
-        service = self.context['service']
-        instance = service.update(user_id, validated_data)
-        return instance
- 
 
 #---------------  OrganizationMember ------------ 
 
-class OrganizationMembershipSerializer(serializers.ModelSerializer):
+class OrganizationMembershipSerializer(SparseFieldsMixin, ValuesSerializerMixin, serializers.ModelSerializer):
 
     class Meta:
         model = OrganizationMembership
@@ -66,7 +157,40 @@ class OrganizationMembershipSerializer(serializers.ModelSerializer):
         service = self.context['service']
         instance = service.update(membership_id, validated_data)
         return instance
+
+
+#a single invitee of a bulk invite, same fields as SendInviteSerializer without the sending member
+class InviteeSerializer(serializers.Serializer):
+    first_name = serializers.CharField(max_length=50)
+    last_name = serializers.CharField(max_length=50)
+    to_email = serializers.EmailField()
+    role = serializers.ChoiceField(choices=['admin', 'user'])
+    expires = serializers.DateTimeField(required=False, allow_null=True, default=None)
+    is_external = serializers.BooleanField(default=False)
+    is_key_contact = serializers.BooleanField(default=False)
+
+
+class BulkInviteSerializer(serializers.Serializer):
+    sending_member_id = serializers.CharField()
+    invitees = serializers.ListField(child=InviteeSerializer(), allow_empty=False, max_length=BULK_INVITE_MAX_INVITEES)
+    
+
+#serializer for returned data when retrieving or creating a single user
+class UserSerializer(SparseFieldsMixin, ValuesSerializerMixin, serializers.ModelSerializer):
+    #memberships in the requesters permissed organizations, prefetched with UsersAccessPolicy.memberships_prefetch
+    memberships = serializers.ListField(child=OrganizationMembershipSerializer(), read_only=True)
+
+    class Meta:
+        model = User
+        fields = ('id', 'first_name', 'last_name', 'timezone', 'email', 'is_active', 'date_joined', 'memberships')
+        read_only_fields = ('id', 'is_active', 'date_joined')
     
+
+    def update(self, user_id, validated_data):
+        service = self.context['service']
+        instance = service.update(user_id, validated_data)
+        return instance
+
   
 #--------------- AuthSerializer ----------------------
 class AuthSerializer(serializers.Serializer):
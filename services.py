@@ -5,13 +5,16 @@ from django.template.loader import render_to_string
 from api.models import Organization, User, OrganizationMembership
 from django.contrib.auth.models import Group
 from api.services.base_service import BaseService
-from api.utilities.auth0 import Auth0ManagmentAPI
-from django.db import transaction
+from api.utilities.auth0 import get_management_client
+from django.conf import settings
+from django.db import IntegrityError, transaction
 from django.core.mail import EmailMessage
+from api.utilities.outbox import PENDING_AUTH0_ID_PREFIX, enqueue, enqueue_many
 from api import services
 import os
 import string
 import random
+import uuid
 
 '''
 Handles logic for the user endpoint
@@ -29,28 +32,23 @@ class UserService(BaseService):
 
     #creates a new user in db and in auth0
     def create(self, email, password, first_name, last_name, organization_id, role, is_key_contact):
-        client_id = os.environ.get('AUTH0_CLIENT_ID')
-        client_secret = os.environ.get('AUTH0_CLIENT_SECRET')
-        domain = os.environ.get('AUTH0_DOMAIN')
-        ath = Auth0ManagmentAPI(client_id, client_secret, domain)
+        ath = get_management_client()
         auth0_user_id = (ath.create_user(email=email, password=password,
                                         validate_email=True))
         user = (User.objects.create_user(first_name=first_name, last_name=last_name, role=role,
-                                        is_key_contact=is_key_contact, auth0_id=auth0_user_id))
+                                        is_key_contact=is_key_contact, auth0_id=auth0_user_id, auth0_managed=True))
         organization = organization.objects.get(id=organization_id)
         user.organization.add(role=role, is_key_contact=is_key_contact)
         return user
 
     #return a specific user if their within their organization
     def get(self, user_id):
-        if not self.scoped_queryset:
+        if self.scoped_queryset is None:
             return False
             
-        user = self.scoped_queryset.filter(id=user_id)
-        if user.exists():
-            return user[0]
-        else:
-            return False
+        #a single query (plus any prefetches) instead of exists() followed by fetching the row
+        user = self.scoped_queryset.filter(id=user_id).first()
+        return user if user is not None else False
     
     #returns a user if it belongs to a users organizations otherwise raises an error 
     def get_or_raise(self, user_id):
@@ -77,11 +75,10 @@ class UserService(BaseService):
             # if they are do not allow user to be deleted until they asign admin to someone else or if 
             # the entire organization is being deleted (archived)
             self.validate_not_sole_admin(user_id)
-            client_id = os.environ.get('AUTH0_CLIENT_ID')
-            client_secret = os.environ.get('AUTH0_CLIENT_SECRET')
-            ath = Auth0ManagmentAPI(client_id, client_secret)
-            ath.delete_user(user.auth0_id)
             user.delete()
+            #the auth0 account is deleted by the outbox worker once the transaction commits
+            if not user.auth0_id.startswith(PENDING_AUTH0_ID_PREFIX):
+                enqueue('auth0.delete_user', {'auth0_id': user.auth0_id}, idempotency_key='auth0.delete_user:' + user.auth0_id)
     
     #checks if user is within an organization that is archived
     def unarchived_queryset(self, queryset):
@@ -121,17 +118,12 @@ class OrganizationService(BaseService):
 
     #returns an organization if the user belongs to the organization
     def get(self, organization_id):
-        if not self.scoped_queryset:
-            return False
-            
-        if not self.scoped_queryset:
+        if self.scoped_queryset is None:
             return False
 
-        org = self.scoped_queryset.filter(id=organization_id)
-        if org.exists():
-            return org[0]
-        else:
-            return False
+        #a single query (plus any prefetches) instead of exists() followed by fetching the row
+        org = self.scoped_queryset.filter(id=organization_id).first()
+        return org if org is not None else False
 
     #eturns an organization if it belongs to a users organizations otherwise raises an error 
     def get_or_raise(self, organization_id ):
@@ -174,14 +166,12 @@ class OrganizationMembershipService(BaseService):
 
     #returns an organization if it belongs to a users organizations
     def get(self, membership_id):
-        if not self.scoped_queryset:
+        if self.scoped_queryset is None:
             return False
             
-        org_user = self.scoped_queryset.filter(id=membership_id)
-        if org_user.exists():
-            return org_user[0]
-        else:
-            return False
+        #a single query (plus any prefetches) instead of exists() followed by fetching the row
+        org_user = self.scoped_queryset.filter(id=membership_id).first()
+        return org_user if org_user is not None else False
 
     #returns an organization user if it belongs to a users organizations otherwise raises an error 
     def get_or_raise(self, organization_id):
@@ -236,11 +226,9 @@ class OrganizationMembershipService(BaseService):
 
             #if user only has one membership also delete the user
             if total_memberships == 1:
-                client_id = os.environ.get('AUTH0_CLIENT_ID')
-                client_secret = os.environ.get('AUTH0_CLIENT_SECRET')
-                ath = Auth0ManagmentAPI(client_id, client_secret)
-                ath.delete_user(user.auth0_id)
                 user.delete()
+                if not user.auth0_id.startswith(PENDING_AUTH0_ID_PREFIX):
+                    enqueue('auth0.delete_user', {'auth0_id': user.auth0_id}, idempotency_key='auth0.delete_user:' + user.auth0_id)
     
     def send_invite(self, validated_data):
         with transaction.atomic():
@@ -262,34 +250,27 @@ class OrganizationMembershipService(BaseService):
 
             #gets/validates sending member
             sending_member = OrganizationMembership.objects.get(id=sending_member_id, user_id=self.request.user.id)
-            sending_member_org_id = OrganizationMembership.objects.get(id=sending_member_id).organization_id
+            sending_member_org_id = sending_member.organization_id
             sending_member_orgs_facility_manager = sending_member.organization.facility_manager
 
-            #only create new user/auth0 account if they dont exists
+            #only create new user if they dont exists, their auth0 account is created by the outbox worker after commit
             user = User.objects.filter(email=email)
-            client_id = os.environ.get('AUTH0_CLIENT_ID')
-            client_secret = os.environ.get('AUTH0_CLIENT_SECRET')
-            domain = os.environ.get('AUTH0_DOMAIN')
-            ath = Auth0ManagmentAPI(client_id, client_secret, domain)
 
             if not user.exists():
                 new_user = True
                 full_name = '{} {}'.format(first_name, last_name)
-                password = ''.join(random.choices(string.ascii_letters + string.digits + string.punctuation, k=9))
-                auth0_id = ath.create_user(email, full_name, password)
                 user = (User.objects.create_user( 
-                    email=email, password=password, is_active=True,
-                    auth0_id=auth0_id, first_name=first_name, last_name=last_name,
+                    email=email, auth0_managed=True, is_active=True,
+                    auth0_id=PENDING_AUTH0_ID_PREFIX + uuid.uuid4().hex, first_name=first_name, last_name=last_name,
                     timezone=self.request.user.timezone))
 
             else:
                 new_user = False
                 user = user.first()
-                auth0_id = user.auth0_id
                 self.validate_existing_membership(sending_member_org_id, user.id, role)
 
             organization = Organization.objects.get(id=sending_member_org_id)
-            OrganizationMembership.objects.create(
+            membership = OrganizationMembership.objects.create(
                 role=role, expires=expires, is_external=is_external, is_key_contact=is_key_contact,
                 user=user, organization=organization)
 
@@ -297,22 +278,110 @@ class OrganizationMembershipService(BaseService):
             #add user to role permission group
             self.add_user_to_role_permission_group(user, role)
 
-            #if this is a newly created user create auth0 password reset link otherwise, just make redirect link to the login page
+            #if this is a newly created user the worker creates their auth0 account and password reset link before
+            # sending the email, otherwise the email just links to the login page
+            sender = {
+                'sender_name': '{} {}'.format(self.request.user.first_name, self.request.user.last_name),
+                'sender_email': self.request.user.email,
+            }
             if new_user:
-                redirect_url = ath.get_passsword_reset_url_by_id(auth0_id, invite_url=True)
-            else: 
-                redirect_url = settings.HOME_URL
-
-            message = render_to_string('invite_email.html', {
-                'sender_name': '{} {}'.format(self.request.user.first_name, self.request.user.last_name), 
-                'sender_email': self.request.user.email, 
-                'domain': settings.DOMAIN,
-                'redirect_url': redirect_url
-            })
-            email = EmailMessage(subject='Method InSight Invite', body=message, to=[email],from_email='<no-reply@' + settings.DOMAIN)
-            email.content_subtype = "html"
-            email.send(fail_silently=False)
-    
+                enqueue('auth0.invite_user', dict(sender, user_id=str(user.id), email=email, name=full_name),
+                    idempotency_key='auth0.invite_user:{}'.format(membership.id))
+            else:
+                enqueue('email.invite', dict(sender, to_email=email, redirect_url=settings.HOME_URL),
+                    idempotency_key='email.invite:{}'.format(membership.id))
+
+    def send_bulk_invites(self, validated_data):
+        """
+        Invites a list of users to the sending members organization
+
+        Invitees are validated in one pass, existing users and memberships are looked up with a single query each and
+        all new rows are inserted in one transaction with User.objects.bulk_create_users. Like send_invite the Auth0 accounts and
+        invite emails of new users are queued as auth0.invite_user outbox messages and existing users are queued an email.invite.
+
+        Parameters
+        ----------
+        validated_data : dict
+            sending_member_id and a list of invitees with the same fields as a single invite
+        Returns
+        -------
+        a result for each invitee in the order given: {'email', 'status': 'invited' | 'failed', 'detail'}, invited rows have their invite queued
+        """
+        invitees = validated_data['invitees']
+        results = [{'email': invitee['to_email'], 'status': 'invited', 'detail': None} for invitee in invitees]
+
+        def fail(i, detail):
+            results[i]['status'] = 'failed'
+            results[i]['detail'] = detail
+
+        #gets/validates sending member, their organization must be one the requester is permitted to send invites for
+        sending_member = self.scoped_queryset.filter(id=validated_data['sending_member_id'], user_id=self.request.user.id).first()
+        if sending_member is None:
+            raise NotFound('Sending member not found.')
+        organization_id = sending_member.organization_id
+
+        #validate all rows, a role outside of admin/user is CRITICAL to reject (see send_invite)
+        seen = set()
+        for i, invitee in enumerate(invitees):
+            email = invitee['to_email'].lower()
+            if invitee['role'] not in ['admin', 'user']:
+                fail(i, 'Invalid role type selected')
+            elif email in seen:
+                fail(i, 'Duplicate invitee')
+            seen.add(email)
+
+        pending = [i for i, result in enumerate(results) if result['status'] == 'invited']
+        emails = [invitees[i]['to_email'] for i in pending]
+        #matched ignoring case as bulk_create_users does
+        existing_users = {user.email.lower(): user for user in User.objects.filter_emails(emails)}
+        existing_memberships = set(OrganizationMembership.objects.filter(
+            organization_id=organization_id, user_id__in=[u.id for u in existing_users.values()]).values_list('user_id', 'role'))
+
+        new_rows = []
+        for i in pending:
+            user = existing_users.get(invitees[i]['to_email'].lower())
+            if user is None:
+                new_rows.append(i)
+            elif (user.id, invitees[i]['role']) in existing_memberships:
+                fail(i, 'User has an existing account with this role already.')
+
+        #new users get a pending auth0 id, their auth0 accounts and invite links are created by the outbox worker after
+        # commit (as send_invite) so the request makes no auth0 calls and there are no accounts to clean up on a rollback
+        invited = [i for i in pending if results[i]['status'] == 'invited']
+        sender = {
+            'sender_name': '{} {}'.format(self.request.user.first_name, self.request.user.last_name),
+            'sender_email': self.request.user.email,
+        }
+        try:
+            with transaction.atomic():
+                created = User.objects.bulk_create_users([{
+                    'email': invitees[i]['to_email'], 'auth0_id': PENDING_AUTH0_ID_PREFIX + uuid.uuid4().hex, 'is_active': True,
+                    'first_name': invitees[i]['first_name'].title(), 'last_name': invitees[i]['last_name'].title(),
+                    'timezone': self.request.user.timezone,
+                    'memberships': [{
+                        'organization_id': organization_id, 'role': invitees[i]['role'], 'expires': invitees[i]['expires'],
+                        'is_external': invitees[i]['is_external'], 'is_key_contact': invitees[i]['is_key_contact']}],
+                } for i in invited])
+
+                #rows created or invited concurrently by another request
+                for i, result in zip(invited, created):
+                    if result['status'] == 'conflict' or not result['memberships_created']:
+                        fail(i, '; '.join(result['errors']) or 'User has an existing account with this role already.')
+                created = [(i, result) for i, result in zip(invited, created) if results[i]['status'] == 'invited']
+
+                #the emails are sent in batches by the outbox worker (paced to the providers rate limit), existing users are sent to the login page
+                enqueue_many('auth0.invite_user', [dict(sender, user_id=str(result['user'].id), email=invitees[i]['to_email'],
+                    name='{} {}'.format(invitees[i]['first_name'].title(), invitees[i]['last_name'].title()))
+                    for i, result in created if result['status'] == 'created'])
+                enqueue_many('email.invite', [dict(sender, to_email=invitees[i]['to_email'], redirect_url=settings.HOME_URL)
+                    for i, result in created if result['status'] == 'existing'])
+        except IntegrityError:
+            #a user or membership was inserted by a concurrent request, the transaction was rolled back so nothing was created
+            for i in invited:
+                fail(i, 'Invite conflicted with a concurrent change, please try again.')
+
+        return results
+
     #validates user doesnt have an existing membership for the same role
     def validate_existing_membership(self, organization_id, user_id, role):
         if OrganizationMembership.objects.filter(
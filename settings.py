@@ -65,6 +65,8 @@ EMAIL_HOST_USER = ''
 EMAIL_HOST_PASSWORD = os.environ.get('mailgun_host_password')
 EMAIL_PORT = 587
 EMAIL_USE_TLS = True
+#messages per second allowed by the email provider (see api.utilities.mailer), None sends as fast as the server accepts them
+EMAIL_RATE_LIMIT = None
 
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -142,11 +144,12 @@ REST_FRAMEWORK = {
         'auth0_auth.Auth0TokenAuthentication',
         'rest_framework.authentication.TokenAuthentication',
     ],
+    #orjson backed json renderer/parser, falls back to the stdlib json DRF classes if orjson isnt installed
     'DEFAULT_RENDERER_CLASSES': [
-        'rest_framework.renderers.JSONRenderer'
+        'api.renderers.FastJSONRenderer'
     ],
     'DEFAULT_PARSER_CLASSES': [
-        'rest_framework.parsers.JSONParser',
+        'api.renderers.FastJSONParser',
     ],
     'DEFAULT_THROTTLE_CLASSES': [
         'rest_framework.throttling.UserRateThrottle'
@@ -158,10 +161,49 @@ REST_FRAMEWORK = {
     'PAGE_SIZE': 500
 }
 
+#how total_results is counted for paginated responses: 'exact', 'cached' or 'estimate' (PostgreSQL planner estimate)
+PAGINATION_COUNT_STRATEGY = 'exact'
+PAGINATION_COUNT_CACHE_TIMEOUT = 60 #seconds
+PAGINATION_COUNT_ESTIMATE_THRESHOLD = 10000 #estimates below this are replaced with an exact count
+
+#seconds list responses are cached for keyed by the requesters organization scope and its versions, 0 disables the cache
+LIST_RESPONSE_CACHE_TIMEOUT = 0
+
+#process local cache, use a shared cache (e.g redis or memcached) in production so cached values are shared between workers
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    }
+}
+
 # auth0 settings
 AUTH0_DOMAIN = os.getenv('AUTH0_DOMAIN')
 AUTH0_ALGORITHMS = ['RS256']
 AUTH0_API_AUDIENCE = os.getenv('AUTH0_IDENTIFIER')
+#path to a local jwks.json to verify tokens against instead of fetching keys from Auth0 (offline/tests)
+AUTH0_JWKS_FILE = os.getenv('AUTH0_JWKS_FILE')
+AUTH0_JWKS_REFRESH_INTERVAL = 3600 #seconds between background refreshes of the signing keys
+AUTH0_JWKS_MIN_REFETCH_INTERVAL = 30 #minimum seconds between refetches caused by an unknown key id
+#verified bearer token cache
+AUTH0_TOKEN_CACHE_SIZE = 10000
+AUTH0_TOKEN_CACHE_LEEWAY = 30 #seconds of clock skew allowed for before a tokens exp
+AUTH0_TOKEN_CACHE_MAX_TTL = 300
+#'claims' resolves users from the verified sub claim (linking an unmatched sub to the user with its verified /userinfo email),
+# 'userinfo' from Auth0s /userinfo endpoint
+AUTH0_IDENTITY_RESOLUTION = 'claims'
+AUTH0_USERINFO_CACHE_TTL = 3600 #seconds a subjects /userinfo response is reused
+#m2m client application metadata cache (client_id -> assigned user)
+AUTH0_CLIENT_CACHE_TTL = 3600
+AUTH0_CLIENT_CACHE_NEGATIVE_TTL = 60
+#reuse still valid client credentials tokens issued through the /auth endpoint
+AUTH0_TOKEN_BROKER_CACHE = True
+AUTH0_TOKEN_BROKER_LEEWAY = 60 #seconds before expiry a cached token is no longer handed out
+
+#outbox for auth0/email side effects (see api.utilities.outbox), 'thread' drains it in each process
+# 'external' leaves it to a separate `manage.py process_outbox` worker
+OUTBOX_MODE = 'thread'
+OUTBOX_BATCH_SIZE = 50
+OUTBOX_MAX_ATTEMPTS = 8
 
 HOME_URL = 'http://127.0.0.1:8000/' #change in production to your homepage url
 APPEND_SLASH = False
@@ -1 +1,1200 @@
+import base64
+import csv
+import datetime as dt
+import decimal
+import io
+import json
+import os
+import random
+import re
+import socketserver
+import tempfile
+import threading
+import time
+import uuid
+from unittest import mock, skipUnless
+from django.conf import settings
+from django.contrib.auth.models import Group
+from django.core import mail
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.db import IntegrityError, connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils.translation import gettext_lazy
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed, ParseError
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+from rest_framework.permissions import IsAuthenticated
+from rest_framework.test import APIClient, APIRequestFactory
+from rest_framework.views import APIView
+import auth0_auth
+from api.pagination import KeysetPagination
+from api.renderers import FastJSONParser, FastJSONRenderer, orjson
+from api.views import ModelViewSet_, OrganizationMembershipViewSet, UsersViewSet
+from api.models import Organization, OrganizationMembership, OutboxMessage, User
+from api.serializers import OrganizationMembershipSerializer, OrganizationSerializer, UserSerializer
+from api.utilities import token_broker
+from api.utilities.jwks import JWKSStore
+from api.utilities.auth0 import Auth0ManagmentAPI
+from api.utilities.mailer import EmailDelivery, invite_email
+from api.utilities.outbox import PENDING_AUTH0_ID_PREFIX, invite_auth0_user, send_invite_emails
+from api.permissions.roles import BaseAccessPolicy, OrganizationsAccessPolicy, PrincipalContext, UsersAccessPolicy
 
+
+#creates an auth0 managed user, in the permission group of each role (as bulk_create_users does) with a membership of the role in each organization
+def create_member(email, organizations=(), role='user', groups=None):
+    user = User.objects.create_user(email, auth0_managed=True, auth0_id='auth0|' + email, timezone='UTC', is_active=True)
+    user.groups.set(Group.objects.filter(name__in=groups or [role]))
+    for organization in organizations:
+        OrganizationMembership.objects.create(user=user, organization=organization, role=role, is_external=False)
+    return user
+
+
+class EndpointTestCase(TestCase):
+    '''
+    Calls the endpoints as an organization admin. The oauth token check and throttling are left out, the requester
+    is force authenticated with a freshly loaded user for every request as the authentication classes do.
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        for name in ['admin', 'user', 'Organization admin']:
+            Group.objects.create(name=name)
+        cls.organization = Organization.objects.create(name='Organization')
+        cls.other_organization = Organization.objects.create(name='Other organization')
+        cls.admin = create_member('admin@example.com', [cls.organization], 'admin', groups=['admin', 'Organization admin'])
+        cls.member = create_member('member@example.com', [cls.organization])
+        create_member('outsider@example.com', [cls.other_organization])
+
+    def setUp(self):
+        for attr, value in (('permission_classes', [IsAuthenticated]), ('throttle_classes', [])):
+            patcher = mock.patch.object(APIView, attr, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.client = APIClient()
+
+    def authenticate(self, user=None):
+        self.client.force_authenticate(User.objects.get(pk=(user or self.admin).pk))
+
+    #a request made by the user for calling access policies directly
+    def make_request(self, user=None):
+        request = APIRequestFactory().get('/')
+        request.user = User.objects.get(pk=(user or self.admin).pk)
+        return request
+
+
+#--------------- Access policies -----------------------
+
+#the statement loop the access policies used before statements were compiled, kept as the oracle for allowed_roles
+def loop_allowed_roles(statements, action, roles):
+    statements = statements if not action else [s for s in statements if action in s['action'] or '*' in s['action']]
+    allowed = set()
+    for role in roles:
+        for statement in statements:
+            role_in_policy = True if '*' in statement['principal'] else any(role in principal for principal in statement['principal'])
+            if role_in_policy and statement['effect'] == "allow":
+                allowed.add(role)
+    return allowed
+
+
+class AllowedRolesTests(SimpleTestCase):
+    ACTIONS = ['list', 'retrieve', 'create', 'update', 'send_invite']
+    PRINCIPALS = ['group:admin', 'group:user', 'group:Organization admin', 'group:system admin', '*']
+    ROLES = ['system admin', 'admin', 'user', 'Admin', 'guest']
+
+    def random_statements(self, rng, count):
+        return [{
+            'action': rng.sample(self.ACTIONS + ['*'], rng.randint(1, 3)),
+            'principal': rng.sample(self.PRINCIPALS, rng.randint(1, 2)),
+            'effect': rng.choice(['allow', 'allow', 'deny']),
+        } for _ in range(count)]
+
+    def policy(self, statements):
+        return type('RandomAccessPolicy', (BaseAccessPolicy,), {'statements': statements})
+
+    def test_matches_statement_loop(self):
+        rng = random.Random(7)
+        for _ in range(3000):
+            statements = self.random_statements(rng, rng.randint(0, 6))
+            policy = self.policy(statements)
+            roles = set(rng.sample(self.ROLES, rng.randint(0, len(self.ROLES))))
+            #the policies actions, one no statement names and no action at all
+            for action in rng.sample(self.ACTIONS, 3) + ['destroy', None]:
+                self.assertEqual(policy.allowed_roles(action, roles), loop_allowed_roles(statements, action, roles),
+                    msg='action={!r} roles={!r} statements={!r}'.format(action, roles, statements))
+
+
+#--------------- Query budgets -----------------------
+
+class PermissionedOrganizationsTests(EndpointTestCase):
+    def test_scope_is_lazy(self):
+        request = self.make_request(self.admin)
+        with self.assertNumQueries(1):
+            #only the requesters memberships are loaded, the scope is a subquery
+            organizations = OrganizationsAccessPolicy().get_permissioned_organizations(request, True, 'create')
+        self.assertEqual(list(organizations), [str(self.organization.pk)])
+
+    def test_system_admin_is_unrestricted(self):
+        system_admin = create_member('system-admin@example.com', [self.other_organization], 'Admin')
+        self.assertIsNone(OrganizationsAccessPolicy().get_permissioned_organizations(self.make_request(system_admin), True, 'create'))
+
+
+class PrincipalContextTests(EndpointTestCase):
+    def test_policies_read_groups_from_context(self):
+        user = User.objects.get(pk=self.admin.pk)
+        context = PrincipalContext.for_user(user)
+        with self.assertNumQueries(1):
+            self.assertEqual(set(context.groups), {'admin', 'Organization admin'})
+        with self.assertNumQueries(0):
+            self.assertEqual(set(UsersAccessPolicy().get_user_group_values(user)), {'admin', 'Organization admin'})
+
+    def test_endpoint_query_budgets(self):
+        membership = OrganizationMembership.objects.get(user=self.member)
+        #the requesters memberships and groups are loaded once and shared by the access policy and the view
+        budgets = [
+            #memberships, groups, list stamps, count, page, page users memberships
+            ('/users', 6),
+            #memberships, groups, etag, user, users memberships
+            ('/users/{}'.format(self.member.pk), 5),
+            ('/organizations', 5),
+            ('/organizations/{}'.format(self.organization.pk), 4),
+            ('/organization-memberships', 5),
+            ('/organization-memberships/{}'.format(membership.pk), 4),
+        ]
+        for url, queries in budgets:
+            self.authenticate()
+            with self.subTest(url=url), self.assertNumQueries(queries):
+                self.assertEqual(self.client.get(url).status_code, 200)
+
+
+class UsersQueryBudgetTests(EndpointTestCase):
+    #returns the number of queries and the response of a request as the admin
+    def get_counting_queries(self, url):
+        self.authenticate()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response
+
+    def test_list_queries_dont_grow_with_users(self):
+        queries, response = self.get_counting_queries('/users')
+        self.assertEqual(len(response.data['data']), 2)
+
+        for i in range(20):
+            create_member('member{}@example.com'.format(i), [self.organization, self.other_organization])
+        many_queries, response = self.get_counting_queries('/users')
+        self.assertEqual(len(response.data['data']), 22)
+        #only memberships in the requesters organizations are rendered
+        self.assertTrue(all(len(user['memberships']) == 1 for user in response.data['data']))
+        self.assertEqual(many_queries, queries)
+
+    def test_retrieve_queries_dont_grow_with_memberships(self):
+        queries, response = self.get_counting_queries('/users/{}'.format(self.member.pk))
+        self.assertEqual(len(response.data['memberships']), 1)
+
+        for role in ['admin', 'user']:
+            OrganizationMembership.objects.create(user=self.admin, organization=self.other_organization, role=role, is_external=False)
+        OrganizationMembership.objects.create(user=self.member, organization=self.organization, role='admin', is_external=False)
+        many_queries, response = self.get_counting_queries('/users/{}'.format(self.member.pk))
+        self.assertEqual(len(response.data['memberships']), 2)
+        self.assertEqual(many_queries, queries)
+
+
+class ListStampsTests(EndpointTestCase):
+    @mock.patch('api.views.count_version_is_shared', return_value=True)
+    def test_system_admin_list_etag_uses_global_version(self, count_version_is_shared):
+        system_admin = create_member('system-admin@example.com', [self.other_organization], 'Admin', groups=['Organization admin'])
+        self.authenticate(system_admin)
+        etag = self.client.get('/organizations')['ETag']
+
+        self.authenticate(system_admin)
+        #only the requesters memberships and groups are loaded, no organizations
+        with self.assertNumQueries(2):
+            self.assertEqual(self.client.get('/organizations', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            Organization.objects.create(name='New organization')
+        self.authenticate(system_admin)
+        response = self.client.get('/organizations', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_system_admin_list_etag_without_shared_cache(self):
+        system_admin = create_member('system-admin@example.com', [self.other_organization], 'Admin', groups=['Organization admin'])
+        self.authenticate(system_admin)
+        etag = self.client.get('/organizations')['ETag']
+
+        #a change made by another worker never bumps this processes version, the organizations own stamps still change
+        Organization.objects.filter(pk=self.other_organization.pk).update(name='Renamed', version='changed-elsewhere')
+        self.authenticate(system_admin)
+        response = self.client.get('/organizations', HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+@override_settings(LIST_RESPONSE_CACHE_TIMEOUT=60)
+class ListResponseCacheTests(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+    #the ids listed at the url for the user and whether the response was built rather than read from the cache
+    def list_ids(self, user, url):
+        self.authenticate(user)
+        with mock.patch.object(ModelViewSet_, 'paginated_list_response', autospec=True, side_effect=ModelViewSet_.paginated_list_response) as build:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return {str(item['id']) for item in response.data['data']}, build.called
+
+    def membership_ids(self, organization):
+        return {str(pk) for pk in OrganizationMembership.objects.filter(organization=organization).values_list('id', flat=True)}
+
+    def test_principals_with_different_scopes(self):
+        other_admin = create_member('other-admin@example.com', [self.other_organization], 'admin', groups=['admin', 'Organization admin'])
+        self.assertEqual(self.list_ids(self.admin, '/organization-memberships'), (self.membership_ids(self.organization), True))
+        self.assertEqual(self.list_ids(other_admin, '/organization-memberships'), (self.membership_ids(self.other_organization), True))
+        #a principal with the same scope is served the cached response
+        self.assertEqual(self.list_ids(self.admin, '/organization-memberships'), (self.membership_ids(self.organization), False))
+
+    def test_hit_after_membership_change(self):
+        self.assertEqual(self.list_ids(self.admin, '/organizations')[0], {str(self.organization.pk)})
+        membership = OrganizationMembership.objects.create(user=self.admin, organization=self.other_organization, role='admin', is_external=False)
+        self.assertEqual(self.list_ids(self.admin, '/organizations')[0], {str(self.organization.pk), str(self.other_organization.pk)})
+        membership.delete()
+        self.assertEqual(self.list_ids(self.admin, '/organizations')[0], {str(self.organization.pk)})
+
+        #a new member of the organization is listed straight away
+        self.list_ids(self.admin, '/organization-memberships')
+        create_member('new@example.com', [self.organization])
+        self.assertEqual(self.list_ids(self.admin, '/organization-memberships'), (self.membership_ids(self.organization), True))
+
+    def test_system_admin_and_organization_admin(self):
+        system_admin = create_member('system-admin@example.com', [self.other_organization], 'Admin', groups=['Organization admin'])
+        every_organization = {str(self.organization.pk), str(self.other_organization.pk)}
+        for shared in (False, True):
+            with self.subTest(shared_cache=shared), mock.patch('api.views.count_version_is_shared', return_value=shared):
+                cache.clear()
+                self.assertEqual(self.list_ids(system_admin, '/organizations')[0], every_organization)
+                self.assertEqual(self.list_ids(self.admin, '/organizations')[0], {str(self.organization.pk)})
+                self.assertEqual(self.list_ids(system_admin, '/organizations'), (every_organization, False))
+
+
+class SparseFieldsTests(EndpointTestCase):
+    #the response data and the sql of the queries made for it
+    def get(self, url, **params):
+        self.authenticate()
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url, params)
+        return response, '\n'.join(query['sql'] for query in queries.captured_queries)
+
+    def test_validates_fields(self):
+        membership = self.member.organizationmembership_set.get()
+        for url in ('/users', '/users/{}'.format(self.member.pk), '/organization-memberships/{}'.format(membership.pk)):
+            for fields in ('email,password', ' , '):
+                with self.subTest(url=url, fields=fields):
+                    response, _ = self.get(url, fields=fields)
+                    self.assertEqual(response.status_code, 400)
+                    self.assertIn('fields', response.data)
+
+    def test_retrieve_selects_requested_columns(self):
+        url = '/users/{}'.format(self.member.pk)
+        response, sql = self.get(url)
+        self.assertIn('"api_user"."first_name"', sql)
+        self.assertIn('memberships', response.data)
+
+        response, sql = self.get(url, fields='email,date_joined')
+        self.assertEqual(response.data, {'email': self.member.email, 'date_joined': User.objects.get(pk=self.member.pk).date_joined.isoformat()})
+        self.assertNotIn('"api_user"."first_name"', sql)
+        #memberships arent prefetched when they arent rendered
+        self.assertNotIn('"api_organizationmembership"."is_key_contact"', sql)
+
+        membership = self.member.organizationmembership_set.get()
+        response, sql = self.get('/organization-memberships/{}'.format(membership.pk), fields='id,role')
+        self.assertEqual(response.data, {'id': membership.pk, 'role': 'user'})
+        self.assertNotIn('"api_organizationmembership"."is_key_contact"', sql)
+
+        response, sql = self.get('/organizations/{}'.format(self.organization.pk), fields='id')
+        self.assertEqual(response.data, {'id': str(self.organization.pk)})
+        self.assertNotIn('"api_organization"."name"', sql)
+
+
+class ExportTests(EndpointTestCase):
+    def export(self, url, **params):
+        self.authenticate()
+        response = self.client.get(url, params)
+        if response.status_code != 200:
+            return response, None
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_ndjson(self):
+        response, content = self.export('/users/export')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        rows = [json.loads(line) for line in content.splitlines()]
+        #only users of the requesters organizations
+        self.assertEqual(sorted(row['email'] for row in rows), [self.admin.email, self.member.email])
+        self.assertEqual(set(rows[0]), set(UserSerializer.column_fields()))
+
+    def test_csv(self):
+        response, content = self.export('/organization-memberships/export', export_format='csv', fields='id,role')
+        self.assertEqual(response['Content-Type'], 'text/csv')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="organization-memberships.csv"')
+        rows = list(csv.reader(io.StringIO(content)))
+        self.assertEqual(rows[0], ['id', 'role'])
+        self.assertEqual(sorted(rows[1:]), sorted([str(pk), role] for pk, role in
+            OrganizationMembership.objects.filter(organization=self.organization).values_list('id', 'role')))
+
+    def test_csv_formulas_are_escaped(self):
+        User.objects.filter(pk=self.member.pk).update(first_name='=HYPERLINK("https://example.com")', last_name='-1+2')
+        _, content = self.export('/users/export', export_format='csv', fields='email,first_name,last_name')
+        rows = {row[0]: row[1:] for row in csv.reader(io.StringIO(content))}
+        self.assertEqual(rows[self.member.email], ['\'=HYPERLINK("https://example.com")', "'-1+2"])
+        #json keeps the values as they are
+        _, content = self.export('/users/export', fields='email,first_name')
+        self.assertIn({'email': self.member.email, 'first_name': '=HYPERLINK("https://example.com")'}, [json.loads(line) for line in content.splitlines()])
+
+    def test_rejects_nested_fields_and_unknown_formats(self):
+        for params in ({'fields': 'email,memberships'}, {'export_format': 'xlsx'}):
+            with self.subTest(params=params):
+                response, _ = self.export('/users/export', **params)
+                self.assertEqual(response.status_code, 400)
+
+
+#--------------- Query plans -----------------------
+
+#a table read from start to end instead of through an index (sqlite SCAN without an index, postgresql Seq Scan)
+FULL_SCAN = re.compile(r'\bSCAN \S+( AS \S+)?$|Seq Scan on', re.MULTILINE)
+
+
+@skipUnless(connection.vendor in ('sqlite', 'postgresql'), 'query plans are only checked on sqlite and postgresql')
+class QueryPlanTests(EndpointTestCase):
+    '''
+    EXPLAINs the hot organization membership lookups against seeded tables and fails if a plan reads a whole table,
+    e.g when a change to a query no longer matches the composite indexes on OrganizationMembership.
+    '''
+
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        organizations = Organization.objects.bulk_create([Organization(name='Organization {}'.format(i)) for i in range(20)])
+        rng = random.Random(20)
+        User.objects.bulk_create_users([{
+            'email': 'seeded{}@example.com'.format(i),
+            'auth0_id': 'auth0|seeded{}'.format(i),
+            'timezone': 'UTC',
+            'memberships': [{'organization_id': organization.pk, 'role': rng.choice(['admin', 'user'])} for organization in rng.sample(organizations, 3)],
+        } for i in range(500)])
+        with connection.cursor() as cursor:
+            cursor.execute('ANALYZE')
+
+    def setUp(self):
+        super().setUp()
+        if connection.vendor == 'postgresql':
+            #the seeded tables are small enough that reading them sequentially is cheapest, only do so when no index can be used
+            with connection.cursor() as cursor:
+                cursor.execute('SET LOCAL enable_seqscan = off')
+
+    def assertNoFullScan(self, queryset):
+        plan = queryset.explain()
+        self.assertIsNone(FULL_SCAN.search(plan), msg='Full scan in query plan:\n' + plan)
+
+    def test_organization_scope(self):
+        scope = UsersAccessPolicy().get_organization_scope(self.make_request(), True, 'list')
+        self.assertNoFullScan(scope)
+        self.assertNoFullScan(UsersAccessPolicy().get_organization_scope(self.make_request(), True, 'list', self.organization.pk))
+
+    def test_users_exists_subquery(self):
+        users = UsersAccessPolicy().scope_queryset(self.make_request(), True, 'list')
+        self.assertNoFullScan(users.filter(pk=self.member.pk))
+        #a page of the users list walks the primary key, the subquery is evaluated per user through the index
+        self.assertNoFullScan(users.order_by('pk')[:25])
+
+    def test_sole_admin_check(self):
+        self.assertNoFullScan(OrganizationMembership.objects.filter(organization_id=self.organization.pk, role='admin'))
+
+    def test_existing_membership_lookup(self):
+        #OrganizationMembershipService.validate_existing_membership
+        self.assertNoFullScan(OrganizationMembership.objects.filter(user=self.member.pk, role='user', organization_id=self.organization.pk))
+
+
+#--------------- Pagination -----------------------
+
+class LimitOffsetPaginationTests(EndpointTestCase):
+    def list_memberships(self, **params):
+        self.authenticate()
+        return self.client.get('/organization-memberships', {'limit': 1, **params}).data
+
+    @override_settings(PAGINATION_COUNT_STRATEGY='cached')
+    def test_stale_count_doesnt_hide_rows(self):
+        self.assertEqual(self.list_memberships()['total_results'], 2)
+        #the cached count is only dropped once the change is committed (never in a test case)
+        for email in ('new1@example.com', 'new2@example.com'):
+            create_member(email, [self.organization])
+
+        page = self.list_memberships(offset=2)
+        self.assertEqual((page['total_results'], page['total_results_type']), (2, 'cached'))
+        self.assertEqual(page['returned_results'], 1)
+        self.assertIn('offset=3', page['next'])
+        last_page = self.list_memberships(offset=3)
+        self.assertEqual(last_page['returned_results'], 1)
+        self.assertIsNone(last_page['next'])
+
+    def test_exact_count(self):
+        page = self.list_memberships()
+        self.assertEqual((page['total_results'], page['total_results_type']), (2, 'exact'))
+        self.assertIn('offset=1', page['next'])
+        self.assertIsNone(self.list_memberships(offset=1)['next'])
+        self.assertEqual(self.list_memberships(offset=5)['data'], [])
+
+
+@mock.patch.object(UsersViewSet, 'pagination_class', KeysetPagination)
+@mock.patch.object(OrganizationMembershipViewSet, 'pagination_class', KeysetPagination)
+class KeysetPaginationTests(EndpointTestCase):
+    @classmethod
+    def setUpTestData(cls):
+        super().setUpTestData()
+        #every row is created on the same date so pages are ordered by the id tie breaker
+        for i in range(5):
+            create_member('new{}@example.com'.format(i), [cls.organization])
+
+    def get(self, url, **params):
+        self.authenticate()
+        response = self.client.get(url, params)
+        self.assertEqual(response.status_code, 200)
+        return response.data
+
+    #follows the next links from the first page then the previous links back from the last, returns the ids of both walks and the page count
+    def walk(self, url, limit):
+        forward, backward = [], []
+        page = self.get(url, limit=limit)
+        pages = [page]
+        while page['next']:
+            page = self.get(page['next'])
+            pages.append(page)
+        for page in pages:
+            forward += [str(item['id']) for item in page['data']]
+        while page['previous']:
+            page = self.get(page['previous'])
+            backward = [str(item['id']) for item in page['data']] + backward
+        return forward, backward, len(pages)
+
+    def test_memberships_from_values_rows(self):
+        memberships = OrganizationMembership.objects.filter(organization=self.organization)
+        self.assertEqual(len(set(memberships.values_list('date_created', flat=True))), 1)
+        ordered = [str(pk) for pk in memberships.order_by('date_created', 'id').values_list('id', flat=True)]
+
+        forward, backward, pages = self.walk('/organization-memberships', 3)
+        self.assertEqual(forward, ordered)
+        #paging back from the last page returns every row before it and stops at the first page
+        self.assertEqual(backward, ordered[:6])
+        self.assertEqual(pages, 3)
+
+    def test_users_from_model_instances(self):
+        users = User.objects.filter(organizationmembership__organization=self.organization)
+        ordered = [str(pk) for pk in users.order_by('date_joined', 'id').values_list('id', flat=True)]
+        forward, backward, pages = self.walk('/users', 2)
+        self.assertEqual(forward, ordered)
+        self.assertEqual(backward, ordered[:6])
+        self.assertEqual(pages, 4)
+
+    def test_invalid_cursor(self):
+        self.authenticate()
+        wrong_keys = base64.urlsafe_b64encode(json.dumps({'p': ['2020-01-01'], 'r': 0}).encode()).decode()
+        for cursor in ('not-a-cursor', wrong_keys):
+            with self.subTest(cursor=cursor):
+                self.assertEqual(self.client.get('/organization-memberships', {'cursor': cursor}).status_code, 404)
+
+
+#--------------- List serialization -----------------------
+
+#a membership serializer with a nullable date column
+class ExpiringMembershipSerializer(OrganizationMembershipSerializer):
+    class Meta(OrganizationMembershipSerializer.Meta):
+        fields = OrganizationMembershipSerializer.Meta.fields + ('expires', 'invite_date')
+
+
+class ValuesSerializationTests(EndpointTestCase):
+    def assertMatchesSerializer(self, serializer_class, queryset, fields=None):
+        queryset = queryset.order_by('pk')
+        sources = serializer_class.values_sources(fields)
+        self.assertIsNotNone(sources)
+        rendered = serializer_class.from_values(queryset.values(*sources), fields)
+        serialized = serializer_class(list(queryset), many=True, fields=fields).data
+        self.assertEqual(rendered, serialized)
+        #the same types, not only equal values
+        self.assertEqual([{k: type(v) for k, v in item.items()} for item in rendered], [{k: type(v) for k, v in item.items()} for item in serialized])
+
+    def test_matches_model_serializer(self):
+        OrganizationMembership.objects.filter(user=self.member).update(expires='2030-01-31', is_key_contact=True)
+        User.objects.filter(pk=self.member.pk).update(first_name='Member', last_name='')
+        for serializer_class, queryset, fields in (
+            (OrganizationSerializer, Organization.objects.all(), None),
+            (OrganizationMembershipSerializer, OrganizationMembership.objects.all(), None),
+            #expires is null for every membership but the members
+            (ExpiringMembershipSerializer, OrganizationMembership.objects.all(), None),
+            (UserSerializer, User.objects.all(), UserSerializer.column_fields()),
+            (UserSerializer, User.objects.all(), ['email', 'date_joined']),
+        ):
+            with self.subTest(serializer=serializer_class.__name__, fields=fields):
+                self.assertMatchesSerializer(serializer_class, queryset, fields)
+
+    def test_nested_fields_need_instances(self):
+        self.assertIsNone(UserSerializer.values_sources())
+        self.assertNotIn('memberships', UserSerializer.column_fields())
+
+
+#--------------- Invites -----------------------
+
+class BulkInviteTests(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        #auth0 is only called by the outbox worker, never during the request
+        self.auth0 = mock.Mock()
+        patcher = mock.patch('api.services.organization_memberships.get_management_client', return_value=self.auth0)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(lambda: self.assertEqual(self.auth0.mock_calls, []))
+
+    def bulk_invite(self, sending_member, emails, role='user'):
+        self.authenticate()
+        return self.client.post('/organization-memberships/bulk_invite', {
+            'sending_member_id': sending_member.pk,
+            'invitees': [{'first_name': 'new', 'last_name': 'member', 'to_email': email, 'role': role} for email in emails],
+        }, format='json')
+
+    def test_invites_to_sending_members_organization(self):
+        response = self.bulk_invite(self.admin.organizationmembership_set.get(), ['new@example.com', 'member@example.com', 'outsider@example.com'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.data['results']], ['invited', 'failed', 'invited'])
+        self.assertTrue(OrganizationMembership.objects.filter(user__email='outsider@example.com', organization=self.organization).exists())
+
+        #the new users auth0 account is created by the outbox worker, existing users are emailed a link to the login page
+        new_user = User.objects.get(email='new@example.com')
+        self.assertTrue(new_user.auth0_id.startswith(PENDING_AUTH0_ID_PREFIX))
+        self.assertEqual([message.payload for message in OutboxMessage.objects.filter(kind='auth0.invite_user')], [{
+            'sender_name': '{} {}'.format(self.admin.first_name, self.admin.last_name),
+            'sender_email': self.admin.email, 'user_id': str(new_user.pk), 'email': 'new@example.com', 'name': 'New Member'}])
+        self.assertEqual([(message.payload['to_email'], message.payload['redirect_url']) for message in OutboxMessage.objects.filter(kind='email.invite')],
+            [('outsider@example.com', settings.HOME_URL)])
+        self.assertEqual(len(mail.outbox), 0)
+
+    def test_matches_existing_users_ignoring_case(self):
+        response = self.bulk_invite(self.admin.organizationmembership_set.get(), ['Outsider@Example.com'])
+        self.assertEqual([result['status'] for result in response.data['results']], ['invited'])
+        self.assertEqual(User.objects.filter(email__iexact='outsider@example.com').count(), 1)
+        self.assertTrue(OrganizationMembership.objects.filter(user__email='outsider@example.com', organization=self.organization).exists())
+        self.assertEqual(OutboxMessage.objects.get().kind, 'email.invite')
+
+    def test_rejects_sending_member_outside_of_scope(self):
+        #the admin is only a user of the other organization so cant invite to it
+        membership = OrganizationMembership.objects.create(user=self.admin, organization=self.other_organization, role='user', is_external=False)
+        response = self.bulk_invite(membership, ['new@example.com'])
+        self.assertEqual(response.status_code, 404)
+        self.assertFalse(User.objects.filter(email='new@example.com').exists())
+
+    def test_integrity_error_fails_rows(self):
+        with mock.patch.object(User.objects, 'bulk_create_users', side_effect=IntegrityError('duplicate key')):
+            response = self.bulk_invite(self.admin.organizationmembership_set.get(), ['new@example.com', 'other@example.com'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([result['status'] for result in response.data['results']], ['failed', 'failed'])
+        #nothing is queued for the rolled back rows
+        self.assertFalse(OutboxMessage.objects.exists())
+
+
+class OutboxInviteTests(EndpointTestCase):
+    def invite_message(self, user):
+        return OutboxMessage.objects.create(kind='auth0.invite_user', idempotency_key='auth0.invite_user:test', payload={
+            'user_id': str(user.pk), 'email': user.email, 'name': 'New Member', 'sender_name': 'Admin', 'sender_email': self.admin.email})
+
+    def test_account_of_user_deleted_during_invite_is_deleted(self):
+        user = create_member('new@example.com', [self.organization])
+        User.objects.filter(pk=user.pk).update(auth0_id=PENDING_AUTH0_ID_PREFIX + 'new')
+        message = self.invite_message(user)
+
+        auth0 = mock.Mock()
+        auth0.get_user_id_by_email.return_value = None
+        #the user is deleted while the auth0 account is being created
+        auth0.create_user.side_effect = lambda email, name, password, app_metadata: User.objects.filter(pk=user.pk).delete() and 'auth0|new'
+        with mock.patch('api.utilities.outbox.get_management_client', return_value=auth0):
+            invite_auth0_user(message)
+
+        self.assertEqual(OutboxMessage.objects.get(kind='auth0.delete_user').payload, {'auth0_id': 'auth0|new'})
+        self.assertFalse(OutboxMessage.objects.filter(kind='email.invite').exists())
+        auth0.get_passsword_reset_url_by_id.assert_not_called()
+
+    def test_only_adopts_account_created_for_the_user(self):
+        user = create_member('new@example.com', [self.organization])
+        User.objects.filter(pk=user.pk).update(auth0_id=PENDING_AUTH0_ID_PREFIX + 'new')
+        message = self.invite_message(user)
+
+        #a social login and an account of a deleted user with the same email, and the account made by an earlier attempt
+        api = Auth0ManagmentAPI('client-id', 'client-secret', 'example.auth0.com')
+        api._auth0 = mock.Mock()
+        api._expires_at = float('inf')
+        accounts = [
+            {'user_id': 'google-oauth2|new', 'identities': [{'connection': 'google-oauth2'}], 'app_metadata': {'user_id': str(user.pk)}},
+            {'user_id': 'auth0|deleted', 'identities': [{'connection': 'Username-Password-Authentication'}], 'app_metadata': {'user_id': 'deleted'}},
+        ]
+        api._auth0.users_by_email.search_users_by_email.side_effect = lambda email, fields: accounts
+        api._auth0.users.create.return_value = {'user_id': 'auth0|new'}
+        api._auth0.tickets.create_pswd_change.return_value = {'ticket': 'https://example.auth0.com/reset'}
+        with mock.patch('api.utilities.outbox.get_management_client', return_value=api):
+            invite_auth0_user(message)
+        self.assertEqual(User.objects.get(pk=user.pk).auth0_id, 'auth0|new')
+        body = api._auth0.users.create.call_args.args[0]
+        self.assertEqual(body['app_metadata'], {'user_id': str(user.pk)})
+
+        #a retry finds the tagged account instead of creating another one
+        accounts.append({'user_id': 'auth0|new', 'identities': [{'connection': 'Username-Password-Authentication'}], 'app_metadata': {'user_id': str(user.pk)}})
+        User.objects.filter(pk=user.pk).update(auth0_id=PENDING_AUTH0_ID_PREFIX + 'new')
+        with mock.patch('api.utilities.outbox.get_management_client', return_value=api):
+            invite_auth0_user(message)
+        self.assertEqual(User.objects.get(pk=user.pk).auth0_id, 'auth0|new')
+        self.assertEqual(api._auth0.users.create.call_count, 1)
+
+
+#--------------- Email -----------------------
+
+class SMTPSinkHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode())
+
+    def handle(self):
+        with self.server.lock:
+            self.server.connections += 1
+        self.reply('220 localhost SMTP sink')
+        recipients = []
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode().strip()
+            verb = command[:4].upper()
+            if verb == 'MAIL':
+                recipients = []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                if 'reject' in command:
+                    self.reply('550 Mailbox unavailable')
+                else:
+                    recipients.append(command.split(':', 1)[1].strip('<> '))
+                    self.reply('250 OK')
+            elif verb == 'DATA':
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = b''.join(iter(lambda: self.rfile.readline(), b'.\r\n'))
+                with self.server.lock:
+                    self.server.messages.append((recipients, data))
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                #EHLO/HELO, RSET and NOOP
+                self.reply('250 localhost')
+
+
+class SMTPSink(socketserver.ThreadingTCPServer):
+    '''
+    Local SMTP server keeping every message it receives (as (recipients, data) in `messages`), recipients
+    containing 'reject' are refused. Use as a context manager, EMAIL_HOST/EMAIL_PORT point at it while it runs.
+    '''
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), SMTPSinkHandler)
+        self.lock = threading.Lock()
+        self.messages = []
+        self.connections = 0
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        self.settings = override_settings(EMAIL_BACKEND='django.core.mail.backends.smtp.EmailBackend', EMAIL_HOST='127.0.0.1',
+            EMAIL_PORT=self.server_address[1], EMAIL_HOST_USER='', EMAIL_HOST_PASSWORD='', EMAIL_USE_TLS=False, EMAIL_USE_SSL=False)
+        self.settings.enable()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.settings.disable()
+        self.shutdown()
+        self.server_close()
+
+
+class EmailDeliveryTests(EndpointTestCase):
+    def invite(self, to_email):
+        return invite_email(to_email, 'Admin', self.admin.email, 'https://example.com/reset')
+
+    def test_batch_is_sent_over_one_connection(self):
+        with SMTPSink() as sink:
+            statuses = EmailDelivery().send([self.invite('new{}@example.com'.format(i)) for i in range(5)])
+        self.assertEqual([status['status'] for status in statuses], ['sent'] * 5)
+        self.assertEqual([recipients for recipients, _ in sink.messages], [['new{}@example.com'.format(i)] for i in range(5)])
+        self.assertEqual(sink.connections, 1)
+
+    def test_refused_recipient_only_fails_its_message(self):
+        with SMTPSink() as sink, self.assertLogs('api.utilities.mailer', 'WARNING'):
+            statuses = EmailDelivery().send([self.invite(email) for email in ['new@example.com', 'reject@example.com', 'other@example.com']])
+        self.assertEqual([status['status'] for status in statuses], ['sent', 'failed', 'sent'])
+        self.assertEqual(len(sink.messages), 2)
+
+    def test_outbox_invite_emails(self):
+        messages = [OutboxMessage.objects.create(kind='email.invite', idempotency_key='email.invite:{}'.format(email), payload={
+            'to_email': email, 'sender_name': 'Admin', 'sender_email': self.admin.email, 'redirect_url': 'https://example.com/reset'})
+            for email in ['new@example.com', 'reject@example.com']]
+        with SMTPSink() as sink, mock.patch('api.utilities.outbox.get_email_delivery', return_value=EmailDelivery()), self.assertLogs('api.utilities.mailer', 'WARNING'):
+            errors = send_invite_emails(messages)
+        #only the refused message is retried
+        self.assertEqual(list(errors), [messages[1].id])
+        self.assertEqual(len(sink.messages), 1)
+        self.assertIn(b'https://example.com/reset', sink.messages[0][1])
+
+
+#--------------- API tokens -----------------------
+
+class CreateApiTokenTests(EndpointTestCase):
+    def test_issues_token_to_auth0_managed_user(self):
+        self.assertFalse(Token.objects.filter(user=self.member).exists())
+        out = io.StringIO()
+        call_command('create_api_token', 'Member@example.com', stdout=out)
+        token = Token.objects.get(user=self.member)
+        self.assertEqual(out.getvalue().strip(), token.key)
+
+        #the same token is printed again and authenticates the user
+        out = io.StringIO()
+        call_command('create_api_token', self.member.email, stdout=out)
+        self.assertEqual(out.getvalue().strip(), token.key)
+        self.client.credentials(HTTP_AUTHORIZATION='Token ' + token.key)
+        self.assertEqual(self.client.get('/users/{}'.format(self.member.pk)).status_code, 200)
+
+    def test_unknown_email(self):
+        with self.assertRaises(CommandError):
+            call_command('create_api_token', 'unknown@example.com', stdout=io.StringIO())
+
+
+#--------------- Bulk user provisioning -----------------------
+
+class BulkCreateUsersTests(EndpointTestCase):
+    def test_row_conflicts(self):
+        rows = [
+            {'email': 'Member@example.com'},
+            {'email': 'new@example.com', 'auth0_id': 'auth0|new', 'timezone': 'UTC', 'memberships': [{'organization_id': self.organization.pk, 'role': 'user'}]},
+            {'email': 'NEW@example.com', 'auth0_id': 'auth0|new-again', 'timezone': 'UTC'},
+            {'email': 'no-account@example.com', 'timezone': 'UTC'},
+            {'email': 'same-account@example.com', 'auth0_id': 'auth0|new', 'timezone': 'UTC'},
+            {'email': 'taken-account@example.com', 'auth0_id': 'auth0|admin@example.com', 'timezone': 'UTC'},
+            {'email': 'password@example.com', 'auth0_id': 'auth0|password', 'timezone': 'UTC', 'password': 'secret'},
+            {'email': 'superuser@example.com', 'auth0_id': 'auth0|superuser', 'timezone': 'UTC', 'is_superuser': True, 'nickname': 'root'},
+            {'email': ''},
+        ]
+        results = User.objects.bulk_create_users(rows)
+        self.assertEqual([(result['status'], result['errors']) for result in results], [
+            ('existing', []),
+            ('created', []),
+            ('conflict', ['Duplicate email']),
+            ('conflict', ['auth0_id must be set for new users']),
+            ('conflict', ['Duplicate auth0_id']),
+            ('conflict', ['auth0_id belongs to another user']),
+            ('conflict', ['Unknown or protected fields: password']),
+            ('conflict', ['Unknown or protected fields: is_superuser, nickname']),
+            ('conflict', ['The given email must be set']),
+        ])
+        self.assertEqual(str(results[0]['user'].pk), str(self.member.pk))
+        self.assertEqual(list(User.objects.filter_emails([row['email'] for row in rows[1:-1]]).values_list('email', flat=True)), ['new@example.com'])
+        self.assertEqual(OrganizationMembership.objects.filter(user__email='new@example.com').count(), 1)
+
+        with self.assertRaises(ValueError):
+            User.objects.bulk_create_users(rows[:1], update_fields=['password'])
+
+    def test_rerun_is_idempotent(self):
+        rows = [{'email': 'new{}@example.com'.format(i), 'auth0_id': 'auth0|new{}'.format(i), 'timezone': 'UTC', 'first_name': 'New',
+                 'memberships': [{'organization_id': self.organization.pk, 'role': 'user'}]} for i in range(3)]
+        self.assertEqual({result['status'] for result in User.objects.bulk_create_users(rows)}, {'created'})
+        users = User.objects.count()
+        memberships = OrganizationMembership.objects.count()
+        versions = dict(Organization.objects.values_list('id', 'members_version'))
+
+        #emails differing in case are the same users
+        rows[0]['email'] = 'NEW0@example.com'
+        results = User.objects.bulk_create_users(rows, update_fields=['first_name'])
+        self.assertEqual([(result['status'], result['memberships_created']) for result in results], [('existing', 0)] * 3)
+        self.assertEqual((User.objects.count(), OrganizationMembership.objects.count()), (users, memberships))
+        self.assertEqual(dict(Organization.objects.values_list('id', 'members_version')), versions)
+
+    def test_updated_users_change_their_organizations_members_version(self):
+        versions = dict(Organization.objects.values_list('id', 'members_version'))
+        results = User.objects.bulk_create_users([{'email': self.member.email, 'first_name': 'Renamed'}], update_fields=['first_name'])
+        self.assertEqual(results[0]['status'], 'existing')
+        self.assertEqual(User.objects.get(pk=self.member.pk).first_name, 'Renamed')
+
+        changed = {pk for pk, version in Organization.objects.values_list('id', 'members_version') if versions[pk] != version}
+        self.assertEqual(changed, {str(self.organization.pk)})
+
+    def test_unchanged_users_dont_change_versions(self):
+        User.objects.filter(pk=self.member.pk).update(first_name='Member')
+        versions = dict(Organization.objects.values_list('id', 'members_version'))
+        User.objects.bulk_create_users([{'email': self.member.email, 'first_name': 'Member'}], update_fields=['first_name'])
+        self.assertEqual(dict(Organization.objects.values_list('id', 'members_version')), versions)
+
+
+#--------------- Auth0 authentication -----------------------
+
+@override_settings(AUTH0_IDENTITY_RESOLUTION='claims')
+class LinkUserByEmailTests(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        auth0_auth.userinfo_cache.clear()
+        self.addCleanup(auth0_auth.userinfo_cache.clear)
+
+    #resolves the user of a token for `subject` whose /userinfo has the verified email
+    def resolve(self, subject, email):
+        userinfo = {'sub': subject, 'email': email, 'email_verified': True}
+        with mock.patch('auth0_auth.get_auth0_user_data', return_value=userinfo):
+            return auth0_auth.get_user_from_claims('token', {'sub': subject})
+
+    def test_links_user_without_auth0_account(self):
+        for auth0_id in (PENDING_AUTH0_ID_PREFIX + 'invite', ''):
+            with self.subTest(auth0_id=auth0_id):
+                User.objects.filter(pk=self.member.pk).update(auth0_id=auth0_id)
+                self.assertEqual(str(self.resolve('auth0|new' + auth0_id, self.member.email).pk), str(self.member.pk))
+                self.assertEqual(User.objects.get(pk=self.member.pk).auth0_id, 'auth0|new' + auth0_id)
+
+    def test_doesnt_relink_user_of_another_identity(self):
+        self.assertIsNone(self.resolve('google-oauth2|other', self.member.email))
+        self.assertEqual(User.objects.get(pk=self.member.pk).auth0_id, 'auth0|' + self.member.email)
+
+        #the token authentication then fails
+        with mock.patch('auth0_auth.is_valid_auth0token', return_value=({'sub': 'google-oauth2|other', 'gty': None}, True)), \
+             mock.patch('auth0_auth.get_auth0_user_data', return_value={'sub': 'google-oauth2|other', 'email': self.member.email, 'email_verified': True}):
+            with self.assertRaises(AuthenticationFailed):
+                auth0_auth.Auth0TokenAuthentication().authenticate_credentials('token')
+
+
+class VerifiedTokenCacheTests(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        self.cache = auth0_auth.verified_token_cache
+        self.cache.clear()
+        self.addCleanup(self.cache.clear)
+        self.payload = {'sub': self.member.auth0_id, 'exp': time.time() + 3600}
+
+    def cache_member(self, token):
+        generation = self.cache.generation
+        self.cache.set(token, self.payload, User.objects.get(pk=self.member.pk), generation)
+
+    def test_evicted_on_save_and_delete(self):
+        self.cache_member('token')
+        self.cache_member('other-token')
+        self.assertEqual(self.cache.get('token')[1].email, self.member.email)
+
+        User.objects.get(pk=self.member.pk).save()
+        self.assertIsNone(self.cache.get('token'))
+        self.assertIsNone(self.cache.get('other-token'))
+
+        self.cache_member('token')
+        User.objects.filter(pk=self.member.pk).delete()
+        self.assertIsNone(self.cache.get('token'))
+
+    def test_user_saved_while_authenticating_isnt_cached(self):
+        def load_then_save(token, payload):
+            user = User.objects.get(pk=self.member.pk)
+            #another request deactivates the user before the loaded one is cached
+            User.objects.filter(pk=self.member.pk).update(is_active=False)
+            User.objects.get(pk=self.member.pk).save()
+            return user
+
+        with mock.patch('auth0_auth.is_valid_auth0token', return_value=(self.payload, True)), \
+             mock.patch('auth0_auth.get_user_from_claims', side_effect=load_then_save) as get_user:
+            auth0_auth.Auth0TokenAuthentication().authenticate_credentials('token')
+            self.assertIsNone(self.cache.get('token'))
+            #the next request loads the user again and sees the change
+            get_user.side_effect = lambda token, payload: User.objects.get(pk=self.member.pk)
+            user, _ = auth0_auth.Auth0TokenAuthentication().authenticate_credentials('token')
+        self.assertFalse(user.is_active)
+        self.assertEqual(get_user.call_count, 2)
+
+    def test_inactive_users_arent_cached(self):
+        User.objects.filter(pk=self.member.pk).update(is_active=False)
+        self.cache_member('token')
+        self.assertIsNone(self.cache.get('token'))
+
+
+class ClientIdentityCacheTests(EndpointTestCase):
+    def setUp(self):
+        super().setUp()
+        auth0_auth.client_identity_cache.clear()
+        self.addCleanup(auth0_auth.client_identity_cache.clear)
+        clients = {
+            'admin-client': {'user_email': self.admin.email, 'auth0_user_id': self.admin.auth0_id},
+            'member-client': {'user_email': self.member.email, 'auth0_user_id': self.member.auth0_id},
+            'unknown-client': {'user_email': 'unknown@example.com', 'auth0_user_id': 'auth0|unknown'},
+        }
+        patcher = mock.patch('auth0_auth.get_auth0_client_application_meta_data', side_effect=lambda client_id: clients[client_id])
+        self.metadata = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    #the clients fetched from the management api (not the cache) while calling func
+    def fetched(self, func):
+        self.metadata.reset_mock()
+        func()
+        return [call.args[0] for call in self.metadata.call_args_list]
+
+    def identities(self, *client_ids):
+        return [auth0_auth.get_client_application_identity(client_id) for client_id in client_ids]
+
+    def test_metadata_is_cached(self):
+        identities = self.identities('admin-client', 'unknown-client')
+        self.assertEqual(identities, [(self.admin.email, self.admin.auth0_id, str(self.admin.pk)), None])
+        #clients without a user are remembered too
+        self.assertEqual(self.fetched(lambda: self.assertEqual(self.identities('admin-client', 'unknown-client'), identities)), [])
+
+    def test_user_changes_only_drop_their_clients(self):
+        self.identities('admin-client', 'member-client', 'unknown-client')
+        User.objects.get(pk=self.member.pk).save()
+        self.assertEqual(self.fetched(lambda: self.identities('admin-client', 'member-client', 'unknown-client')), ['member-client'])
+
+        User.objects.filter(pk=self.admin.pk).delete()
+        self.assertEqual(self.fetched(lambda: self.identities('admin-client', 'member-client')), ['admin-client'])
+
+        with self.captureOnCommitCallbacks(execute=True):
+            User.objects.bulk_create_users([{'email': self.member.email, 'first_name': 'Renamed'}], update_fields=['first_name'])
+        self.assertEqual(self.fetched(lambda: self.identities('member-client', 'unknown-client')), ['member-client'])
+
+    def test_invalidate_client_application_identity(self):
+        self.identities('admin-client', 'member-client')
+        auth0_auth.invalidate_client_application_identity('admin-client')
+        self.assertEqual(self.fetched(lambda: self.identities('admin-client', 'member-client')), ['admin-client'])
+        auth0_auth.invalidate_client_application_identity()
+        self.assertEqual(self.fetched(lambda: self.identities('admin-client', 'member-client')), ['admin-client', 'member-client'])
+
+
+#--------------- Auth0 management api -----------------------
+
+class Auth0ManagementAPITests(SimpleTestCase):
+    def test_management_calls_use_the_pooled_session(self):
+        api = Auth0ManagmentAPI('client-id', 'client-secret', 'example.auth0.com')
+        api.session = mock.Mock()
+        api.session.post.return_value.json.return_value = {'access_token': 'management-token', 'expires_in': 86400}
+        api.session.request.return_value = mock.Mock(status_code=200, headers={},
+            text='[{"user_id": "auth0|member", "identities": [{"connection": "Username-Password-Authentication"}]}]')
+
+        with mock.patch('requests.request') as request, mock.patch('requests.get') as get:
+            self.assertEqual(api.get_user_id_by_email('member@example.com'), 'auth0|member')
+            self.assertEqual(api.get_user_id_by_email('member@example.com'), 'auth0|member')
+        request.assert_not_called()
+        get.assert_not_called()
+
+        #one token request, then both searches over the same session with the token
+        api.session.post.assert_called_once()
+        self.assertEqual(api.session.request.call_count, 2)
+        method, url = api.session.request.call_args.args
+        self.assertEqual((method, url), ('get', 'https://example.auth0.com/api/v2/users-by-email'))
+        self.assertEqual(api.session.request.call_args.kwargs['headers']['Authorization'], 'Bearer management-token')
+
+
+#--------------- Token broker -----------------------
+
+#an upstream /oauth/token response
+def token_response(status=200, data=None, headers=None):
+    return mock.Mock(status_code=status, headers=headers or {}, json=mock.Mock(return_value=data if data is not None else {}))
+
+
+class TokenBrokerTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        clock = mock.Mock(time=lambda: self.now, monotonic=lambda: self.now)
+        for module in ('api.utilities.token_broker.time', 'api.utilities.ttl_cache.time'):
+            patcher = mock.patch(module, clock)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def broker(self, **kwargs):
+        broker = token_broker.ClientCredentialsTokenBroker('example.auth0.com', 'https://api.example.com', **kwargs)
+        broker.session = mock.Mock()
+        broker.session.post.side_effect = lambda url, json, timeout: token_response(data={
+            'access_token': 'token-{}-{}'.format(json['client_id'], broker.session.post.call_count), 'expires_in': 3600})
+        return broker
+
+    def test_reuses_token_per_key(self):
+        broker = self.broker()
+        status, data, retry_after = broker.get_token('client', 'secret')
+        self.assertEqual((status, data['access_token'], data['expires_in'], retry_after), (200, 'token-client-1', 3600, None))
+
+        self.now += 600
+        self.assertEqual(broker.get_token('client', 'secret')[1], {'access_token': 'token-client-1', 'expires_in': 3000})
+        #another secret or client is another key
+        self.assertEqual(broker.get_token('client', 'rotated-secret')[1]['access_token'], 'token-client-2')
+        self.assertEqual(broker.get_token('other-client', 'secret')[1]['access_token'], 'token-other-client-3')
+        self.assertEqual(broker.session.post.call_count, 3)
+
+        #a token isnt handed out within the leeway of its expiry
+        self.now += 3000 - broker.leeway
+        self.assertEqual(broker.get_token('client', 'secret')[1]['access_token'], 'token-client-4')
+
+    def test_concurrent_identical_requests_make_one_upstream_call(self):
+        broker = self.broker()
+        followers = 4
+        waiting = threading.Semaphore(0)
+
+        #the upstream call only returns once every other request is waiting on it
+        class WaitedCall(token_broker._Call):
+            def __init__(self):
+                super().__init__()
+                wait = self.event.wait
+                def counted_wait(timeout=None):
+                    waiting.release()
+                    return wait(timeout)
+                self.event.wait = counted_wait
+
+        def post(url, json, timeout):
+            for _ in range(followers):
+                self.assertTrue(waiting.acquire(timeout=5))
+            return token_response(data={'access_token': 'shared', 'expires_in': 3600})
+        broker.session.post.side_effect = post
+
+        results = []
+        with mock.patch.object(token_broker, '_Call', WaitedCall):
+            threads = [threading.Thread(target=lambda: results.append(broker.get_token('client', 'secret'))) for _ in range(followers + 1)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(5)
+
+        self.assertEqual(broker.session.post.call_count, 1)
+        self.assertEqual([data['access_token'] for _, data, _ in results], ['shared'] * (followers + 1))
+        self.assertEqual(broker._calls, {})
+
+    def test_throttle_is_cached_until_retry_after(self):
+        broker = self.broker()
+        broker.session.post.side_effect = [token_response(429, headers={'Retry-After': '30'})]
+        with self.assertLogs('api.utilities.token_broker', 'WARNING'):
+            self.assertEqual(broker.get_token('client', 'secret'), (429, {'retry_after': 30}, 30))
+
+        self.now += 20
+        self.assertEqual(broker.get_token('client', 'secret'), (429, {'retry_after': 30}, 10))
+        self.assertEqual(broker.session.post.call_count, 1)
+
+        self.now += 10
+        broker.session.post.side_effect = [token_response(data={'access_token': 'token', 'expires_in': 3600})]
+        self.assertEqual(broker.get_token('client', 'secret')[0], 200)
+        self.assertEqual(broker.session.post.call_count, 2)
+
+    def test_passthrough(self):
+        broker = self.broker(cache_tokens=False)
+        self.assertEqual(broker.get_token('client', 'secret')[1]['access_token'], 'token-client-1')
+        self.assertEqual(broker.get_token('client', 'secret')[1]['access_token'], 'token-client-2')
+
+        broker.session.post.side_effect = [token_response(429, headers={'Retry-After': '5'})] * 2
+        with self.assertLogs('api.utilities.token_broker', 'WARNING'):
+            self.assertEqual(broker.get_token('client', 'secret'), (429, {'retry_after': 5}, 5))
+            self.assertEqual(broker.get_token('client', 'secret'), (429, {'retry_after': 5}, 5))
+        self.assertEqual(broker.session.post.call_count, 4)
+        self.assertEqual(len(broker.cache), 0)
+
+
+#--------------- JWKS -----------------------
+
+def jwk(kid):
+    return {'kty': 'RSA', 'kid': kid, 'use': 'sig', 'n': 'modulus-' + kid, 'e': 'AQAB', 'alg': 'RS256', 'x5c': ['certificate']}
+
+
+class JWKSStoreTests(SimpleTestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch('api.utilities.jwks.time', mock.Mock(monotonic=lambda: self.now))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.jwks_file = os.path.join(directory.name, 'jwks.json')
+        self.write_keys('first')
+        #no background refresh timer
+        self.store = JWKSStore(jwks_file=self.jwks_file, refresh_interval=0, min_refetch_interval=30)
+
+    def write_keys(self, *kids):
+        with open(self.jwks_file, 'w') as f:
+            json.dump({'keys': [jwk(kid) for kid in kids]}, f)
+
+    def test_kid_hit(self):
+        key = self.store.get_key('first')
+        self.assertEqual(key, {'kty': 'RSA', 'kid': 'first', 'use': 'sig', 'n': 'modulus-first', 'e': 'AQAB'})
+        #later lookups are served from the index without reading the key set again
+        with mock.patch.object(self.store, '_load') as load:
+            self.assertEqual(self.store.get_key('first'), key)
+        load.assert_not_called()
+        self.assertEqual(self.store.get_metrics(), {'hits': 1, 'misses': 1, 'refreshes': 1, 'refresh_failures': 0, 'keys': 1})
+
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        self.store.get_key('first')
+        #the keys rotate
+        self.write_keys('first', 'second')
+        self.now += 10
+        self.assertIsNone(self.store.get_key('second'))
+        self.assertIsNone(self.store.get_key('made-up'))
+        self.assertEqual(self.store.get_metrics()['refreshes'], 1)
+
+        self.now += 20
+        self.assertEqual(self.store.get_key('second')['kid'], 'second')
+        self.assertEqual(self.store.get_metrics()['refreshes'], 2)
+        #an unknown kid right after the refetch doesnt fetch again
+        self.assertIsNone(self.store.get_key('made-up'))
+        self.assertEqual(self.store.get_metrics()['refreshes'], 2)
+
+    def test_keeps_keys_when_refresh_fails(self):
+        self.store.refresh()
+        with open(self.jwks_file, 'w') as f:
+            f.write('not json')
+        with self.assertLogs('api.utilities.jwks', 'WARNING'):
+            self.store.refresh()
+        self.assertEqual(self.store.get_key('first')['kid'], 'first')
+        self.assertEqual(self.store.get_metrics()['refresh_failures'], 1)
+
+        #an unknown kid after the failed refresh waits for the rate limit too
+        self.write_keys('second')
+        self.assertIsNone(self.store.get_key('second'))
+        self.now += 30
+        self.assertEqual(self.store.get_key('second')['kid'], 'second')
+
+
+#--------------- Renderers -----------------------
+
+class FastJSONTests(SimpleTestCase):
+    DATA = {
+        'id': uuid.UUID('12345678-1234-5678-1234-567812345678'),
+        'amount': decimal.Decimal('10.50'),
+        'label': gettext_lazy('Organization admin'),
+        'created': dt.datetime(2024, 1, 2, 3, 4, 5, 678901, tzinfo=dt.timezone.utc),
+        'updated': dt.datetime(2024, 1, 2, 3, 4, 5),
+        'offset': dt.datetime(2024, 1, 2, 3, 4, 5, 120000, tzinfo=dt.timezone(dt.timedelta(hours=2))),
+        'joined': dt.date(2024, 1, 2),
+        'expires': None,
+        'tags': ('a', 'é', 'line\u2028separator'),
+        'counts': {1: True, 'total': 3},
+    }
+
+    #runs the test once with orjson and once without it
+    def variants(self):
+        modules = [None] if orjson is None else [orjson, None]
+        for module in modules:
+            with self.subTest(orjson=module is not None), mock.patch('api.renderers.orjson', module):
+                yield
+
+    def test_renders_like_drf(self):
+        expected = JSONRenderer().render(self.DATA)
+        #utc is written with a Z suffix and the sub-second part is kept as drf writes it
+        self.assertIn(b'"created":"2024-01-02T03:04:05.678901Z"', expected)
+        self.assertIn(b'"offset":"2024-01-02T03:04:05.120000+02:00"', expected)
+        for _ in self.variants():
+            self.assertEqual(FastJSONRenderer().render(self.DATA), expected)
+            #indented output is left to drf
+            self.assertEqual(FastJSONRenderer().render(self.DATA, 'application/json; indent=2'), JSONRenderer().render(self.DATA, 'application/json; indent=2'))
+            self.assertEqual(FastJSONRenderer().render(None), b'')
+
+    def test_parses_like_drf(self):
+        body = '{"id":"12345678-1234-5678-1234-567812345678","amount":10.5,"name":"é","tags":[1,null,true]}'.encode()
+        for _ in self.variants():
+            self.assertEqual(FastJSONParser().parse(io.BytesIO(body)), JSONParser().parse(io.BytesIO(body)))
+            latin1 = {'encoding': 'latin-1'}
+            self.assertEqual(FastJSONParser().parse(io.BytesIO('{"name":"é"}'.encode('latin-1')), parser_context=latin1), {'name': 'é'})
+            with self.assertRaises(ParseError):
+                FastJSONParser().parse(io.BytesIO(b'{"id":'))
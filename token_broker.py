@@ -0,0 +1,171 @@
+import hashlib
+import logging
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from django.conf import settings
+from api.utilities.ttl_cache import MISSING, TTLCache
+
+logger = logging.getLogger(__name__)
+
+TOKEN_BROKER_CACHE_SIZE = 10000
+TOKEN_BROKER_LEEWAY = 60 #seconds before expiry a cached token stops being handed out
+TOKEN_BROKER_TIMEOUT = 10
+TOKEN_BROKER_POOL_MAXSIZE = 20
+
+
+class _Call:
+    #an in flight upstream token request that concurrent identical requests wait on
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class ClientCredentialsTokenBroker:
+    '''
+    Issues client credentials access tokens from Auth0 on behalf of API clients.
+
+    Upstream requests reuse a pooled keep-alive session. When `cache_tokens` is set a still valid token is
+    returned for the same (client_id, client secret hash, audience) instead of requesting a new one, concurrent
+    identical requests are coalesced into a single upstream call and an Auth0 429 is remembered until its
+    Retry-After has passed so throttled clients dont keep hitting Auth0.
+    '''
+
+    def __init__(self, domain, audience, cache_tokens=True, leeway=TOKEN_BROKER_LEEWAY,
+                 maxsize=TOKEN_BROKER_CACHE_SIZE, timeout=TOKEN_BROKER_TIMEOUT):
+        self.domain = domain
+        self.audience = audience
+        self.cache_tokens = cache_tokens
+        self.leeway = leeway
+        self.timeout = timeout
+        self.cache = TTLCache(maxsize=maxsize)
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=TOKEN_BROKER_POOL_MAXSIZE))
+        self._calls = {}
+        self._lock = threading.Lock()
+
+    def get_token(self, client_id, client_secret):
+        """
+        Gets an access token for a client
+
+        Parameters
+        ----------
+        client_id, client_secret : str
+            The client applications credentials
+        Returns
+        -------
+        (status, data, retry_after) - the upstream status code, response body and the seconds
+        to wait before retrying if the client is being throttled otherwise None
+        """
+        if not self.cache_tokens:
+            status, data, _ = self._request_token(client_id, client_secret)
+            return status, data, data.get('retry_after') if status == 429 else None
+
+        key = self._key(client_id, client_secret)
+        entry = self.cache.get(key)
+        if entry is MISSING:
+            entry = self._coalesced_request(key, client_id, client_secret)
+
+        return self._from_entry(entry)
+
+    def _coalesced_request(self, key, client_id, client_secret):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.event.wait(self.timeout)
+            if call.error is not None:
+                raise call.error
+            if call.result is None:
+                raise requests.Timeout('Timed out waiting for an in flight token request')
+            return call.result
+
+        try:
+            #a previous leader may have cached the token between our cache miss and taking the lock
+            entry = self.cache.get(key)
+            if entry is MISSING:
+                entry = self._request_token(client_id, client_secret)
+                self._cache_entry(key, entry)
+            call.result = entry
+            return entry
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.event.set()
+
+    def _request_token(self, client_id, client_secret):
+        payload = {
+            'client_id': client_id,
+            'client_secret': client_secret,
+            'audience': self.audience,
+            'grant_type': 'client_credentials'
+        }
+        resp = self.session.post('https://{}/oauth/token'.format(self.domain), json=payload, timeout=self.timeout)
+        try:
+            data = resp.json()
+        except ValueError:
+            data = {}
+
+        if resp.status_code == 200:
+            expires_at = time.time() + data.get('expires_in', 0)
+            return 200, data, expires_at
+
+        if resp.status_code == 429:
+            retry_after = self._retry_after(resp)
+            logger.warning('Auth0 throttled token requests for client %s for %s seconds', client_id, retry_after)
+            return 429, {'retry_after': retry_after}, time.time() + retry_after
+
+        return resp.status_code, data, None
+
+    def _cache_entry(self, key, entry):
+        status, data, expires_at = entry
+        if status == 200:
+            self.cache.set(key, entry, ttl=expires_at - time.time() - self.leeway)
+        elif status == 429:
+            self.cache.set(key, entry, ttl=expires_at - time.time())
+
+    #converts a cached entry to a response with the remaining lifetime of the token/throttle
+    def _from_entry(self, entry):
+        status, data, expires_at = entry
+        remaining = max(int(expires_at - time.time()), 0) if expires_at else None
+        if status == 200:
+            return status, dict(data, expires_in=remaining), None
+        if status == 429:
+            return status, data, remaining
+        return status, data, None
+
+    def _key(self, client_id, client_secret):
+        secret_hash = hashlib.sha256(client_secret.encode()).hexdigest()
+        return (client_id, secret_hash, self.audience)
+
+    @staticmethod
+    def _retry_after(resp):
+        try:
+            return max(int(resp.headers.get('Retry-After', 1)), 1)
+        except ValueError:
+            return 1
+
+
+_token_broker = None
+_token_broker_lock = threading.Lock()
+
+#returns the process wide token broker created from settings on first use
+def get_token_broker():
+    global _token_broker
+    if _token_broker is None:
+        with _token_broker_lock:
+            if _token_broker is None:
+                _token_broker = ClientCredentialsTokenBroker(
+                    settings.AUTH0_DOMAIN,
+                    settings.AUTH0_API_AUDIENCE,
+                    cache_tokens=getattr(settings, 'AUTH0_TOKEN_BROKER_CACHE', True),
+                    leeway=getattr(settings, 'AUTH0_TOKEN_BROKER_LEEWAY', TOKEN_BROKER_LEEWAY))
+    return _token_broker
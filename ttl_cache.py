@@ -0,0 +1,87 @@
+import threading
+import time
+from collections import OrderedDict
+
+#returned by get() on a cache miss so cached falsy values (e.g negative cache entries) can be told apart from misses
+MISSING = object()
+
+
+class TTLCache:
+    '''
+    Thread safe in-process LRU cache where every entry has its own expiry.
+
+    Entries are evicted least recently used first once `maxsize` is reached and are dropped
+    lazily when read after they expire. `ttl` is the default lifetime in seconds for set(),
+    None means entries only leave the cache through LRU eviction or delete().
+
+    `on_remove(key, value)` is called (while the cache lock is held) for every entry that is evicted,
+    expires, is replaced or is removed with delete(), e.g to maintain a secondary index.
+    '''
+
+    def __init__(self, maxsize=1024, ttl=None, on_remove=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_remove = on_remove
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.metrics = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    def get(self, key, default=MISSING):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.metrics['misses'] += 1
+                return default
+
+            expires_at, value = entry
+            if expires_at is not None and expires_at <= time.monotonic():
+                del self._data[key]
+                self._removed(key, value)
+                self.metrics['expirations'] += 1
+                self.metrics['misses'] += 1
+                return default
+
+            self._data.move_to_end(key)
+            self.metrics['hits'] += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        #nothing to cache if the value is already expired
+        if ttl is not None and ttl <= 0:
+            return
+
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            previous = self._data.get(key)
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            if previous is not None:
+                self._removed(key, previous[1])
+            while len(self._data) > self.maxsize:
+                evicted_key, (_, evicted) = self._data.popitem(last=False)
+                self._removed(evicted_key, evicted)
+                self.metrics['evictions'] += 1
+
+    def delete(self, key):
+        with self._lock:
+            entry = self._data.pop(key, None)
+            if entry is not None:
+                self._removed(key, entry[1])
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def get_metrics(self):
+        with self._lock:
+            metrics = dict(self.metrics)
+            metrics['size'] = len(self._data)
+        return metrics
+
+    def _removed(self, key, value):
+        if self.on_remove is not None:
+            self.on_remove(key, value)
+
+    def __len__(self):
+        return len(self._data)
@@ -1,5 +1,6 @@
 import requests 
-import http.client
+import csv
+import hashlib
 import json
 from django.shortcuts import render
 from rest_framework.exceptions import *
@@ -7,11 +8,20 @@ from rest_framework import viewsets
 from rest_framework.decorators import action
 from rest_access_policy import AccessViewSetMixin
 from api.permissions.roles import *
+from api.permissions.roles import PrincipalContext
+#the star import of api.permissions.roles (through api.models) shadows the rest framework ValidationError with djangos
+from rest_framework.exceptions import ValidationError
 from api import serializers
 from django.conf import settings
 from rest_framework.response import Response
 from authlib.integrations.django_oauth2 import ResourceProtector
-from django.http import JsonResponse
+from django.http import JsonResponse, StreamingHttpResponse
+from rest_framework.utils.encoders import JSONEncoder
+from django.core.cache import cache
+from django.utils.http import parse_etags, quote_etag
+from api.models import Organization
+from api.utilities.token_broker import get_token_broker
+from api.pagination import KeysetPagination, count_version_is_shared, get_count_version
 import os
 import auth0
 
@@ -22,8 +32,56 @@ validator = auth0_validator.Auth0JWTBearerTokenValidator(
 )
 require_auth.register_token_validator(validator)
 
+EXPORT_CHUNK_SIZE = 2000 #rows fetched from the database cursor and written to the response at a time
+EXPORT_FORMATS = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+#text cells starting with these are evaluated as formulas when the csv is opened in a spreadsheet
+CSV_FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+#file like object that returns what is written to it so csv.writer can build lines for a streaming response
+class _Echo:
+    def write(self, value):
+        return value
+
+#yields the rendered rows as newline delimited json in chunks
+def _ndjson_chunks(items, chunk_size):
+    encoder = JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    lines = []
+    for item in items:
+        lines.append(encoder.encode(item) + '\n')
+        if len(lines) >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
+#quotes text that a spreadsheet would run as a formula (csv injection) so it is shown as the text it is
+def _csv_cell(value):
+    if isinstance(value, str) and value.startswith(CSV_FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+#yields the rendered rows as csv (with a header row) in chunks
+def _csv_chunks(items, fields, chunk_size):
+    writer = csv.writer(_Echo())
+    lines = [writer.writerow(fields)]
+    for item in items:
+        lines.append(writer.writerow([_csv_cell(item[field]) for field in fields]))
+        if len(lines) >= chunk_size:
+            yield ''.join(lines)
+            lines = []
+    if lines:
+        yield ''.join(lines)
+
 #overides model viewset to include getting scoped queryset and permissioned orgs 
 class ModelViewSet_(viewsets.ModelViewSet):
+    #version (etag and cache) lists that arent limited to any organizations (system admins), only safe if every listed resource belongs to an organization
+    unscoped_list_etags = True
+    #seconds list responses are cached for, None uses settings.LIST_RESPONSE_CACHE_TIMEOUT (0 disables)
+    list_cache_timeout = None
     
     #returns existing resources users has permission
     def get_queryset(self, request, action, organization_id=None):
@@ -33,7 +91,7 @@ class ModelViewSet_(viewsets.ModelViewSet):
             role_scoped=True,
             organization_id=organization_id)
 
-    #used to get organizations user has permmission to access and edit resources for
+    #used to get organizations user has permmission to access and edit resources for, a lazy subquery of ids (None for system admins)
     def permissed_orgs(self, request, action, organization_id=None):
         return self.access_policy().get_permissioned_organizations(
             request=request, 
@@ -41,10 +99,140 @@ class ModelViewSet_(viewsets.ModelViewSet):
             role_scoped=True,
             organization_id=organization_id)
 
+    #paginates and serializes a list endpoints queryset, rendering from .values() rows when the serializer supports it
+    def paginated_list_response(self, serializer_class, queryset, prefetch=()):
+        #sparse fieldsets (?fields=) narrow both the columns selected and the serialized fields
+        fields = serializer_class.requested_fields(self.request)
+        #keyset pagination reads its cursor keys from each row so they must be fetched too
+        keys = []
+        if isinstance(self.paginator, KeysetPagination):
+            keys = list(getattr(self, 'keyset_ordering', self.paginator.ordering))
+
+        sources = serializer_class.values_sources(fields)
+        if sources is None:
+            if fields is not None:
+                queryset = queryset.only(*dict.fromkeys(serializer_class.only_fields(fields) + keys))
+            #nested relations are batch loaded for the page, the .values() path never renders them
+            if prefetch:
+                queryset = queryset.prefetch_related(*prefetch)
+            page = self.paginate_queryset(queryset)
+            data = serializer_class(page, many=True, fields=fields).data
+        else:
+            page = self.paginate_queryset(queryset.values(*dict.fromkeys(sources + keys)))
+            data = serializer_class.from_values(page, fields)
+        return self.get_paginated_response(data)
+
+    #returns the (id, version, members_version) of the organizations in the requesters scope, a single global stamp when
+    # every organization is in scope, None if the list cant be versioned
+    def list_stamps(self, action, organization_id=None):
+        scope = self.access_policy().get_organization_scope(self.request, True, action, organization_id)
+        #unscoped lists can include resources outside of every organization (e.g users without memberships)
+        if scope is None and not self.unscoped_list_etags:
+            return None
+
+        #every organization is in scope so the global version (changed by any organization, membership or user change)
+        # stands in for their stamps instead of loading every organization. Only when the cache is shared by all workers,
+        # with a per process cache other workers would never see the change so every organizations stamps are loaded instead
+        organizations = Organization.objects.all()
+        if scope is None:
+            if count_version_is_shared():
+                return [('*', get_count_version())]
+        else:
+            organizations = organizations.filter(id__in=scope)
+        return list(organizations.order_by('id').values_list('id', 'version', 'members_version'))
+
+    #conditional (etag) and optionally cached response for a list action
+    def list_response(self, action, organization_id, get_response):
+        stamps = self.list_stamps(action, organization_id)
+        etag = None if stamps is None else self.make_etag(action, stamps)
+        return self.conditional_response(etag, lambda: self.cached_list_response(action, stamps, get_response))
+
+    def cached_list_response(self, action, stamps, get_response):
+        """
+        Gets a list response from the response cache, building and caching it on a miss
+
+        Responses are keyed by the organizations in the requesters scope together with their versions and the
+        normalized url so principals only share a response when they have the same scope, and any change to an
+        organization, its members or memberships changes the key. Disabled unless list_cache_timeout
+        (or settings.LIST_RESPONSE_CACHE_TIMEOUT) is set.
+        """
+        timeout = self.list_cache_timeout if self.list_cache_timeout is not None else getattr(settings, 'LIST_RESPONSE_CACHE_TIMEOUT', None)
+        if not timeout or stamps is None:
+            return get_response()
+
+        params = sorted((k, sorted(v)) for k, v in self.request.query_params.lists())
+        fingerprint = repr((type(self).__name__, action, stamps, self.request.get_host(), self.request.path, params))
+        key = 'list_response:' + hashlib.sha256(fingerprint.encode()).hexdigest()
+        data = cache.get(key)
+        if data is not None:
+            return Response(data, status=200, content_type='application/json')
+
+        response = get_response()
+        if response.status_code == 200:
+            cache.set(key, response.data, timeout)
+        return response
+
+    #loads only the columns backing the requested fields (?fields=), every column when no fields were requested
+    def only_requested(self, queryset, serializer_class, fields):
+        if fields is None:
+            return queryset
+        return queryset.only(*serializer_class.only_fields(fields))
+
+    #returns the etag of a resource in the scoped queryset with a single indexed lookup, None if it isnt in the scope
+    def retrieve_etag(self, pk):
+        version = self.queryset.filter(pk=pk).prefetch_related(None).values_list('version', flat=True).first()
+        return None if version is None else self.make_etag('retrieve', version)
+
+    #responses also depend on the requesters memberships and the url (filters, pages, fields) so they are part of the etag
+    def make_etag(self, action, stamps):
+        context = PrincipalContext.for_request(self.request)
+        key = repr((type(self).__name__, action, context.user.id, context.memberships, self.request.build_absolute_uri(), stamps))
+        return quote_etag(hashlib.sha1(key.encode()).hexdigest())
+
+    #answers 304 if the clients If-None-Match matches the etag, otherwise builds the response and tags it with the etag
+    def conditional_response(self, etag, get_response):
+        if etag is not None:
+            if_none_match = parse_etags(self.request.META.get('HTTP_IF_NONE_MATCH', ''))
+            if etag in if_none_match or '*' in if_none_match:
+                return Response(status=304, headers={'ETag': etag})
+
+        response = get_response()
+        if etag is not None and response.status_code == 200:
+            response['ETag'] = etag
+        return response
+
+    #streams every row of a scoped queryset as ndjson (default) or csv (?export_format=csv) with flat memory use
+    def export_response(self, serializer_class, queryset, filename):
+        export_format = self.request.query_params.get('export_format', 'ndjson')
+        if export_format not in EXPORT_FORMATS:
+            raise ValidationError({'export_format': ['Must be one of: {}'.format(', '.join(EXPORT_FORMATS))]})
+
+        #only fields stored in a column can be exported, nested fields have their own export endpoints
+        fields = serializer_class.requested_fields(self.request) or serializer_class.column_fields()
+        sources = serializer_class.values_sources(fields)
+        if sources is None:
+            raise ValidationError({'fields': ['Nested fields cannot be exported']})
+
+        #rows are read with a server side cursor (where supported) a chunk at a time instead of loading the whole result
+        rows = queryset.order_by('pk').values(*sources).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+        items = serializer_class.iter_values(rows, fields)
+        if export_format == 'csv':
+            content = _csv_chunks(items, fields, EXPORT_CHUNK_SIZE)
+        else:
+            content = _ndjson_chunks(items, EXPORT_CHUNK_SIZE)
+
+        response = StreamingHttpResponse(content, content_type=EXPORT_FORMATS[export_format])
+        response['Content-Disposition'] = 'attachment; filename="{}.{}"'.format(filename, export_format)
+        return response
+
     
  class UsersViewSet(AccessViewSetMixin, PermissionedModelViewSet):
     
     access_policy = UsersAccessPolicy
+    #users without any memberships arent covered by an organizations version
+    unscoped_list_etags = False
+    #keys used when KeysetPagination is the pagination class
+    keyset_ordering = ('date_joined', 'id')
 
     #lists all the streams of the users organization
     def list(self, request):
@@ -55,16 +243,32 @@ class ModelViewSet_(viewsets.ModelViewSet):
         service = services.users.UserService(self.request, self.queryset)
         #get all users organizatins 
         users = service.all()
-        data = serializers.UserSerializer(users, many=True).data
-        data = self.paginate_queryset(data)
-        return self.get_paginated_response(data)
+        memberships = self.access_policy().memberships_prefetch(request, 'list', organization_id)
+        #paginate in the database before serializing so only the page is fetched
+        return self.list_response('list', organization_id, lambda: self.paginated_list_response(serializers.UserSerializer, users, prefetch=[memberships]))
+
+    #streams all users the requester has access to (?organization_id= to limit to organizations)
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        serializer = serializers.GenericListSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        organization_id = serializer.validated_data.get('organization_id')
+        self.queryset = self.get_queryset(request, 'export', organization_id=organization_id)
+        service = services.users.UserService(self.request, self.queryset)
+        return self.export_response(serializers.UserSerializer, service.all(), 'users')
 
     #retrieves a user
     def retrieve(self, request, pk):
-        self.queryset = self.get_queryset(request, 'retrieve')
+        fields = serializers.UserSerializer.requested_fields(request)
+        self.queryset = self.only_requested(self.get_queryset(request, 'retrieve'), serializers.UserSerializer, fields)
+        if fields is None or 'memberships' in fields:
+            self.queryset = self.queryset.prefetch_related(self.access_policy().memberships_prefetch(request, 'retrieve'))
         service = services.users.UserService(self.request, self.queryset)
+        return self.conditional_response(self.retrieve_etag(pk), lambda: self._retrieve(service, pk, fields))
+
+    def _retrieve(self, service, pk, fields):
         user = service.get_or_raise(pk)
-        data = serializers.UserSerializer(user).data
+        data = serializers.UserSerializer(user, fields=fields).data
         return Response(data, status=200, content_type='application/json')
     
     #updates an existing user
@@ -92,9 +296,7 @@ class OrganizationsViewSet(AccessViewSetMixin, ModelViewSet_):
         self.queryset = self.get_queryset(request, 'list')
         service = services.organizations.OrganizationService(self.request, self.queryset)
         organizations = service.all()
-        data = serializers.OrganizationSerializer(organizations, many=True).data
-        data = self.paginate_queryset(data)
-        return self.get_paginated_response(data)
+        return self.list_response('list', None, lambda: self.paginated_list_response(serializers.OrganizationSerializer, organizations))
 
     #creates a new organization
     def create(self, request):
@@ -109,10 +311,14 @@ class OrganizationsViewSet(AccessViewSetMixin, ModelViewSet_):
 
     #retrieves an organization
     def retrieve(self, request, pk):
-        self.queryset = self.get_queryset(request, 'retrieve')
+        fields = serializers.OrganizationSerializer.requested_fields(request)
+        self.queryset = self.only_requested(self.get_queryset(request, 'retrieve'), serializers.OrganizationSerializer, fields)
         service = services.organizations.OrganizationService(self.request, self.queryset)
+        return self.conditional_response(self.retrieve_etag(pk), lambda: self._retrieve(service, pk, fields))
+
+    def _retrieve(self, service, pk, fields):
         organization = service.get_or_raise(pk)
-        data = serializers.OrganizationSerializer(organization).data
+        data = serializers.OrganizationSerializer(organization, fields=fields).data
         return Response(data, status=200, content_type='application/json')
     
     #updates an existing organization
@@ -145,9 +351,18 @@ class OrganizationMembershipViewSet(AccessViewSetMixin, PermissionedModelViewSet
         self.queryset = self.get_queryset(request, 'list', organization_id)
         service = services.organization_memberships.OrganizationMembershipService(self.request, self.queryset)
         memberships = service.all(serializer.validated_data)
-        data = serializers.OrganizationMembershipSerializer(memberships, many=True).data
-        data = self.paginate_queryset(data)
-        return self.get_paginated_response(data)
+        return self.list_response('list', organization_id, lambda: self.paginated_list_response(serializers.OrganizationMembershipSerializer, memberships))
+
+    #streams all memberships the requester has access to (?organization_id=, ?user_id= to filter)
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        serializer = serializers.GenericListSerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        organization_id = serializer.validated_data.get('organization_id')
+        self.queryset = self.get_queryset(request, 'export', organization_id)
+        service = services.organization_memberships.OrganizationMembershipService(self.request, self.queryset)
+        memberships = service.all(serializer.validated_data)
+        return self.export_response(serializers.OrganizationMembershipSerializer, memberships, 'organization-memberships')
 
     #creates organization membership and sends an invite email to the user
     def create(self, request):
@@ -158,13 +373,27 @@ class OrganizationMembershipViewSet(AccessViewSetMixin, PermissionedModelViewSet
         service.send_invite(serializer.validated_data)
         return Response(status=204, content_type='application/json')
 
+    #creates organization memberships for a list of invitees and sends each an invite email, returns a result per invitee
+    @action(detail=False, methods=['post'])
+    def bulk_invite(self, request):
+        self.queryset = self.get_queryset(request, 'send_invite')
+        service = services.organization_memberships.OrganizationMembershipService(self.request, self.queryset)
+        serializer = serializers.BulkInviteSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        results = service.send_bulk_invites(serializer.validated_data)
+        return Response({'results': results}, status=200, content_type='application/json')
+
     #retrieves a organization membership
     def retrieve(self, request, pk):
-        self.queryset = self.get_queryset(request, 'retrieve')
+        fields = serializers.OrganizationMembershipSerializer.requested_fields(request)
+        self.queryset = self.only_requested(self.get_queryset(request, 'retrieve'), serializers.OrganizationMembershipSerializer, fields)
         service = services.organization_memberships.OrganizationMembershipService(self.request, self.queryset)
+        return self.conditional_response(self.retrieve_etag(pk), lambda: self._retrieve(service, pk, fields))
+
+    def _retrieve(self, service, pk, fields):
         #gets organization and validates user belongs to organization
         membership = service.get_or_raise(pk)
-        data = serializers.OrganizationMembershipSerializer(membership).data
+        data = serializers.OrganizationMembershipSerializer(membership, fields=fields).data
         return Response(data, status=200, content_type='application/json')
     
     #updates an existing organization membership
@@ -197,18 +426,19 @@ class AuthViewSet(AccessViewSetMixin, PermissionedModelViewSet):
         serializer.is_valid(raise_exception=True)
         client_id = serializer.validated_data['client_id']
         client_secret = serializer.validated_data['client_secret']
-        conn = http.client.HTTPSConnection(settings.AUTH0_DOMAIN)
-        payload = {"client_id": client_id, "client_secret": client_secret, "audience": settings.AUTH0_API_AUDIENCE, "grant_type": "client_credentials"}
-        payload = json.dumps(payload)
-        headers = { 'content-type': "application/json" }
-        conn.request("POST", "/oauth/token", payload, headers)
-        res = conn.getresponse()
-        if res.status == 200:
-            data = res.read()
-            data = data.decode("utf-8")
-            data = json.loads(data)
+        #tokens are requested through the broker which reuses still valid tokens for the same client
+        try:
+            status, data, retry_after = get_token_broker().get_token(client_id, client_secret)
+        except requests.RequestException:
+            return Response({'detail': 'Identity server unavailable'}, status=503, content_type='application/json')
+
+        if status == 200:
             return Response(data, status=200, content_type='application/json')
 
+        if status == 429:
+            return Response({'detail': 'Too many token requests'}, status=429, content_type='application/json',
+                            headers={'Retry-After': str(retry_after)})
+
         return Response({'Detail': 'Invalid credentials'}, status=401, content_type='application/json')
     
     def retrieve(self, request, pk):